@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# Load environment variables from .env file once, before any config module reads them
+load_dotenv()
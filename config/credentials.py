@@ -1,18 +1,19 @@
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
+from config.settings import INVOICE_RECIPIENT  # Read in settings; imported so validate_credentials checks it
 
-# Load environment variables from .env file
-load_dotenv()
+# Environment variables from .env are loaded once by the config package
 
 # Microsoft Graph API credentials
 MS_CLIENT_ID = os.environ.get('MS_CLIENT_ID')
 MS_CLIENT_SECRET = os.environ.get('MS_CLIENT_SECRET')
 MS_TENANT_ID = os.environ.get('MS_TENANT_ID')
 TARGET_EMAIL = os.environ.get('TARGET_EMAIL')
-INVOICE_RECIPIENT = os.environ.get('INVOICE_RECIPIENT')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
-# Validate required credentials
+# Validate required credentials; the values are fixed at import, so a
+# successful check is cached for the rest of the process
+@lru_cache(maxsize=1)
 def validate_credentials():
     missing = []
     for var in ['MS_CLIENT_ID', 'MS_CLIENT_SECRET', 'MS_TENANT_ID', 'TARGET_EMAIL', 'INVOICE_RECIPIENT', 'OPENAI_API_KEY']:
@@ -10,22 +10,69 @@ LOCAL_PDF_DIR = os.path.join(BASE_DIR, 'local')
 PROCESSED_PDF_DIR = os.path.join(BASE_DIR, 'processed')
 OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
 
-# Ensure directories exist
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-os.makedirs(LOCAL_PDF_DIR, exist_ok=True)
-os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Directories are created on first use via utils.file_utils.ensure_dir
 
 # Graph API settings
 GRAPH_API_VERSION = 'v1.0'
 GRAPH_BASE_URL = f'https://graph.microsoft.com/{GRAPH_API_VERSION}'
+GRAPH_BATCH_LIMIT = 20  # Maximum number of requests in a single $batch call
+DOWNLOAD_CHUNK_SIZE = 128 * 1024  # Block size used when streaming attachments to disk
+# Attachments this large or larger are sent through an upload session instead of inline
+LARGE_ATTACHMENT_THRESHOLD = 3 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024  # Upload session chunks must be multiples of 320 KiB
+# Upper bound on Graph requests in flight at once, to stay clear of throttling
+GRAPH_MAX_CONCURRENCY = int(os.environ.get('GRAPH_MAX_CONCURRENCY', 8))
 
 # Email processing settings
 MAX_EMAILS_PER_BATCH = 5
 
+# Address processed invoices are sent to
+INVOICE_RECIPIENT = os.environ.get('INVOICE_RECIPIENT')
+
+# Unread emails requested per page when walking the whole inbox
+EMAIL_PAGE_SIZE = int(os.environ.get('EMAIL_PAGE_SIZE', 50))
+
+# Number of emails processed concurrently (Graph/OpenAI calls are I/O bound)
+MAX_CONCURRENT_EMAILS = int(os.environ.get('MAX_CONCURRENT_EMAILS', MAX_EMAILS_PER_BATCH))
+
+# Number of local PDF files processed in parallel
+LOCAL_PDF_WORKERS = int(os.environ.get('LOCAL_PDF_WORKERS', 4))
+
+# Maximum number of OpenAI requests in flight across all worker threads
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8))
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 60))  # seconds per request
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+
+# Extractions run on the cheaper primary model first and are retried on the
+# fallback model when the result is unusable
+OPENAI_PRIMARY_MODEL = os.environ.get('OPENAI_PRIMARY_MODEL', 'gpt-4o-mini')
+OPENAI_FALLBACK_MODEL = os.environ.get('OPENAI_FALLBACK_MODEL', 'gpt-4o')
+
+# Submit local PDF runs through the OpenAI Batch API (half price, up to 24h turnaround)
+USE_OPENAI_BATCH_API = os.environ.get('USE_OPENAI_BATCH_API', 'false').lower() == 'true'
+OPENAI_BATCH_POLL_INTERVAL = int(os.environ.get('OPENAI_BATCH_POLL_INTERVAL', 60))  # seconds, longest wait between polls
+OPENAI_BATCH_MAX_REQUESTS = int(os.environ.get('OPENAI_BATCH_MAX_REQUESTS', 1000))  # requests per submitted batch job
+
+# Disk cache for LLM responses, keyed on the full request
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_DIR = os.environ.get('LLM_CACHE_DIR', os.path.join(BASE_DIR, '.llm_cache'))
+LLM_CACHE_TTL_DAYS = int(os.environ.get('LLM_CACHE_TTL_DAYS', 30))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 5000))  # Oldest entries beyond this are pruned
+
+# Disk cache for PDF to markdown conversions, keyed on the PDF's content
+MARKDOWN_CACHE_ENABLED = os.environ.get('MARKDOWN_CACHE_ENABLED', 'true').lower() == 'true'
+MARKDOWN_CACHE_DIR = os.environ.get('MARKDOWN_CACHE_DIR', os.path.join(BASE_DIR, '.markdown_cache'))
+MARKDOWN_CACHE_TTL_DAYS = int(os.environ.get('MARKDOWN_CACHE_TTL_DAYS', 30))
+MARKDOWN_CACHE_MAX_ENTRIES = int(os.environ.get('MARKDOWN_CACHE_MAX_ENTRIES', 1000))  # Oldest entries beyond this are pruned
+
 # Invoice template path
 INVOICE_TEMPLATE_PATH = os.path.join(BASE_DIR, 'templates', 'oioubl_template.xml')
 
+# Company CVR mapping and default customer configuration files
+CONFIG_DIR = os.path.join(BASE_DIR, 'config')
+COMPANY_CVR_MAP_PATH = os.path.join(CONFIG_DIR, 'company_cvr_map.json')
+DEFAULT_CUSTOMER_CONFIG_PATH = os.path.join(CONFIG_DIR, 'default_customer.json')
+
 # Output file retention
 OUTPUT_FILES_MAX_AGE_DAYS = int(os.environ.get('OUTPUT_FILES_MAX_AGE_DAYS', 3))
 
@@ -1,24 +1,22 @@
 import logging
 import os
 import shutil
-import traceback
 import argparse
-from datetime import datetime, timedelta
-import base64
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import time
+from functools import lru_cache
 from config.credentials import validate_credentials
-from config.settings import DOWNLOAD_DIR, OUTPUT_FILES_MAX_AGE_DAYS
+from config.settings import INVOICE_RECIPIENT, DOWNLOAD_DIR, LOCAL_PDF_DIR, OUTPUT_FILES_MAX_AGE_DAYS, MAX_CONCURRENT_EMAILS
 from services.email_service import EmailService
 from services.pdf_service import PDFService
 from services.invoice_service import InvoiceService
 from services.local_pdf_service import LocalPDFService
-from utils.file_utils import safe_filename
-from utils.token_tracker import get_token_usage, get_cost_estimate, reset_counters
-from dotenv import load_dotenv
+from utils.file_utils import safe_filename, ensure_dir
+from utils.llm_cache import prune_cache as prune_llm_cache
+from utils.token_tracker import get_token_usage, get_cost_estimate, reset_counters, get_cached_response_count
 import re
 
-# Load environment variables
-load_dotenv()
-
 # Configure logging
 logging.basicConfig(
     level=getattr(logging, os.environ.get("LOG_LEVEL", "INFO")),
@@ -27,30 +25,51 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Keywords logged with context when debugging markdown extraction
+KEYWORD_RE = re.compile(r"(Fakturakonto|Faktura|Nummer)")
+
+# Attachments with these content types are forwarded as-is
+XML_CONTENT_TYPES = frozenset({"application/xml", "text/xml"})
+
+
+@lru_cache(maxsize=1)
+def get_email_service():
+    """Shared EmailService so every email reuses the same Graph client and access token"""
+    return EmailService()
+
+@lru_cache(maxsize=1)
+def get_pdf_service():
+    """Shared PDFService so the MarkItDown converter is only set up once"""
+    return PDFService()
 
 def convert_pdf_to_markdown(file_path):
-    logger.info(f"Converting PDF to markdown: {file_path}")
-    pdf_service = PDFService()
-    markdown_content = pdf_service.convert_to_markdown(file_path)
+    logger.info("Converting PDF to markdown: %s", file_path)
+    markdown_content = get_pdf_service().convert_to_markdown(file_path)
+    
+    logger.info("PDF converted to markdown, length: %s characters", len(markdown_content))
+    
+    # Content diagnostics for difficult cases - only built when DEBUG is enabled
+    if not logger.isEnabledFor(logging.DEBUG):
+        return markdown_content
     
-    # Log complete content for difficult cases
-    logger.info(f"PDF converted to markdown, length: {len(markdown_content)} characters")
+    # Find all occurrences of specific keywords in a single pass
+    hits = defaultdict(list)
+    for match in KEYWORD_RE.finditer(markdown_content):
+        hits[match.group(1)].append(match.start())
     
-    # Find all occurrences of specific keywords
-    keywords = ["Faktura", "Nummer", "Fakturakonto"]
-    for keyword in keywords:
-        positions = [m.start() for m in re.finditer(keyword, markdown_content)]
-        if positions:
-            logger.info(f"Found '{keyword}' at positions: {positions}")
-            for pos in positions:
-                context = markdown_content[max(0, pos-20):min(len(markdown_content), pos+80)]
-                logger.info(f"Context around '{keyword}': {context}")
+    keyword_report = []
+    for keyword, positions in hits.items():
+        keyword_report.append(f"Found '{keyword}' at positions: {positions}")
+        for pos in positions:
+            context = markdown_content[max(0, pos-20):min(len(markdown_content), pos+80)]
+            keyword_report.append(f"Context around '{keyword}': {context}")
+    if keyword_report:
+        logger.debug("Keyword matches:\n%s", "\n".join(keyword_report))
     
-    # Log the entire content line by line to help with debugging
+    # Log the start of the content in a single record to help with debugging
     lines = markdown_content.split('\n')
-    logger.info(f"Total lines in content: {len(lines)}")
-    for i, line in enumerate(lines[:50]):  # Log first 50 lines
-        logger.info(f"Line {i}: {line}")
+    preview = "\n".join(f"Line {i}: {line}" for i, line in enumerate(lines[:50]))
+    logger.debug("Total lines in content: %d, first 50 lines:\n%s", len(lines), preview)
     
     return markdown_content
 
@@ -59,23 +78,23 @@ def generate_invoice(markdown_content, invoice_service):
     return invoice_service.generate_invoice(markdown_content)
 
 def send_invoice_email(invoice_file_path, invoice_data, original_email, token_usage=None):
-    email_service = EmailService()
+    email_service = get_email_service()
     return email_service.send_invoice(invoice_file_path, invoice_data, original_email, token_usage)
 
-def forward_email_directly(email):
+def forward_email_directly(email, attachments=None):
     """Forward an email directly without any modification"""
     try:
-        email_service = EmailService()
-        recipient_email = os.environ.get('INVOICE_RECIPIENT')
+        email_service = get_email_service()
+        recipient_email = INVOICE_RECIPIENT
         
         if not recipient_email:
             logger.error("INVOICE_RECIPIENT not defined in environment variables")
             return False
         
-        # Get original email details
+        # Get original email details; the listing leaves out the body, so fetch it now
         original_subject = email.get("subject", "No subject")
-        original_body = email.get("body", {})
         email_id = email.get("id")
+        original_body = email["body"] if "body" in email else email_service.get_email_body(email_id)
         
         # Create a message that preserves the original email as closely as possible
         message = {
@@ -96,26 +115,24 @@ def forward_email_directly(email):
         if "ccRecipients" in email:
             message["message"]["ccRecipients"] = email["ccRecipients"]
         
-        # Get original attachments if available
-        attachments = email_service.get_email_attachments(email_id)
+        # Get original attachments if the caller hasn't listed them already
+        if attachments is None:
+            attachments = email_service.get_email_attachments(email_id)
         
         # If there are attachments, add them to the forwarded email
         if attachments:
             forwarded_attachments = []
             
+            # Attachments fetched through get_email_attachments carry base64 contentBytes; the
+            # metadata from the unread listing does not, so those are downloaded in one batch
+            missing_ids = [attachment.get("id") for attachment in attachments if not attachment.get("contentBytes")]
+            attachment_contents = email_service.get_attachments_batch(email_id, missing_ids) if missing_ids else {}
+            
             for attachment in attachments:
-                # Download the attachment
                 attachment_id = attachment.get("id")
                 attachment_name = attachment.get("name", "attachment")
                 content_type = attachment.get("contentType", "application/octet-stream")
-                
-                # Get attachment content
-                attachment_content = email_service.client.get_binary(
-                    f"/users/{email_service.target_email}/messages/{email_id}/attachments/{attachment_id}/$value"
-                )
-                
-                # Encode for the email
-                content_bytes = base64.b64encode(attachment_content).decode('utf-8')
+                content_bytes = attachment.get("contentBytes") or attachment_contents.get(attachment_id, "")
                 
                 # Add to forwarded attachments
                 forwarded_attachments.append({
@@ -129,16 +146,26 @@ def forward_email_directly(email):
             message["message"]["attachments"] = forwarded_attachments
         
         # Send the email
-        endpoint = f"/users/{email_service.target_email}/sendMail"
-        email_service.client.post(endpoint, message)
+        email_service.client.post(email_service.send_mail_endpoint, message)
         
-        logger.info(f"Email forwarded to {recipient_email} without modification")
+        logger.info("Email forwarded to %s without modification", recipient_email)
         return True
         
     except Exception as e:
-        logger.error(f"Error forwarding email: {e}", exc_info=True)
+        logger.exception("Error forwarding email: %s", e)
         return False
 
+def classify_attachment(attachment):
+    """Return 'xml', 'pdf' or 'skip' for an attachment based on its type and name"""
+    content_type = attachment.get("contentType", "")
+    filename = attachment.get("name", "")
+    
+    if content_type in XML_CONTENT_TYPES or filename[-4:].lower() == '.xml':
+        return "xml"
+    if content_type == "application/pdf":
+        return "pdf"
+    return "skip"
+
 def process_attachment(attachment, email_id, email_data, temp_dir, invoice_service):
     try:
         content_type = attachment.get("contentType", "")
@@ -146,31 +173,20 @@ def process_attachment(attachment, email_id, email_data, temp_dir, invoice_servi
         original_filename = attachment.get("name", "attachment")
         safe_name = safe_filename(original_filename)
         
-        logger.info(f"Processing attachment: {safe_name} (type: {content_type})")
-        
-        # Check if it's an XML file - trigger direct email forwarding
-        if content_type == "application/xml" or content_type == "text/xml" or original_filename.lower().endswith('.xml'):
-            logger.info(f"Found XML attachment: {safe_name} - will forward entire email directly")
-            # Return special status to indicate the entire email should be forwarded
-            return "FORWARD_ENTIRE_EMAIL"
+        logger.info("Processing attachment: %s (type: %s)", safe_name, content_type)
             
-        # Skip non-PDF attachments that aren't XML
-        if content_type != "application/pdf":
-            logger.info(f"Skipping non-PDF, non-XML attachment: {safe_name}")
-            return False
-            
-        # Process PDF as before
-        email_service = EmailService()  # Initialize email service
+        # Only PDF attachments reach this point (see classify_attachment)
+        email_service = get_email_service()
         temp_file_path = os.path.join(temp_dir, safe_name)
         
-        # Download attachment to temp directory
-        logger.info(f"Downloading PDF attachment to: {temp_file_path}")
+        # Stream the PDF straight to disk; the email listing only carries attachment metadata
+        logger.info("Downloading PDF attachment to: %s", temp_file_path)
         email_service.download_attachment(email_id, attachment_id, temp_file_path)
         
         # Convert PDF to markdown
         markdown_content = convert_pdf_to_markdown(temp_file_path)
         if not markdown_content:
-            logger.warning(f"No markdown content extracted from PDF: {safe_name}")
+            logger.warning("No markdown content extracted from PDF: %s", safe_name)
             return False
             
         # Generate invoice from markdown
@@ -180,17 +196,14 @@ def process_attachment(attachment, email_id, email_data, temp_dir, invoice_servi
             logger.warning("Failed to generate invoice")
             return False 
 
-        # Get token usage from the global tracker
-        token_usage = get_token_usage()
-
-        # Send invoice email
+        # Send invoice email with the tokens spent on this invoice; the global tracker
+        # also counts emails being processed at the same time
         result = send_invoice_email(invoice_file_path, invoice_data, email_data, token_usage)
         
         return result
         
     except Exception as e:
-        logger.error(f"Error processing attachment: {e}")
-        logger.debug(traceback.format_exc())
+        logger.exception("Error processing attachment: %s", e)
         return False
 
 def process_single_email(email, temp_dir, invoice_service):
@@ -199,72 +212,66 @@ def process_single_email(email, temp_dir, invoice_service):
         subject = email["subject"]
         from_email = email.get("from", {}).get("emailAddress", {}).get("address", "unknown")
         
-        logger.info(f"Processing email: {subject} from {from_email}")
+        logger.info("Processing email: %s from %s", subject, from_email)
         
-        # Initialize email service
-        email_service = EmailService()
+        email_service = get_email_service()
         
         # If email doesn't have attachments, forward it directly
         if not email.get("hasAttachments", False):
-            logger.info(f"Email has no attachments, forwarding directly: {subject}")
+            logger.info("Email has no attachments, forwarding directly: %s", subject)
             
             # Forward the email directly
-            result = forward_email_directly(email)
+            result = forward_email_directly(email, email.get("attachments"))
             
-            # Mark as read if successfully forwarded
             if result:
-                email_service.mark_as_read(email_id)    # Comment on dev
-                logger.info(f"Successfully forwarded email: {subject}")
+                logger.info("Successfully forwarded email: %s", subject)
                 return True
             else:
-                logger.warning(f"Failed to forward email: {subject}")
+                logger.warning("Failed to forward email: %s", subject)
                 return False
         
-        # Get attachments for emails that have them
-        attachments = email_service.get_email_attachments(email_id)
+        # Attachments are expanded with the listing; fetch them only if they weren't
+        attachments = email.get("attachments")
+        if attachments is None:
+            attachments = email_service.get_email_attachments(email_id)
         
         if not attachments:
-            logger.info(f"No attachments found for email: {subject}")
+            logger.info("No attachments found for email: %s", subject)
             # Forward the email directly since it claims to have attachments but none were found
-            result = forward_email_directly(email)
+            result = forward_email_directly(email, attachments)
             
             if result:
-                email_service.mark_as_read(email_id)    # Comment on dev
-                logger.info(f"Successfully forwarded email without attachments: {subject}")
+                logger.info("Successfully forwarded email without attachments: %s", subject)
                 return True
             else:
-                logger.warning(f"Failed to forward email without attachments: {subject}")
+                logger.warning("Failed to forward email without attachments: %s", subject)
                 return False
         
-        # First check if any attachment is XML - if so, forward the entire email directly
-        for attachment in attachments:
-            content_type = attachment.get("contentType", "")
-            filename = attachment.get("name", "")
+        # Classify every attachment once
+        kinds = [classify_attachment(attachment) for attachment in attachments]
+        
+        # If any attachment is XML, forward the entire email directly
+        if "xml" in kinds:
+            logger.info("Found XML attachment, forwarding entire email directly: %s", subject)
+            result = forward_email_directly(email, attachments)
             
-            if (content_type == "application/xml" or content_type == "text/xml" or 
-                filename.lower().endswith('.xml')):
-                logger.info(f"Found XML attachment, forwarding entire email directly: {subject}")
-                result = forward_email_directly(email)
-                
-                if result:
-                    email_service.mark_as_read(email_id)    # Comment on dev
-                    logger.info(f"Successfully forwarded email with XML: {subject}")
-                    return True
-                else:
-                    logger.warning(f"Failed to forward email with XML: {subject}")
-                    return False
+            if result:
+                logger.info("Successfully forwarded email with XML: %s", subject)
+                return True
+            else:
+                logger.warning("Failed to forward email with XML: %s", subject)
+                return False
             
-        # Process each attachment (PDFs only at this point)
+        # Process each PDF attachment, skipping anything else
         success = False
-        for attachment in attachments:
+        for attachment, kind in zip(attachments, kinds):
+            if kind != "pdf":
+                logger.info("Skipping non-PDF, non-XML attachment: %s", attachment.get('name', 'attachment'))
+                continue
+                
             attachment_result = process_attachment(
                 attachment, email_id, email, temp_dir, invoice_service
             )
-            
-            # Special handling for XML forwarding flag
-            if attachment_result == "FORWARD_ENTIRE_EMAIL":
-                logger.info(f"XML detected during processing, forwarding entire email: {subject}")
-                return forward_email_directly(email)
                 
             # If any attachment is processed successfully, consider the email processed
             if attachment_result:
@@ -272,47 +279,44 @@ def process_single_email(email, temp_dir, invoice_service):
                 
         # Mark email as read only if successfully processed
         if success:
-            email_service.mark_as_read(email_id)    # Comment on dev
-            logger.info(f"Successfully processed email: {subject}")
+            logger.info("Successfully processed email: %s", subject)
         else:
-            logger.warning(f"Failed to process email: {subject}")
+            logger.warning("Failed to process email: %s", subject)
             
         return success
         
     except Exception as e:
-        logger.error(f"Error processing email: {e}")
-        logger.debug(traceback.format_exc())
+        logger.exception("Error processing email: %s", e)
         return False
 
 def clean_output_directory(max_age_days=7):
     try:
         output_dir = os.path.join(os.getcwd(), "output")
-        if not os.path.exists(output_dir):
-            return
-            
-        logger.info(f"Cleaning up output directory: {output_dir}")
-        current_time = datetime.now()
-        max_age = timedelta(days=max_age_days)
+        cutoff = time.time() - max_age_days * 86400
         
-        # Check each file in the output directory
-        for filename in os.listdir(output_dir):
-            file_path = os.path.join(output_dir, filename)
+        # Check each file in the output directory; scandir caches the stat info
+        try:
+            entries = os.scandir(output_dir)
+        except FileNotFoundError:
+            return
             
-            # Skip directories
-            if os.path.isdir(file_path):
-                continue
-                
-            # Check file age
-            file_age = current_time - datetime.fromtimestamp(os.path.getmtime(file_path))
-            if file_age > max_age:
-                try:
-                    os.remove(file_path)
-                    logger.info(f"Removed old file: {filename}")
-                except Exception as e:
-                    logger.error(f"Error removing file {filename}: {e}")
+        logger.info("Cleaning up output directory: %s", output_dir)
+        with entries:
+            for entry in entries:
+                # Skip directories
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                    
+                # Check file age
+                if entry.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(entry.path)
+                        logger.info("Removed old file: %s", entry.name)
+                    except Exception as e:
+                        logger.error("Error removing file %s: %s", entry.name, e)
     
     except Exception as cleanup_error:
-        logger.error(f"Error cleaning up output directory: {cleanup_error}")
+        logger.error("Error cleaning up output directory: %s", cleanup_error)
 
 def process_local_pdfs():
     """Process PDF files from local directory"""
@@ -322,6 +326,7 @@ def process_local_pdfs():
     
     try:
         logger.info("Starting local PDF processing")
+        ensure_dir(LOCAL_PDF_DIR)
         
         # Initialize local PDF service
         local_service = LocalPDFService()
@@ -363,13 +368,14 @@ def process_local_pdfs():
         logger.info("Local PDF processing completed")
         
     except Exception as e:
-        logger.error(f"Error in local PDF processing: {e}")
-        logger.debug(traceback.format_exc())
+        logger.exception("Error in local PDF processing: %s", e)
         print(f"\nError: {e}")
         raise
     finally:
-        # Clean up old output files
+        # Clean up old output files and cache entries
         clean_output_directory(max_age_days=OUTPUT_FILES_MAX_AGE_DAYS)
+        get_pdf_service().prune_cache()
+        prune_llm_cache()
 
 def process_emails():
     """Main function to process emails"""
@@ -378,11 +384,8 @@ def process_emails():
     reset_counters()
     
     # Create a session-specific temp directory
-    session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-    temp_root = os.path.join(DOWNLOAD_DIR, f"session_{session_id}")
-
-    # Initialize invoice service
-    invoice_service = InvoiceService()
+    session_id = f"{time.time_ns():x}"
+    temp_root = os.path.join(ensure_dir(DOWNLOAD_DIR), f"session_{session_id}")
     
     try:
         # Validate credentials before starting
@@ -390,32 +393,64 @@ def process_emails():
         
         # Create temp directory for this processing session
         os.makedirs(temp_root, exist_ok=True)
-        logger.info(f"Created temporary directory: {temp_root}")
+        logger.info("Created temporary directory: %s", temp_root)
         
-        # Initialize services
-        email_service = EmailService()
-        
-        # Get unread emails
-        emails = email_service.get_unread_emails()
-        
-        if not emails:
-            logger.info("No unread emails to process")
-            return
-            
-        logger.info(f"Found {len(emails)} unread emails to process")
+        email_service = get_email_service()
         
-        # Process each email in a separate temp directory
-        for index, email in enumerate(emails):
-            # Create email-specific temp directory
-            email_temp_dir = os.path.join(temp_root, f"email_{index}")
-            os.makedirs(email_temp_dir, exist_ok=True)
-            
-            try:
-                # process_single_email(email, email_temp_dir)
-                process_single_email(email, email_temp_dir, invoice_service)
-            except Exception as e:
-                logger.error(f"Failed to process email {index}: {e}")
-                # Continue with next email
+        # Process every unread email concurrently, each in a separate temp directory.
+        # Pages are fetched as the listing is consumed, so work starts on the first page
+        # while later ones are still loading. InvoiceService keeps per-document state,
+        # so every email gets its own.
+        processed_ids = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_EMAILS)) as executor:
+                # Only a couple of emails per worker are queued; the listing waits for one to
+                # finish before reading on, so pages are not fetched far ahead of the work
+                max_pending = max(1, MAX_CONCURRENT_EMAILS) * 2
+                pending = {}
+                email_count = 0
+                
+                def collect(done):
+                    for future in done:
+                        email_id = pending.pop(future)
+                        try:
+                            if future.result():
+                                processed_ids.append(email_id)
+                        except Exception as e:
+                            logger.error("Failed to process email %s: %s", email_id, e)
+                            # Continue with next email
+                
+                try:
+                    for index, email in enumerate(email_service.iter_unread_emails()):
+                        if len(pending) >= max_pending:
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        
+                        # Create email-specific temp directory
+                        email_temp_dir = os.path.join(temp_root, f"email_{index}")
+                        os.makedirs(email_temp_dir, exist_ok=True)
+                        
+                        future = executor.submit(process_single_email, email, email_temp_dir, InvoiceService())
+                        pending[future] = email["id"]
+                        email_count += 1
+                finally:
+                    # Even when paging fails, finish and record the emails already submitted
+                    collect(as_completed(list(pending)))
+                
+                if not email_count:
+                    logger.info("No unread emails to process")
+                    return
+                    
+                logger.info("Found %s unread emails to process", email_count)
+        finally:
+            # Mark emails as read only once the unread listing has been paged to the end: nextLink
+            # pages with $skip, so shrinking the filtered set mid-listing would skip unread emails.
+            # This runs even when processing fails, so a retry does not send those invoices again.
+            if processed_ids:
+                try:
+                    email_service.mark_as_read_batch(processed_ids)    # Comment on dev
+                except Exception as e:
+                    logger.error("Failed to mark emails as read: %s", e)
                 
         logger.info("Email processing completed")
 
@@ -423,26 +458,24 @@ def process_emails():
         usage = get_token_usage()
         
         logger.info("Token Usage Summary:")
-        logger.info(f"Prompt tokens: {usage['prompt_tokens']}")
-        logger.info(f"Completion tokens: {usage['completion_tokens']}")
-        logger.info(f"Total tokens: {usage['total_tokens']}")
-        logger.info(f"Estimated OpenAI API cost: ${get_cost_estimate():.4f}")
+        logger.info("Prompt tokens: %s", usage['prompt_tokens'])
+        logger.info("Completion tokens: %s", usage['completion_tokens'])
+        logger.info("Total tokens: %s", usage['total_tokens'])
+        logger.info("Cached LLM responses: %s", get_cached_response_count())
+        logger.info("Estimated OpenAI API cost: $%.4f", get_cost_estimate())
         
     except Exception as e:
-        logger.error(f"Error in email processing: {e}")
-        logger.debug(traceback.format_exc())
+        logger.exception("Error in email processing: %s", e)
         raise
     finally:
         # Clean up temporary files
-        try:
-            if os.path.exists(temp_root):
-                logger.info(f"Cleaning up temporary directory: {temp_root}")
-                shutil.rmtree(temp_root)    # Comment on dev
-        except Exception as cleanup_error:
-            logger.error(f"Error cleaning up temp directory: {cleanup_error}")
+        logger.info("Cleaning up temporary directory: %s", temp_root)
+        shutil.rmtree(temp_root, ignore_errors=True)    # Comment on dev
 
-        # Clean up old output files
+        # Clean up old output files and cache entries
         clean_output_directory(max_age_days=OUTPUT_FILES_MAX_AGE_DAYS)
+        get_pdf_service().prune_cache()
+        prune_llm_cache()
 
 def main():
     """Application entry point with support for local and email processing"""
@@ -468,7 +501,7 @@ def main():
                 break
             except Exception as e:
                 retry_count += 1
-                logger.error(f"Attempt {retry_count} failed: {e}")
+                logger.error("Attempt %s failed: %s", retry_count, e)
                 if retry_count >= max_retries:
                     logger.critical("Max retries exceeded, giving up")
                     raise
@@ -1,78 +1,16 @@
 import os
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from services.graph_client import GraphClient
 from config.credentials import TARGET_EMAIL
-from config.settings import MAX_EMAILS_PER_BATCH
-import base64
+from config.settings import EMAIL_PAGE_SIZE, LARGE_ATTACHMENT_THRESHOLD, INVOICE_RECIPIENT
+from utils.file_utils import encode_file_base64
 
 logger = logging.getLogger(__name__)
 
-class EmailService:
-    """Service for interacting with emails via Graph API"""
-    
-    def __init__(self):
-        self.client = GraphClient()
-        self.target_email = TARGET_EMAIL
-    
-    def get_unread_emails(self, limit=MAX_EMAILS_PER_BATCH):
-        endpoint = f"/users/{self.target_email}/messages"
-        
-        params = {
-            "$filter": "isRead eq false",
-            "$top": limit,
-            "$select": "id,subject,receivedDateTime,hasAttachments,from,body,ccRecipients"
-        }
-        
-        response = self.client.get(endpoint, params)
-        emails = response.get("value", [])
-        
-        logger.info(f"Found {len(emails)} unread emails")
-        return emails
-    
-    def get_email_attachments(self, email_id):
-        endpoint = f"/users/{self.target_email}/messages/{email_id}/attachments"
-        
-        response = self.client.get(endpoint)
-        attachments = response.get("value", [])
-        
-        logger.info(f"Found {len(attachments)} attachments for email {email_id}")
-        return attachments
-    
-    def download_attachment(self, email_id, attachment_id, filename=None):
-        endpoint = f"/users/{self.target_email}/messages/{email_id}/attachments/{attachment_id}/$value"
-        
-        content = self.client.get_binary(endpoint)
-        
-        if not filename:
-            # Get attachment info to get the filename
-            attachment_info = self.client.get(
-                f"/users/{self.target_email}/messages/{email_id}/attachments/{attachment_id}"
-            )
-            filename = attachment_info.get("name", f"attachment_{attachment_id}")
-        
-        # file_path = os.path.join(DOWNLOAD_DIR, filename)
-        file_path = os.path.join(filename)
-        
-        with open(file_path, 'wb') as file:
-            file.write(content)
-        
-        logger.info(f"Downloaded attachment to {file_path}")
-        return file_path
-    
-    def mark_as_read(self, email_id):
-        endpoint = f"/users/{self.target_email}/messages/{email_id}"
-        
-        data = {
-            "isRead": True
-        }
-        
-        self.client.patch(endpoint, data)
-        logger.info(f"Marked email {email_id} as read")
-        return True
-
-    def _create_forwarded_xml_email_body(self, invoice_number, processing_date):
-        """Create email body template for forwarded XML invoices"""
-        return f"""
+# Email body templates, built once at import time; only the dynamic spans are formatted per call
+_FORWARDED_TMPL = """
         <div style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; max-width: 500px; margin: 0 auto;">
             <div style="text-align: center; padding: 40px 20px;">
                 <div style="display: inline-block; background: #fef3c7; padding: 20px; border-radius: 50%; margin-bottom: 20px;">
@@ -110,9 +48,7 @@ class EmailService:
         </div>
         """
 
-    def _create_processed_pdf_email_body(self, invoice_number, processing_date, token_usage=None):
-        """Create email body template for processed PDF invoices"""
-        body = f"""
+_PROCESSED_HEAD_TMPL = """
         <div style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; max-width: 500px; margin: 0 auto;">
             <div style="text-align: center; padding: 40px 20px;">
                 <div style="display: inline-block; background: #f0f9ff; padding: 20px; border-radius: 50%; margin-bottom: 20px;">
@@ -141,19 +77,8 @@ class EmailService:
                     The processed OIOUBL XML file is attached and ready for use in your accounting system.
                 </p>
         """
-        
-        # Add token usage information if provided
-        if token_usage:
-            prompt_tokens = token_usage.get('prompt_tokens', 0)
-            completion_tokens = token_usage.get('completion_tokens', 0)
-            total_tokens = token_usage.get('total_tokens', 0)
-            
-            # Calculate cost
-            prompt_cost = (prompt_tokens / 1000) * 0.0015
-            completion_cost = (completion_tokens / 1000) * 0.002
-            total_cost = prompt_cost + completion_cost
-            
-            body += f"""
+
+_PROCESSED_TOKENS_TMPL = """
                 <div style="background: #f8fafc; border: 1px solid #e2e8f0; border-radius: 8px; padding: 20px; margin: 20px 0; text-align: left;">
                     <h4 style="color: #475569; margin: 0 0 15px 0; font-size: 14px; font-weight: 600;">⚡ Processing Stats</h4>
                     <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px; font-size: 12px;">
@@ -168,9 +93,8 @@ class EmailService:
                     </div>
                 </div>
             """
-        
-        # Close the template
-        body += """
+
+_PROCESSED_TAIL = """
                 <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
                     <p style="font-size: 12px; color: #9ca3af; margin: 0;">
                         Automated by Invoice Processing System
@@ -179,8 +103,197 @@ class EmailService:
             </div>
         </div>
         """
+
+class EmailService:
+    """Service for interacting with emails via Graph API"""
+    
+    def __init__(self):
+        self.client = GraphClient()
+        self.target_email = TARGET_EMAIL
+        # Endpoint prefixes are fixed for the mailbox, so build them once
+        self.messages_endpoint = f"/users/{self.target_email}/messages"
+        self.send_mail_endpoint = f"/users/{self.target_email}/sendMail"
+    
+    def _unread_params(self, limit):
+        return {
+            "$filter": "isRead eq false",
+            "$top": limit,
+            # body can be large and is only needed when an email is forwarded; see get_email_body
+            "$select": "id,subject,receivedDateTime,hasAttachments,from,ccRecipients",
+            # List attachment metadata with the email instead of one request per email; the content
+            # is left out so a page never holds every attachment in memory (PDFs are streamed to disk)
+            "$expand": "attachments($select=id,name,contentType,size)"
+        }
+    
+    def iter_unread_emails(self, page_size=EMAIL_PAGE_SIZE):
+        """Yield every unread email, following @odata.nextLink across pages.
+        
+        The next page is requested in the background while the current one is consumed.
+        """
+        endpoint = self.messages_endpoint
+        
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            response = self.client.get(endpoint, self._unread_params(page_size))
+            
+            while True:
+                # nextLink already carries the filter and skiptoken
+                next_link = response.get("@odata.nextLink")
+                next_page = prefetcher.submit(self.client.get, next_link) if next_link else None
+                
+                # Hand emails out one at a time and drop the page's reference to each, so an
+                # email and its attachment listing are freed as soon as its worker is done
+                emails = deque(response.pop("value", []))
+                logger.info(f"Fetched page of {len(emails)} unread emails")
+                while emails:
+                    yield emails.popleft()
+                
+                if next_page is None:
+                    break
+                response = next_page.result()
+    
+    def get_email_body(self, email_id):
+        endpoint = f"{self.messages_endpoint}/{email_id}"
         
-        return body
+        response = self.client.get(endpoint, {"$select": "body"})
+        return response.get("body", {})
+    
+    def get_email_attachments(self, email_id):
+        endpoint = f"{self.messages_endpoint}/{email_id}/attachments"
+        
+        response = self.client.get(endpoint)
+        attachments = response.get("value", [])
+        
+        logger.info(f"Found {len(attachments)} attachments for email {email_id}")
+        return attachments
+    
+    def get_attachments_batch(self, email_id, attachment_ids):
+        """Fetch attachment contents through the Graph $batch endpoint.
+        
+        Returns a dict mapping attachment id to its base64 encoded content,
+        which is the form Graph uses for binary bodies in batch responses.
+        """
+        requests_list = [
+            {
+                "method": "GET",
+                "url": f"{self.messages_endpoint}/{email_id}/attachments/{attachment_id}/$value"
+            }
+            for attachment_id in attachment_ids
+        ]
+        
+        contents = {}
+        for attachment_id, item in zip(attachment_ids, self.client.batch(requests_list)):
+            status = item.get("status")
+            if not status or status >= 400:
+                raise Exception(f"Batch download of attachment {attachment_id} failed with status {status}")
+            contents[attachment_id] = item.get("body", "")
+        
+        logger.info(f"Downloaded {len(contents)} attachments for email {email_id} in batch")
+        return contents
+    
+    def download_attachment(self, email_id, attachment_id, filename=None):
+        endpoint = f"{self.messages_endpoint}/{email_id}/attachments/{attachment_id}/$value"
+        
+        if not filename:
+            # Get attachment info to get the filename
+            attachment_info = self.client.get(
+                f"{self.messages_endpoint}/{email_id}/attachments/{attachment_id}"
+            )
+            filename = attachment_info.get("name", f"attachment_{attachment_id}")
+        
+        # file_path = os.path.join(DOWNLOAD_DIR, filename)
+        file_path = os.path.join(filename)
+        
+        # Stream the content straight to disk to keep memory bounded
+        self.client.download_to_file(endpoint, file_path)
+        
+        logger.info(f"Downloaded attachment to {file_path}")
+        return file_path
+    
+    def mark_as_read(self, email_id):
+        endpoint = f"{self.messages_endpoint}/{email_id}"
+        
+        data = {
+            "isRead": True
+        }
+        
+        self.client.patch(endpoint, data)
+        logger.info(f"Marked email {email_id} as read")
+        return True
+    
+    def mark_as_read_batch(self, email_ids):
+        """Mark several emails as read using $batch instead of one PATCH per email"""
+        requests_list = [
+            {
+                "method": "PATCH",
+                "url": f"{self.messages_endpoint}/{email_id}",
+                "body": {"isRead": True}
+            }
+            for email_id in email_ids
+        ]
+        
+        # A sub-response without a status never reached Graph, so it counts as failed
+        failed = []
+        for email_id, item in zip(email_ids, self.client.batch(requests_list)):
+            status = item.get("status")
+            if not status or status >= 400:
+                failed.append(email_id)
+        
+        if failed:
+            logger.error(f"Failed to mark {len(failed)} emails as read: {failed}")
+        logger.info(f"Marked {len(email_ids) - len(failed)} emails as read")
+        return not failed
+
+    def _create_forwarded_xml_email_body(self, invoice_number, processing_date):
+        """Create email body template for forwarded XML invoices"""
+        return _FORWARDED_TMPL.format(invoice_number=invoice_number, processing_date=processing_date)
+
+    def _create_processed_pdf_email_body(self, invoice_number, processing_date, token_usage=None):
+        """Create email body template for processed PDF invoices"""
+        parts = [_PROCESSED_HEAD_TMPL.format(invoice_number=invoice_number, processing_date=processing_date)]
+        
+        # Add token usage information if provided
+        if token_usage:
+            prompt_tokens = token_usage.get('prompt_tokens', 0)
+            completion_tokens = token_usage.get('completion_tokens', 0)
+            total_tokens = token_usage.get('total_tokens', 0)
+            
+            # Calculate cost
+            prompt_cost = (prompt_tokens / 1000) * 0.0015
+            completion_cost = (completion_tokens / 1000) * 0.002
+            total_cost = prompt_cost + completion_cost
+            
+            parts.append(_PROCESSED_TOKENS_TMPL.format(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=total_tokens,
+                total_cost=total_cost
+            ))
+        
+        # Close the template
+        parts.append(_PROCESSED_TAIL)
+        
+        return "".join(parts)
+
+    def _send_with_upload_session(self, message, file_path, file_name, file_size):
+        """Send a message whose attachment is uploaded in raw chunks to a draft"""
+        draft = self.client.post(self.messages_endpoint, message)
+        draft_id = draft["id"]
+        
+        upload_session = self.client.post(
+            f"{self.messages_endpoint}/{draft_id}/attachments/createUploadSession",
+            {
+                "AttachmentItem": {
+                    "attachmentType": "file",
+                    "name": file_name,
+                    "size": file_size,
+                    "contentType": "application/xml"
+                }
+            }
+        )
+        self.client.upload_file(upload_session["uploadUrl"], file_path)
+        
+        self.client.post(f"{self.messages_endpoint}/{draft_id}/send", {})
+        logger.info(f"Sent draft {draft_id} with {file_size} byte attachment via upload session")
 
     def send_invoice(self, invoice_file_path, invoice_data, original_email, token_usage=None):
         try:
@@ -192,22 +305,20 @@ class EmailService:
             
             logger.info(f"Sending invoice email for: {invoice_number} (direct XML: {is_direct_xml})")
             
-            # Check if the invoice file exists
-            if not os.path.exists(invoice_file_path):
+            # Check if the invoice file exists; the stat result also gives the size used below
+            try:
+                file_stat = os.stat(invoice_file_path)
+            except FileNotFoundError:
                 logger.error(f"Invoice file not found: {invoice_file_path}")
                 return False
             
-            # Get the specific recipient email from environment variables
-            recipient_email = os.environ.get('INVOICE_RECIPIENT')
+            # Get the specific recipient email from the settings
+            recipient_email = INVOICE_RECIPIENT
             
             if not recipient_email:
                 logger.error("INVOICE_RECIPIENT not defined in environment variables")
                 return False
                 
-            # Read the invoice file content
-            with open(invoice_file_path, 'rb') as file:
-                attachment_content = base64.b64encode(file.read()).decode('utf-8')
-            
             # Get the file name from the path
             file_name = os.path.basename(invoice_file_path)
             
@@ -237,22 +348,30 @@ class EmailService:
                                 "address": recipient_email
                             }
                         }
-                    ],
-                    "attachments": [
-                        {
-                            "@odata.type": "#microsoft.graph.fileAttachment",
-                            "name": file_name,
-                            "contentType": "application/xml",
-                            "contentBytes": attachment_content
-                        }
                     ]
                 }
             }
             
-            # Send the email using Microsoft Graph API
-            endpoint = f"/users/{self.target_email}/sendMail"
+            file_size = file_stat.st_size
             
-            self.client.post(endpoint, message)
+            if file_size < LARGE_ATTACHMENT_THRESHOLD:
+                # Small files go inline with a single sendMail call
+                message["message"]["attachments"] = [
+                    {
+                        "@odata.type": "#microsoft.graph.fileAttachment",
+                        "name": file_name,
+                        "contentType": "application/xml",
+                        "contentBytes": encode_file_base64(invoice_file_path)
+                    }
+                ]
+                
+                # Send the email using Microsoft Graph API
+                endpoint = self.send_mail_endpoint
+                
+                self.client.post(endpoint, message)
+            else:
+                # sendMail rejects attachments this large
+                self._send_with_upload_session(message["message"], invoice_file_path, file_name, file_size)
             
             logger.info(f"Invoice email sent to {recipient_email} with attachment: {file_name}")
             return True
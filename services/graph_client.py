@@ -1,36 +1,139 @@
+import os
 import requests
 import logging
-from utils.auth import get_access_token
-from config.settings import GRAPH_BASE_URL
+import threading
+import time
+import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.auth import get_access_token_with_expiry
+from config.settings import GRAPH_BASE_URL, DOWNLOAD_CHUNK_SIZE, UPLOAD_CHUNK_SIZE, GRAPH_MAX_CONCURRENCY, GRAPH_BATCH_LIMIT
 
 logger = logging.getLogger(__name__)
 
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+
+def _dumps(data):
+    """Serialize a request body, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class GraphRetry(Retry):
+    """Retry policy that also retries POST/PATCH, but only when Graph throttled or
+    refused the request (429/503) so it is known not to have been applied"""
+    
+    THROTTLE_STATUS_CODES = frozenset({429, 503})
+    
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() in ("POST", "PATCH") and status_code in self.THROTTLE_STATUS_CODES:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Rounds of resending throttled $batch sub-requests; the outer call succeeds, so the session retry never sees them
+BATCH_THROTTLE_RETRIES = 3
+
+
+def _retry_after_seconds(sub_response, attempt):
+    """Wait asked for by a throttled sub-response, exponential backoff when it gives none"""
+    headers = {key.lower(): value for key, value in (sub_response.get("headers") or {}).items()}
+    try:
+        return max(0.0, float(headers["retry-after"]))
+    except (KeyError, TypeError, ValueError):
+        return float(2 ** attempt)
+
+
+def _create_session():
+    """Create a pooled session so Graph calls reuse keep-alive TCP/TLS connections"""
+    session = requests.Session()
+    
+    # Retry transient failures with jittered exponential backoff, honouring Retry-After.
+    # The last response is returned so raise_for_status() still reports the HTTP error
+    retries = GraphRetry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.25,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retries)
+    session.mount("https://", adapter)
+    
+    # Every Graph call sends JSON; Authorization is added per request by GraphClient
+    session.headers["Content-Type"] = "application/json"
+    
+    return session
+
+# Shared by every GraphClient in the process
+SESSION = _create_session()
+
+# Caps concurrent Graph requests across all worker threads
+REQUEST_SLOTS = threading.BoundedSemaphore(max(1, GRAPH_MAX_CONCURRENCY))
+
+# Process-wide access token shared by every GraphClient; refreshed shortly before expiry
+_TOKEN_CACHE = {"value": None, "exp": 0}
+_TOKEN_LOCK = threading.Lock()
+
+def _get_cached_token():
+    """Return the cached access token, acquiring a new one if it is missing or about to expire"""
+    with _TOKEN_LOCK:
+        if not _TOKEN_CACHE["value"] or time.time() >= _TOKEN_CACHE["exp"] - 60:
+            token, expires_in = get_access_token_with_expiry()
+            _TOKEN_CACHE["value"] = token
+            _TOKEN_CACHE["exp"] = time.time() + expires_in
+        return _TOKEN_CACHE["value"]
+
+def _invalidate_token(token):
+    """Drop the cached token unless another thread has already replaced it"""
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE["value"] == token:
+            _TOKEN_CACHE["value"] = None
+            _TOKEN_CACHE["exp"] = 0
+
 class GraphClient:
     """Client for interacting with Microsoft Graph API"""
     
-    def __init__(self):
+    def __init__(self, session=None):
         self.base_url = GRAPH_BASE_URL
         self.access_token = None
+        # Pooled HTTP session; defaults to the process-wide one
+        self.session = session or SESSION
     
-    def _ensure_token(self):
-        """Ensure we have a valid access token"""
-        if not self.access_token:
-            self.access_token = get_access_token()
+    def _auth_headers(self):
+        """Authorization header for the current access token"""
+        self.access_token = _get_cached_token()
+        # Sent per request: the session's headers are shared by every worker thread
+        return {"Authorization": f"Bearer {self.access_token}"}
     
-    def _get_headers(self):
-        """Get headers for API requests"""
-        self._ensure_token()
-        return {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
-        }
+    def _send(self, method, url, **kwargs):
+        """Send a request, refreshing the access token and retrying once on 401"""
+        response = getattr(self.session, method)(url, headers=self._auth_headers(), **kwargs)
+        
+        if response.status_code == 401:
+            logger.info("Access token rejected, acquiring a new one")
+            response.close()
+            _invalidate_token(self.access_token)
+            response = getattr(self.session, method)(url, headers=self._auth_headers(), **kwargs)
+        
+        return response
     
     def get(self, endpoint, params=None):
-        """Make a GET request to the Graph API"""
-        url = f"{self.base_url}{endpoint}"
+        """Make a GET request to the Graph API.
+        
+        Absolute URLs such as @odata.nextLink are used as given.
+        """
+        url = endpoint if endpoint.startswith("http") else f"{self.base_url}{endpoint}"
         
         try:
-            response = requests.get(url, headers=self._get_headers(), params=params)
+            with REQUEST_SLOTS:
+                response = self._send("get", url, params=params)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
@@ -46,7 +149,8 @@ class GraphClient:
         url = f"{self.base_url}{endpoint}"
         
         try:
-            response = requests.patch(url, headers=self._get_headers(), json=data)
+            with REQUEST_SLOTS:
+                response = self._send("patch", url, data=_dumps(data))
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
@@ -62,7 +166,8 @@ class GraphClient:
         url = f"{self.base_url}{endpoint}"
         
         try:
-            response = requests.post(url, headers=self._get_headers(), json=data)
+            with REQUEST_SLOTS:
+                response = self._send("post", url, data=_dumps(data))
             response.raise_for_status()
             return response.json() if response.content else None
         except requests.exceptions.HTTPError as e:
@@ -73,14 +178,84 @@ class GraphClient:
             logger.error(f"Error in API request: {e}")
             raise
             
-    def get_binary(self, endpoint):
-        """Make a GET request that returns binary data"""
+    def batch(self, requests_list):
+        """Send sub-requests through the $batch endpoint, GRAPH_BATCH_LIMIT per call.
+        
+        Each sub-request is a dict with method, url and optionally body; ids are
+        assigned here. Returns the sub-responses in the same order as requests_list.
+        """
+        responses = []
+        
+        for start in range(0, len(requests_list), GRAPH_BATCH_LIMIT):
+            responses.extend(self._batch_chunk(requests_list[start:start + GRAPH_BATCH_LIMIT]))
+        
+        return responses
+    
+    def _batch_chunk(self, chunk):
+        """One $batch call, resending throttled sub-requests after their Retry-After"""
+        responses = [{}] * len(chunk)
+        indexes = range(len(chunk))
+        
+        for attempt in range(BATCH_THROTTLE_RETRIES + 1):
+            payload = {"requests": []}
+            for index in indexes:
+                item = dict(chunk[index], id=str(index))
+                if "body" in item:
+                    item.setdefault("headers", {"Content-Type": "application/json"})
+                payload["requests"].append(item)
+            
+            result = self.post("/$batch", payload) or {}
+            by_id = {item["id"]: item for item in result.get("responses", [])}
+            for index in indexes:
+                responses[index] = by_id.get(str(index), {})
+            
+            throttled = [index for index in indexes if responses[index].get("status") in GraphRetry.THROTTLE_STATUS_CODES]
+            if not throttled or attempt == BATCH_THROTTLE_RETRIES:
+                break
+            
+            delay = max(_retry_after_seconds(responses[index], attempt) for index in throttled)
+            logger.warning(f"{len(throttled)} batch sub-requests throttled, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            indexes = throttled
+        
+        return responses
+            
+    def download_to_file(self, endpoint, file_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Stream a binary GET response to disk without buffering it in memory"""
         url = f"{self.base_url}{endpoint}"
         
         try:
-            response = requests.get(url, headers=self._get_headers())
-            response.raise_for_status()
-            return response.content
+            with REQUEST_SLOTS, self._send("get", url, stream=True) as response:
+                response.raise_for_status()
+                with open(file_path, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+            return file_path
         except Exception as e:
             logger.error(f"Error downloading binary content: {e}")
-            raise
\ No newline at end of file
+            raise
+    
+    def upload_file(self, upload_url, file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+        """PUT a file to a pre-authenticated upload session URL in raw byte ranges"""
+        total_size = os.path.getsize(file_path)
+        
+        try:
+            with open(file_path, 'rb') as file:
+                offset = 0
+                while offset < total_size:
+                    chunk = file.read(chunk_size)
+                    end = offset + len(chunk) - 1
+                    # The upload URL carries its own token, so no Authorization header is sent
+                    headers = {
+                        "Authorization": None,
+                        "Content-Type": "application/octet-stream",
+                        "Content-Length": str(len(chunk)),
+                        "Content-Range": f"bytes {offset}-{end}/{total_size}"
+                    }
+                    with REQUEST_SLOTS:
+                        response = self.session.put(upload_url, data=chunk, headers=headers)
+                    response.raise_for_status()
+                    offset = end + 1
+        except Exception as e:
+            logger.error(f"Error uploading file: {e}")
+            raise
@@ -1,19 +1,581 @@
 import logging
 import os
 import json
-from typing import Dict, Any, Tuple, Optional, List
+from typing import Dict, Any, Tuple, Optional, List, Union, Mapping
 from datetime import datetime, timedelta
 import openai
-import time
+import random
 import re
-from config.settings import INVOICE_TEMPLATE_PATH
-from config.settings import USE_DEFAULT_CUSTOMER_ONLY
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+from xml.sax.saxutils import escape
+from config.settings import INVOICE_TEMPLATE_PATH, COMPANY_CVR_MAP_PATH, DEFAULT_CUSTOMER_CONFIG_PATH
+from config.settings import USE_DEFAULT_CUSTOMER_ONLY, OPENAI_MAX_CONCURRENCY, OPENAI_BATCH_POLL_INTERVAL, OPENAI_BATCH_MAX_REQUESTS, LLM_CACHE_ENABLED
+from config.settings import OPENAI_TIMEOUT, OPENAI_MAX_RETRIES, OPENAI_PRIMARY_MODEL, OPENAI_FALLBACK_MODEL
 
 import uuid
-from utils.token_tracker import update_token_usage, get_token_usage, get_cost_estimate, reset_counters
+from utils.token_tracker import update_token_usage, get_token_usage, get_cost_estimate, reset_counters, record_cached_response
+from utils.llm_cache import cache_key, get_cached_response, store_response, single_flight
+from utils.file_utils import write_text_atomic
 
 logger = logging.getLogger(__name__)
 
+try:
+    import tiktoken
+except ImportError:  # optional, chunk sizing falls back to a chars / 4 estimate
+    tiktoken = None
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:  # optional, company lookups fall back to one substring test per key
+    ahocorasick = None
+
+# Caps concurrent OpenAI requests across all invoices being processed
+LLM_SLOTS = threading.BoundedSemaphore(max(1, OPENAI_MAX_CONCURRENCY))
+
+# Rate limits and timeouts are waited out instead of dropping the extraction
+_RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+_LLM_RETRY_ATTEMPTS = 5
+_LLM_RETRY_MAX_WAIT = 30  # seconds
+
+
+def _request_key(request: Dict[str, Any]) -> str:
+    """Stable key identifying a chat completion request by its full body"""
+    return json.dumps(request, sort_keys=True, ensure_ascii=False)
+
+@lru_cache(maxsize=1)
+def _get_openai_client() -> "openai.OpenAI":
+    """One OpenAI client per process, so every extraction reuses its connection pool"""
+    return openai.OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        timeout=OPENAI_TIMEOUT,
+        max_retries=OPENAI_MAX_RETRIES
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_token_encoding():
+    """Tokenizer used by gpt-4o, or None when tiktoken is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"Could not load tiktoken encoding, estimating tokens from length: {e}")
+        return None
+
+
+def _count_tokens(text: str) -> float:
+    encoding = _get_token_encoding()
+    if encoding is None:
+        # Rough estimate of tokens (chars / 4)
+        return len(text) / 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+@lru_cache(maxsize=4)
+def _load_template_cached(path: str, mtime: float) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Fallback mappings used when the configuration file is missing or unreadable, read-only
+_DEFAULT_COMPANY_CVR_MAP: Mapping[str, str] = MappingProxyType({
+    "lego": "47458714",
+    "lego system": "47458714",
+    "universal robots": "29138060", 
+    "danfoss": "20165715",
+    "novo nordisk": "24256790",
+    "carlsberg": "25508343",
+    "carlsberg breweries": "25508343"
+})
+_DEFAULT_COMPANY_GLN_MAP: Mapping[str, str] = MappingProxyType({
+    "lego": "5790000123456",
+    "lego system": "5790000123456",
+    "universal robots": "5790000234567",
+    "danfoss": "5790000345678", 
+    "novo nordisk": "5790000456789",
+    "carlsberg": "5790000567890",
+    "carlsberg breweries": "5790000567890"
+})
+
+
+def _loads_json(data: Union[str, bytes]) -> Any:
+    """json.loads, through orjson when it is installed; both raise json.JSONDecodeError"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class _CompanyMatcher:
+    """Finds the value of the most specific company key contained in a name"""
+    
+    def __init__(self, company_map: Mapping[str, str]):
+        # (lowercased key, value) pairs with the longest, most specific keys first
+        self.matches = tuple(sorted(((key.lower(), value) for key, value in company_map.items() if key),
+                                    key=lambda item: len(item[0]), reverse=True))
+        self.automaton = None
+        if ahocorasick is not None and self.matches:
+            # One pass over the name finds every key; the rank keeps the most specific one
+            ranked = {}
+            for rank, (key, value) in enumerate(self.matches):
+                ranked.setdefault(key, (rank, value))
+            self.automaton = ahocorasick.Automaton()
+            for key, match in ranked.items():
+                self.automaton.add_word(key, match)
+            self.automaton.make_automaton()
+    
+    def find(self, normalized_name: str) -> Optional[str]:
+        if self.automaton is not None:
+            found = [match for _, match in self.automaton.iter(normalized_name)]
+            return min(found)[1] if found else None
+        for key, value in self.matches:
+            if key in normalized_name:
+                return value
+        return None
+
+_DEFAULT_CVR_MATCHER = _CompanyMatcher(_DEFAULT_COMPANY_CVR_MAP)
+_DEFAULT_GLN_MATCHER = _CompanyMatcher(_DEFAULT_COMPANY_GLN_MAP)
+
+
+@lru_cache(maxsize=4)
+def _load_company_cvr_map_cached(path: str, mtime: float) -> _CompanyMatcher:
+    with open(path, 'rb') as f:
+        company_cvr_map = _loads_json(f.read()).get("company_cvr_map", {})
+    logger.info(f"Loaded {len(company_cvr_map)} company mappings from configuration")
+    return _CompanyMatcher(company_cvr_map)
+
+
+@lru_cache(maxsize=4)
+def _load_default_customer_cached(path: str, mtime: float) -> Optional[Dict[str, str]]:
+    with open(path, 'rb') as f:
+        config = _loads_json(f.read())
+    logger.info(f"Loaded default customer configuration from {path}")
+    return config.get("default_customer")
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _loads_llm_json(content: str) -> Any:
+    """Parse the JSON object of a JSON-mode LLM response, ignoring any trailing text"""
+    content = content.strip()
+    
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass  # text after the JSON value, let raw_decode find where it ends
+    
+    data, _ = _JSON_DECODER.raw_decode(content)
+    return data
+
+def _is_llm_json(content: str) -> bool:
+    """Whether _loads_llm_json can read the response"""
+    try:
+        _loads_llm_json(content)
+    except ValueError:
+        return False
+    return True
+
+# Patterns used on every line of every invoice, compiled once
+_PARA_RE = re.compile(r'\n\s*\n')
+_HAS_DIGIT_RE = re.compile(r'\d')
+_SAFE_FNAME_RE = re.compile(r'[^\w\-]')
+# JSON repair: string delimiters and the raw line breaks that break strings inside them
+_UNESCAPED_QUOTE_RE = re.compile(r'(?<!\\)"')
+_RAW_NEWLINE_RE = re.compile(r'[\r\n]')
+# Exact header labels of the vertical invoice layout and their position keys
+_HEADER_LABELS = {
+    "Faktura": "faktura",
+    "Fakturadato": "fakturadato",
+    "Fakturakonto": "fakturakonto",
+    "Nummer": "nummer",
+}
+# Digits with optional '-' and '.' separators, at least one digit
+_INVOICE_NUMBER_RE = re.compile(r'^(?=.*\d)[\d.\-]+$')
+# Characters stripped when cleaning CVR and VAT numbers
+_NON_DIGIT_RE = re.compile(r'\D')
+_NON_ALNUM_RE = re.compile(r'[\W_]')
+# A Danish VAT number once cleaned: 8 digits, with or without the DK prefix
+_DANISH_VAT_RE = re.compile(r'(?:DK)?(\d{8})', re.IGNORECASE)
+# Order reference numbers, e.g. "SAGS. NR.: 4028204" and "KUNDE NR. 12345"
+_SAGS_NR_RE = re.compile(r'SAGS\.\s*NR.*?[:\.\s]+(\d+)')
+_KUNDE_NR_RE = re.compile(r'KUNDE\s*NR.*?[:\.\s]+(\d+)')
+
+# XML declaration and Invoice root element with namespaces, the same for every invoice
+_OIOXML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2" '
+    'xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" '
+    'xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2" '
+    'xmlns:ccts="urn:un:unece:uncefact:documentation:2" '
+    'xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2" '
+    'xmlns:qdt="urn:oasis:names:specification:ubl:schema:xsd:QualifiedDatatypes-2" '
+    'xmlns:udt="urn:un:unece:uncefact:data:specification:UnqualifiedDataTypesSchemaModule:2" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2 UBL-Invoice-2.0.xsd">',
+)
+
+# OIOUBL payment means codes accepted as extracted, and the FIK payment IDs (card types)
+_VALID_PAYMENT_MEANS_CODES = frozenset({"1", "10", "20", "31", "42", "48", "49", "50", "93", "97"})
+_FIK_PAYMENT_IDS = frozenset({"71", "73", "75"})
+
+# The amount in a fee text, without currency codes, "kr" or spaces around it
+_AMOUNT_RE = re.compile(r'-?\d[\d.,]*')
+
+def _parse_money(value: Any, name: str) -> float:
+    """Amount of an extracted fee such as "125,50 kr", 0 when missing or unreadable"""
+    if not value:
+        return 0
+    try:
+        if isinstance(value, str):
+            match = _AMOUNT_RE.search(value)
+            value = match.group().replace(',', '.') if match else value
+        return float(value)
+    except (ValueError, TypeError):
+        logger.warning(f"Could not convert {name} to float: {value}")
+        return 0
+
+# Fixed document information elements, filled in with format_map; an optional Note goes between the two
+_OIOXML_DOCUMENT_INFO = """\
+  <cbc:UBLVersionID>2.0</cbc:UBLVersionID>
+  <cbc:CustomizationID>OIOUBL-2.02</cbc:CustomizationID>
+  <cbc:ProfileID schemeAgencyID="{schema_agency_id}" schemeID="{schema_id}">{profile_id}</cbc:ProfileID>
+  <cbc:ID>{invoice_number}</cbc:ID>
+  <cbc:CopyIndicator>false</cbc:CopyIndicator>
+  <cbc:UUID>{uuid}</cbc:UUID>
+  <cbc:IssueDate>{invoice_date}</cbc:IssueDate>
+  <cbc:InvoiceTypeCode listAgencyID="320" listID="urn:oioubl:codelist:invoicetypecode-1.1">{invoice_type_code}</cbc:InvoiceTypeCode>"""
+_OIOXML_DOCUMENT_PERIOD = """\
+  <cbc:DocumentCurrencyCode>{currency}</cbc:DocumentCurrencyCode>
+  <cbc:LineCountNumeric>{line_count}</cbc:LineCountNumeric>
+  <cac:InvoicePeriod>
+    <cbc:StartDate>{invoice_date}</cbc:StartDate>
+  </cac:InvoicePeriod>"""
+
+# Supplier party elements, written for both the Accounting and the Seller Supplier Party
+_OIOXML_PARTY_GLN = """\
+      <cac:PartyIdentification>
+        <cbc:ID schemeAgencyID="9" schemeID="GLN">{gln}</cbc:ID>
+      </cac:PartyIdentification>
+"""
+_OIOXML_SUPPLIER_DETAILS = """\
+{gln_identification}      <cac:PartyName>
+        <cbc:Name>{name}</cbc:Name>
+      </cac:PartyName>
+      <cac:PostalAddress>
+        <cbc:AddressFormatCode listAgencyID="320" listID="urn:oioubl:codelist:addressformatcode-1.1">StructuredDK</cbc:AddressFormatCode>
+        <cbc:StreetName>{street}</cbc:StreetName>
+        <cbc:BuildingNumber>.</cbc:BuildingNumber>
+        <cbc:CityName>{city}</cbc:CityName>
+        <cbc:PostalZone>{postal}</cbc:PostalZone>
+        <cac:Country>
+          <cbc:IdentificationCode>{country}</cbc:IdentificationCode>
+        </cac:Country>
+      </cac:PostalAddress>
+      <cac:PartyTaxScheme>
+        <cbc:CompanyID schemeID="DK:SE">{vat}</cbc:CompanyID>
+        <cac:TaxScheme>
+          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>
+          <cbc:Name>Moms</cbc:Name>
+        </cac:TaxScheme>
+      </cac:PartyTaxScheme>"""
+_OIOXML_SUPPLIER_LEGAL_ENTITY = """\
+      <cac:PartyLegalEntity>
+        <cbc:RegistrationName>{name}</cbc:RegistrationName>
+        <cbc:CompanyID schemeID="DK:CVR">{company_id}</cbc:CompanyID>
+      </cac:PartyLegalEntity>
+      <cac:Contact>
+        <cbc:ID>n/a</cbc:ID>
+        <cbc:Name>{contact}</cbc:Name>
+      </cac:Contact>"""
+
+# Payment terms, document level charges (fees) and the tax total, all taxed at the standard rate
+_OIOXML_PAYMENT_TERMS = """\
+  <cac:PaymentTerms>
+    <cbc:ID>1</cbc:ID>
+    <cbc:PaymentMeansID>1</cbc:PaymentMeansID>
+    <cbc:SettlementDiscountPercent>0.00</cbc:SettlementDiscountPercent>
+    <cbc:Amount currencyID="{currency}">{amount}</cbc:Amount>
+    <cac:SettlementPeriod>
+      <cbc:EndDate>{due_date}</cbc:EndDate>
+    </cac:SettlementPeriod>
+  </cac:PaymentTerms>"""
+_OIOXML_ALLOWANCE_CHARGE = """\
+  <cac:AllowanceCharge>
+    <cbc:ChargeIndicator>true</cbc:ChargeIndicator>
+    <cbc:AllowanceChargeReasonCode>{reason_code}</cbc:AllowanceChargeReasonCode>
+    <cbc:AllowanceChargeReason>{reason}</cbc:AllowanceChargeReason>
+    <cbc:Amount currencyID="{currency}">{amount}</cbc:Amount>
+    <cac:TaxCategory>
+      <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>
+          <cbc:Percent>25.00</cbc:Percent>
+      <cac:TaxScheme>
+        <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>
+        <cbc:Name>Moms</cbc:Name>
+      </cac:TaxScheme>
+    </cac:TaxCategory>
+  </cac:AllowanceCharge>"""
+_OIOXML_TAX_TOTAL = """\
+  <cac:TaxTotal>
+    <cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>
+    <cac:TaxSubtotal>
+      <cbc:TaxableAmount currencyID="{currency}">{taxable_amount}</cbc:TaxableAmount>
+      <cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>
+      <cac:TaxCategory>
+        <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>
+          <cbc:Percent>25.00</cbc:Percent>
+        <cac:TaxScheme>
+          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>
+          <cbc:Name>Moms</cbc:Name>
+        </cac:TaxScheme>
+      </cac:TaxCategory>
+    </cac:TaxSubtotal>
+  </cac:TaxTotal>"""
+
+# Invoice line elements around the LineExtensionAmount, which is kept separate so it can be adjusted
+_OIOXML_LINE_START = """\
+  <cac:InvoiceLine>
+    <cbc:ID>{idx}</cbc:ID>
+    <cbc:InvoicedQuantity unitCode="{unit}">{quantity}</cbc:InvoicedQuantity>"""
+_OIOXML_LINE_BODY = """\
+    <cac:OrderLineReference>
+      <cbc:LineID>{idx}</cbc:LineID>
+      <cac:OrderReference>
+        <cbc:ID>{order_id}</cbc:ID>
+        <cbc:SalesOrderID schemeID="VN">{sales_order_id}</cbc:SalesOrderID>
+        <cbc:IssueDate>{order_date}</cbc:IssueDate>{customer_reference}
+      </cac:OrderReference>
+    </cac:OrderLineReference>
+    <cac:PricingReference>
+      <cac:AlternativeConditionPrice>
+        <cbc:PriceAmount currencyID="{currency}">{original_price}</cbc:PriceAmount>
+        <cbc:PriceTypeCode listID="UN/ECE 5387">AAB</cbc:PriceTypeCode>
+      </cac:AlternativeConditionPrice>
+    </cac:PricingReference>
+    <cac:TaxTotal>
+      <cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>
+      <cac:TaxSubtotal>
+        <cbc:TaxableAmount currencyID="{currency}">{line_amount}</cbc:TaxableAmount>
+        <cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>
+        <cac:TaxCategory>
+          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>
+          <cbc:Percent>25.00</cbc:Percent>
+          <cac:TaxScheme>
+            <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>
+            <cbc:Name>Moms</cbc:Name>
+          </cac:TaxScheme>
+        </cac:TaxCategory>
+      </cac:TaxSubtotal>
+    </cac:TaxTotal>
+    <cac:Item>
+      <cbc:Description>{description}</cbc:Description>
+      <cbc:Name>{description}</cbc:Name>{item_identification}
+    </cac:Item>
+    <cac:Price>
+      <cbc:PriceAmount currencyID="{currency}">{discounted_price}</cbc:PriceAmount>
+      <cbc:BaseQuantity unitCode="{unit}">1</cbc:BaseQuantity>
+      <cbc:OrderableUnitFactorRate>1</cbc:OrderableUnitFactorRate>
+    </cac:Price>
+  </cac:InvoiceLine>"""
+_OIOXML_ITEM_IDENTIFICATION = """
+      <cac:{element}>
+        <cbc:ID schemeID="{scheme}">{value}</cbc:ID>
+      </cac:{element}>"""
+
+# Common Danish units mapped to valid UN/ECE codes
+_UNIT_CODES = {
+    "stk": "EA",      # stykker -> Each
+    "stk.": "EA",     # stykker -> Each
+    "szet": "SET",    # sæt -> Set
+    "sæt": "SET",     # sæt -> Set
+    "pk": "PK",       # pakke -> Package
+    "pk.": "PK",      # pakke -> Package
+    "m": "MTR",       # meter -> Metre
+    "kg": "KGM",      # kilogram -> Kilogram
+    "l": "LTR",       # liter -> Litre
+    "timer": "HUR",   # timer -> Hour
+    "time": "HUR",    # time -> Hour
+    "dag": "DAY",     # dag -> Day
+    "dage": "DAY",    # dage -> Day
+    "kasse": "CS",    # kasse -> Case
+    "rulle": "RO",    # rulle -> Roll
+    "flaske": "BO",   # flaske -> Bottle
+    "palle": "PF",    # palle -> Pallet
+    "boks": "BX",     # boks -> Box
+}
+# Codes accepted in any case
+_KNOWN_UNIT_CODES = frozenset({"EA", "SET", "PK", "KGM", "MTR", "LTR", "HUR", "DAY"})
+
+# OIOXML metadata that is the same for every invoice
+_OIOXML_METADATA: Mapping[str, Any] = MappingProxyType({
+    "invoice_type_code": 380,  # Standard invoice
+    "profile_id": "urn:www.nesubl.eu:profiles:profile5:ver2.0",
+    "schema_agency_id": 320,
+    "schema_id": "urn:oioubl:id:profileid-1.2",
+})
+
+# Spaces and dashes written between the registration and account numbers
+_BANK_ACCOUNT_SEPARATORS = str.maketrans('', '', ' -')
+
+def _fik_payment_means(data: Dict[str, Any]) -> List[str]:
+    """PaymentMeans details for a FIK (indbetalingskort) payment"""
+    parts = []
+
+    # InstructionID (optional, but usually present for FIK)
+    if "instruction_id" in data:
+        parts.append(f'    <cbc:InstructionID>{data["instruction_id"]}</cbc:InstructionID>')
+
+    # PaymentID (mandatory for FIK)
+    payment_id = data.get("payment_id", "71")
+    if payment_id not in _FIK_PAYMENT_IDS:
+        logger.warning(f"Invalid payment_id: {payment_id}, defaulting to 71")
+        payment_id = "71"
+    parts.append(f'    <cbc:PaymentID schemeAgencyID="320" schemeID="urn:oioubl:id:paymentid-1.1">{payment_id}</cbc:PaymentID>')
+
+    # CreditAccount (aggregate element, comes last)
+    account_id = str(data.get("account_id", "")).strip()
+    if len(account_id) != 8:
+        logger.warning(f"FIK account_id must be 8 chars, got {len(account_id)}: {account_id}")
+        account_id = account_id[:8].zfill(8)  # Truncate to 8, pad left with zeros
+
+    parts.append('    <cac:CreditAccount>')
+    parts.append(f'      <cbc:AccountID>{account_id}</cbc:AccountID>')
+    parts.append('    </cac:CreditAccount>')
+    return parts
+
+def _bank_payment_means(data: Dict[str, Any]) -> List[str]:
+    """PaymentMeans details for a bank transfer to the supplier's account"""
+    parts = []
+
+    # PayeeFinancialAccount (aggregate element)
+    parts.append('    <cac:PayeeFinancialAccount>')
+
+    # Extract account details
+    account_number = ""
+    reg_number = ""
+
+    # Use the extracted values from LLM
+    if "reg_number" in data and data["reg_number"]:
+        reg_number = str(data["reg_number"]).strip()
+
+    if "account_number" in data and data["account_number"]:
+        account_number = str(data["account_number"]).strip()
+    elif "bank_account" in data and data["bank_account"]:
+        # Fallback: if we have combined bank_account
+        bank_account = str(data["bank_account"])
+        bank_account_clean = bank_account.translate(_BANK_ACCOUNT_SEPARATORS)
+
+        if len(bank_account_clean) > 10 and not account_number:
+            if not reg_number:
+                reg_number = bank_account_clean[:4]
+            account_number = bank_account_clean[-10:]
+        else:
+            account_number = bank_account_clean
+
+    # Validate
+    if not reg_number:
+        reg_number = "0000"
+    if not account_number:
+        account_number = "0000000000"
+
+    reg_number = reg_number.zfill(4)
+
+    parts.append(f'      <cbc:ID>{account_number}</cbc:ID>')
+    parts.append(f'      <cbc:Name>{escape(str(data.get("supplier_name", "")))}</cbc:Name>')
+
+    # FinancialInstitutionBranch
+    parts.append('      <cac:FinancialInstitutionBranch>')
+    parts.append(f'        <cbc:ID>{reg_number}</cbc:ID>')
+
+    # Add BIC if available
+    if "bic" in data and data["bic"]:
+        parts.append('        <cac:FinancialInstitution>')
+        parts.append(f'          <cbc:ID schemeID="BIC">{data["bic"]}</cbc:ID>')
+        parts.append('        </cac:FinancialInstitution>')
+
+    parts.append('      </cac:FinancialInstitutionBranch>')
+    parts.append('    </cac:PayeeFinancialAccount>')
+    return parts
+
+# PaymentMeans details by payment method type; other types only get the common elements
+_PAYMENT_MEANS_DETAILS = {
+    "FIK": _fik_payment_means,
+    "BANK_TRANSFER": _bank_payment_means,
+}
+# Payment method type implied by the payment means code, FIK codes take precedence over the extracted type
+_PAYMENT_METHOD_BY_CODE = {"93": "FIK", "42": "BANK_TRANSFER"}
+# PaymentChannelCode element for the FIK and bank transfer payment means codes
+_PAYMENT_CHANNEL_CODES = {
+    "93": '    <cbc:PaymentChannelCode listAgencyID="320" listID="urn:oioubl:codelist:paymentchannelcode-1.1">DK:FIK</cbc:PaymentChannelCode>',
+    "42": '    <cbc:PaymentChannelCode listAgencyID="320" listID="urn:oioubl:codelist:paymentchannelcode-1.1">DK:BANK</cbc:PaymentChannelCode>',
+}
+
+# Extracted customer fields and the default customer config keys they fall back to
+_CUSTOMER_FIELDS = (
+    ("customer_vat", "vat"),
+    ("customer_name", "name"),
+    ("customer_street", "street"),
+    ("customer_city", "city"),
+    ("customer_postal_code", "postal_code"),
+    ("customer_country", "country"),
+    ("customer_contact", "contact_name"),
+    ("customer_phone", "contact_phone"),
+)
+
+def _invoice_date(data: Dict[str, Any]) -> str:
+    """The extracted invoice date, today only when there is none (no clock read otherwise)"""
+    if "invoice_date" in data:
+        return data["invoice_date"]
+    return datetime.now().strftime("%Y-%m-%d")
+
+# Decimal comma to decimal point, for amounts written the Danish way
+_COMMA_TO_DOT = str.maketrans(',', '.')
+
+def _to_float(value: Any, default: Optional[float]) -> Optional[float]:
+    """A number that may be written with a decimal comma, default when missing or unreadable"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not value:
+        return default
+    try:
+        return float(str(value).translate(_COMMA_TO_DOT))
+    except ValueError:
+        return default
+
+def _discount_percent(item: Dict[str, Any]) -> float:
+    """Percentage discount of a line such as "12,5%", 0 when there is none; raises when it can't be read"""
+    discount = item.get("discount", 0)
+    if not discount:
+        return 0.0
+    if isinstance(discount, str):
+        return float(discount.translate(_COMMA_TO_DOT).replace('%', '').strip())
+    return float(discount)
+
+def _line_amount(item: Dict[str, Any]) -> Optional[float]:
+    """quantity * unit_price less any percentage discount, None if the line can't be priced"""
+    try:
+        # Same quantity parsing as the OIOXML lines, but an unreadable quantity leaves the line unpriced
+        quantity = _to_float(item.get("quantity", 0), None)
+        if quantity is None:
+            return None
+        line_amount = quantity * float(item.get("unit_price", 0))
+        
+        # Apply discount if present
+        discount = _discount_percent(item)
+        if discount:
+            line_amount = line_amount * (1 - discount/100)
+        return line_amount
+    except Exception:
+        return None
+
 class InvoiceService:
     """Service for generating invoice files"""
     
@@ -24,30 +586,36 @@ class InvoiceService:
         self.api_key = os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             logger.warning("OPENAI_API_KEY not found in environment variables")
-        else:
-            openai.api_key = self.api_key
             
         # Define constants for chunking
         self.CHUNK_SIZE = 3000  # approximate tokens
         self.CHUNK_OVERLAP = 500  # overlap between chunks to maintain context
 
-        # Initialize token tracking
+        # Cheap model first, the fallback only when its result is unusable
+        self.primary_model = OPENAI_PRIMARY_MODEL
+        self.fallback_model = OPENAI_FALLBACK_MODEL
+
+        # Responses fetched through the Batch API, keyed by request (see _chat_completion),
+        # and the (prompt, completion) tokens each one cost
+        self._prefetched_responses = {}
+        self._prefetched_usage = {}
+
+        # Initialize token tracking; chunks are extracted in parallel, so updates are locked
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
         self.total_tokens = 0
+        self._token_lock = threading.Lock()
 
     def format_amount(self, amount):
         try:
-            # Convert to float and round to 2 decimal places
-            amount_float = float(amount)
-            amount_rounded = round(amount_float, 2)
-            
-            # Format with 2 decimal places
-            return f"{amount_rounded:.2f}"
-        except:
+            # Format with 2 decimal places; the format rounds like round(amount, 2) would
+            return f"{float(amount):.2f}"
+        except (ValueError, TypeError, OverflowError):
             return "0.00"    
     
     def generate_invoice(self, markdown_content: str) -> Tuple[Optional[str], Optional[Dict[str, Any]], Dict[str, int]]:
+        # Token usage is reported for this invoice only, the instance may already have generated others
+        usage_before = self.get_token_usage_summary()
         try:
             if not markdown_content:
                 logger.error("No markdown content provided")
@@ -89,23 +657,18 @@ class InvoiceService:
             # Create a unique filename based on timestamp
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
             invoice_number = invoice_data.get("invoice_number", "unknown")
-            safe_invoice_number = re.sub(r'[^\w\-]', '_', invoice_number)
+            safe_invoice_number = _SAFE_FNAME_RE.sub('_', invoice_number)
                 
             invoice_file_path = os.path.join(output_dir, f"invoice_{safe_invoice_number}_{timestamp}.xml")
                 
-            with open(invoice_file_path, 'w', encoding='utf-8') as f:
-                f.write(xml_content)
+            write_text_atomic(invoice_file_path, xml_content)
                     
             logger.info(f"Invoice generated and saved to: {invoice_file_path}")
                 
             logger.info(f"Current token usage after invoice generation: {self.get_token_usage_summary()}")
 
             # Return token usage along with invoice data
-            token_usage = {
-                "prompt_tokens": getattr(self, "total_prompt_tokens", 0),
-                "completion_tokens": getattr(self, "total_completion_tokens", 0),
-                "total_tokens": getattr(self, "total_tokens", 0)
-            }
+            token_usage = {key: value - usage_before[key] for key, value in self.get_token_usage_summary().items()}
                 
             return invoice_file_path, invoice_data, token_usage
                 
@@ -115,41 +678,172 @@ class InvoiceService:
             token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
             return None, None, token_usage
     
+    def generate_invoice_batch(self, markdown_contents: List[str], max_concurrency: int = 10) -> List[Tuple[Optional[str], Optional[Dict[str, Any]], Dict[str, int]]]:
+        """
+        Generate invoices for several documents with their OpenAI calls in flight concurrently
+        
+        Returns:
+            List of (invoice_file_path, invoice_data, token_usage) in input order
+        """
+        if not markdown_contents:
+            return []
+        
+        logger.info(f"Generating {len(markdown_contents)} invoices with up to {max_concurrency} in parallel")
+        
+        # Extraction keeps per-document state on the service, so each document
+        # is generated by its own instance
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(markdown_contents)))) as executor:
+            return list(executor.map(
+                lambda markdown_content: type(self)().generate_invoice(markdown_content),
+                markdown_contents
+            ))
+    
+    def generate_invoices_with_batch_api(self, markdown_contents: List[str], poll_interval: int = OPENAI_BATCH_POLL_INTERVAL, max_requests_per_batch: int = OPENAI_BATCH_MAX_REQUESTS) -> List[Tuple[Optional[str], Optional[Dict[str, Any]], Dict[str, int]]]:
+        """
+        Generate invoices with every LLM request submitted through OpenAI Batch API jobs
+        
+        Batch requests are billed at half price but can take up to 24 hours, so this is
+        meant for bulk offline runs. Requests are split into jobs of at most
+        max_requests_per_batch; requests from a failed job are sent live instead, and if
+        no job completes this falls back to generate_invoice_batch.
+        
+        Returns:
+            List of (invoice_file_path, invoice_data, token_usage) in input order
+        """
+        if not markdown_contents:
+            return []
+        
+        # Build the same requests generate_invoice would send for each document
+        batch_lines = []
+        document_requests = []
+        for doc_index, markdown_content in enumerate(markdown_contents):
+            chunks = self._split_content_into_chunks(markdown_content) if markdown_content else []
+            full_content = "\n".join(chunks)
+            requests = [self._invoice_extras_request(full_content)]
+            requests.extend(self._extraction_request(self._create_extraction_prompt(chunk)) for chunk in chunks)
+            document_requests.append(requests)
+            
+            for request_index, request in enumerate(requests):
+                batch_lines.append({
+                    "custom_id": f"{doc_index}:{request_index}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": request
+                })
+        
+        try:
+            client = _get_openai_client()
+            # Submit every job before waiting, so OpenAI works on them side by side
+            batches = [
+                self._submit_batch(client, batch_lines[start:start + max_requests_per_batch])
+                for start in range(0, len(batch_lines), max(1, max_requests_per_batch))
+            ]
+            logger.info(f"Submitted {len(batches)} batch job(s) with {len(batch_lines)} requests for {len(markdown_contents)} invoices")
+            outputs = [self._wait_for_batch(client, batch, poll_interval) for batch in batches]
+        except Exception as e:
+            logger.error(f"Batch API run failed, generating invoices directly: {e}")
+            return self.generate_invoice_batch(markdown_contents)
+        
+        outputs = [output for output in outputs if output is not None]
+        if not outputs:
+            logger.error("No batch job completed, generating invoices directly")
+            return self.generate_invoice_batch(markdown_contents)
+        output = "\n".join(outputs)
+        
+        # Bucket the responses by document; failed requests are simply retried live later
+        responses = [{} for _ in markdown_contents]
+        usages = [{} for _ in markdown_contents]
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = _loads_json(line)
+            doc_index, request_index = (int(part) for part in result["custom_id"].split(":"))
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.warning(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+                continue
+            
+            body = response["body"]
+            update_token_usage(body["usage"]["prompt_tokens"], body["usage"]["completion_tokens"])
+            request = document_requests[doc_index][request_index]
+            responses[doc_index][_request_key(request)] = body["choices"][0]["message"]["content"]
+            usages[doc_index][_request_key(request)] = (body["usage"]["prompt_tokens"], body["usage"]["completion_tokens"])
+        
+        # Run the regular pipeline per document; its LLM calls are served from the batch output
+        results = []
+        for markdown_content, prefetched, prefetched_usage in zip(markdown_contents, responses, usages):
+            invoice_service = type(self)()
+            invoice_service._prefetched_responses = prefetched
+            invoice_service._prefetched_usage = prefetched_usage
+            results.append(invoice_service.generate_invoice(markdown_content))
+        
+        return results
+    
+    def _submit_batch(self, client, batch_lines: List[Dict[str, Any]]):
+        """Upload one JSONL request file and create a batch job for it"""
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as batch_file:
+            for line in batch_lines:
+                batch_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        
+        try:
+            with open(batch_file.name, "rb") as f:
+                input_file = client.files.create(file=f, purpose="batch")
+        finally:
+            os.remove(batch_file.name)
+        
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted batch {batch.id} with {len(batch_lines)} requests")
+        return batch
+    
+    def _wait_for_batch(self, client, batch, poll_interval: int) -> Optional[str]:
+        """Poll a batch job until it finishes and return its output, or None if it did not complete"""
+        # Poll quickly at first and back off to poll_interval, small jobs often finish in minutes
+        delay = min(5, poll_interval)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(delay)
+            delay = min(delay * 2, poll_interval)
+            batch = client.batches.retrieve(batch.id)
+            logger.info(f"Batch {batch.id} status: {batch.status}")
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            logger.warning(f"Batch {batch.id} ended with status {batch.status}, its requests will be sent live")
+            return None
+        
+        return client.files.content(batch.output_file_id).text
+    
     def _split_content_into_chunks(self, content: str) -> List[str]:
-        # Split by paragraphs
-        paragraphs = re.split(r'\n\s*\n', content)
+        # Paragraphs as (start, end, tokens), so chunks are sliced straight out of
+        # the content and every paragraph is tokenized exactly once
+        paragraphs = []
+        position = 0
+        for separator in _PARA_RE.finditer(content):
+            paragraphs.append((position, separator.start(), _count_tokens(content[position:separator.start()])))
+            position = separator.end()
+        paragraphs.append((position, len(content), _count_tokens(content[position:])))
         
         chunks = []
-        current_chunk = []
+        chunk_start = 0
         current_length = 0
         
-        for paragraph in paragraphs:
-            # Rough estimate of tokens (chars / 4)
-            paragraph_length = len(paragraph) / 4
-            
-            if current_length + paragraph_length > self.CHUNK_SIZE and current_chunk:
+        for i, (start, end, paragraph_length) in enumerate(paragraphs):
+            if current_length + paragraph_length > self.CHUNK_SIZE and i > chunk_start:
                 # Add the current chunk to our list and start a new one
-                chunks.append('\n\n'.join(current_chunk))
-                
-                # Start a new chunk with some overlap (keep last few paragraphs)
-                overlap_size = 0
-                overlap_paragraphs = []
-                
-                for p in reversed(current_chunk):
-                    overlap_size += len(p) / 4
-                    overlap_paragraphs.insert(0, p)
-                    if overlap_size > self.CHUNK_OVERLAP:
-                        break
+                chunks.append(content[paragraphs[chunk_start][0]:paragraphs[i - 1][1]])
                 
-                current_chunk = overlap_paragraphs
-                current_length = overlap_size
+                # Start a new chunk with some overlap: keep the fewest trailing
+                # paragraphs that still exceed the overlap size
+                while current_length - paragraphs[chunk_start][2] > self.CHUNK_OVERLAP:
+                    current_length -= paragraphs[chunk_start][2]
+                    chunk_start += 1
             
-            current_chunk.append(paragraph)
             current_length += paragraph_length
         
-        # Add the last chunk if it's not empty
-        if current_chunk:
-            chunks.append('\n\n'.join(current_chunk))
+        # Add the last chunk
+        chunks.append(content[paragraphs[chunk_start][0]:paragraphs[-1][1]])
         
         return chunks
 
@@ -160,97 +854,87 @@ class InvoiceService:
         # Join all chunks for analysis
         full_content = "\n".join(chunks)
         self.current_content = full_content  # Store for possible use later
-        lines = full_content.split('\n')
+        # Every pass below works on stripped lines, so strip each line once
+        lines = [line.strip() for line in full_content.splitlines()]
         
-        # ADD DEBUGGING
-        logger.info("=== DEBUGGING INVOICE NUMBER EXTRACTION ===")
-        logger.info(f"Total lines: {len(lines)}")
+        logger.debug("Total lines: %d", len(lines))
         
-        # Print first 20 lines to see the structure
-        for i, line in enumerate(lines[:20]):
-            logger.info(f"Line {i}: '{line.strip()}'")
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if debug_enabled:
+            # Print first 20 lines to see the structure
+            for i, line in enumerate(lines[:20]):
+                logger.debug("Line %d: '%s'", i, line)
         
-        # FIRST: Check for invoice number in the header format "Faktura XXXXX"
+        # Single pass over the lines: record the positions of the vertical layout labels
+        # and check for the invoice number in the header format "Faktura XXXXX"
+        label_positions = {}
         try:
-            for i, line in enumerate(lines):
-                line_stripped = line.strip()
-                logger.debug(f"Checking line {i}: '{line_stripped}'")
+            for i, line_stripped in enumerate(lines):
+                if debug_enabled:
+                    logger.debug("Checking line %d: '%s'", i, line_stripped)
                 
-                # Check multiple patterns
-                if "Faktura" in line_stripped:
-                    logger.info(f"Found 'Faktura' in line {i}: '{line_stripped}'")
+                label = _HEADER_LABELS.get(line_stripped)
+                if label is not None:
+                    label_positions[label] = i
+                
+                # Check multiple patterns until the first invoice number is found
+                if "invoice_number" not in all_data and "Faktura" in line_stripped:
+                    logger.debug("Found 'Faktura' in line %d: '%s'", i, line_stripped)
                     
                     # Pattern 1: "Faktura 112262" on same line
                     if line_stripped.startswith("Faktura") and len(line_stripped.split()) > 1:
                         parts = line_stripped.split()
                         potential_invoice_num = parts[1]
-                        logger.info(f"Pattern 1 - Found potential invoice: {potential_invoice_num}")
-                        if potential_invoice_num.replace('-', '').replace('.', '').isdigit():
+                        logger.debug("Pattern 1 - Found potential invoice: %s", potential_invoice_num)
+                        if _INVOICE_NUMBER_RE.match(potential_invoice_num):
                             all_data["invoice_number"] = potential_invoice_num
-                            logger.info(f"Set invoice number: {potential_invoice_num}")
-                            break
+                            logger.debug("Set invoice number: %s", potential_invoice_num)
                     
                     # Pattern 2: "Faktura" on one line, number within next few lines (skipping empty)
-                    if line_stripped == "Faktura":
+                    if label == "faktura":
                         # Check next 5 lines for a number
                         for j in range(1, 6):
                             if i + j < len(lines):
-                                next_line = lines[i + j].strip()
-                                logger.info(f"Checking line {i + j} after 'Faktura': '{next_line}'")
+                                next_line = lines[i + j]
+                                logger.debug("Checking line %d after 'Faktura': '%s'", i + j, next_line)
                                 # Check if it's a number (could be invoice number)
-                                if next_line and next_line.replace('-', '').replace('.', '').isdigit():
+                                if next_line and _INVOICE_NUMBER_RE.match(next_line):
                                     all_data["invoice_number"] = next_line
-                                    logger.info(f"Set invoice number from line {i + j}: {next_line}")
+                                    logger.debug("Set invoice number from line %d: %s", i + j, next_line)
                                     break
-                        if "invoice_number" in all_data:
-                            break
                 
         except Exception as e:
-            logger.error(f"Error in header extraction: {e}")
+            logger.error("Error in header extraction: %s", e)
         
-        logger.info(f"Invoice number after header extraction: {all_data.get('invoice_number', 'NOT FOUND')}")
+        logger.debug("Invoice number after header extraction: %s", all_data.get('invoice_number', 'NOT FOUND'))
 
         try:
-            # Find positions of key labels
-            label_positions = {}
-            for i, line in enumerate(lines):
-                line = line.strip()
-                if line == "Faktura":
-                    label_positions["faktura"] = i
-                elif line == "Fakturadato":
-                    label_positions["fakturadato"] = i
-                elif line == "Fakturakonto":
-                    label_positions["fakturakonto"] = i
-                elif line == "Nummer":
-                    label_positions["nummer"] = i
-            
-            logger.info(f"Found label positions: {label_positions}")
+            logger.debug("Found label positions: %s", label_positions)
             
             # If we found labels, look for values
             if label_positions:
                 # Find the first value line (a line with digits after labels)
                 first_value_line = -1
                 for i in range(max(label_positions.values()) + 1, len(lines)):
-                    if re.search(r'\d', lines[i].strip()):
+                    if _HAS_DIGIT_RE.search(lines[i]):
                         first_value_line = i
                         break
                 
                 if first_value_line > 0:
-                    logger.info(f"First value line: {first_value_line}")
+                    logger.debug("First value line: %d", first_value_line)
                     
                     # The values are in vertical order matching the order of labels
-                    # Find the order of labels by position
-                    ordered_labels = sorted(label_positions.items(), key=lambda x: x[1])
-                    logger.info(f"Ordered labels: {ordered_labels}")
+                    if debug_enabled:
+                        logger.debug("Ordered labels: %s", sorted(label_positions.items(), key=lambda x: x[1]))
                     
                     # Map values directly by position
                     # The date is always the first value
                     # The invoice number is always the third value
                     if len(lines) > first_value_line + 2:
-                        date_value = lines[first_value_line].strip()
-                        account_value = lines[first_value_line + 1].strip()
+                        date_value = lines[first_value_line]
+                        account_value = lines[first_value_line + 1]
                         
-                        logger.info(f"Extracted values: date={date_value}, account={account_value}")
+                        logger.debug("Extracted values: date=%s, account=%s", date_value, account_value)
                         
                         # Set values directly
                         all_data["invoice_date"] = date_value
@@ -258,65 +942,71 @@ class InvoiceService:
                         
                         # IMPORTANT: Only set invoice number if not already found
                         if "invoice_number" not in all_data:
-                            invoice_value = lines[first_value_line + 2].strip()
+                            invoice_value = lines[first_value_line + 2]
                             all_data["invoice_number"] = invoice_value
-                            logger.info(f"Assigned invoice_number from vertical layout: {invoice_value}")
+                            logger.debug("Assigned invoice_number from vertical layout: %s", invoice_value)
                         else:
-                            logger.info(f"Keeping existing invoice_number: {all_data.get('invoice_number')}")
+                            logger.debug("Keeping existing invoice_number: %s", all_data.get('invoice_number'))
                     
         except Exception as e:
-            logger.error(f"Error in direct extraction: {e}")
-
-        # Extract environmental fee and additional charges using LLM
-        try:
-            additional_charges = self._extract_additional_charges_with_llm(full_content)
-            if additional_charges:
-                all_data.update(additional_charges)
-                logger.info(f"Found additional charges: {additional_charges}")
-        except Exception as e:
-            logger.error(f"Failed to extract additional charges: {e}")
-
-        try:
-            payment_details = self._extract_payment_details_with_llm(full_content)
-            if payment_details:
-                # Merge payment details including the calculated due date
-                all_data.update(payment_details)
-                logger.info(f"Updated data with payment details (including due date): {payment_details}")
-        except Exception as e:
-            logger.error(f"Failed to extract payment details: {e}")
-        
-        # Continue with OpenAI extraction for other fields
-        for i, chunk in enumerate(chunks):
+            logger.error("Error in direct extraction: %s", e)
+
+        # The LLM extractions are independent network calls, so run them concurrently
+        # and merge the results in their original order once they are all back.
+        # No more threads than LLM_SLOTS could ever let through at once.
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chunks) + 1, OPENAI_MAX_CONCURRENCY))) as executor:
+            extras_future = executor.submit(self._extract_invoice_extras_with_llm, full_content)
+            chunk_futures = [
+                executor.submit(self._extract_data_with_openai, self._create_extraction_prompt(chunk))
+                for chunk in chunks
+            ]
+            
+            # Environmental fee, additional charges and payment details come from one LLM call
             try:
-                logger.info(f"Processing chunk {i+1}/{len(chunks)}")
-                prompt = self._create_extraction_prompt(chunk)
-                chunk_data = self._extract_data_with_openai(prompt)
+                additional_charges, payment_details = extras_future.result()
+                if additional_charges:
+                    all_data.update(additional_charges)
+                    logger.debug("Found additional charges: %s", additional_charges)
+                if payment_details:
+                    # Merge payment details including the calculated due date
+                    all_data.update(payment_details)
+                    logger.debug("Updated data with payment details (including due date): %s", payment_details)
+            except Exception as e:
+                logger.error("Failed to extract additional charges and payment details: %s", e)
+            
+            # Continue with OpenAI extraction for other fields
+            chunk_results = []
+            for i, chunk_future in enumerate(chunk_futures):
+                try:
+                    chunk_data = chunk_future.result()
+                except Exception as e:
+                    logger.error("Error processing chunk %d: %s", i + 1, e)
+                    continue
                 
                 if not chunk_data:
-                    logger.warning(f"Failed to extract data from chunk {i+1}")
+                    logger.warning("Failed to extract data from chunk %d", i + 1)
                     continue
                 
-                # Preserve our directly extracted invoice number
-                if "invoice_number" in all_data and "invoice_number" in chunk_data:
-                    logger.info(f"Direct extraction: {all_data['invoice_number']}, OpenAI extraction: {chunk_data['invoice_number']}")
-                    del chunk_data["invoice_number"]
-                
-                # Handle line items
-                if "line_items" in chunk_data:
-
-                    # Additional logging for line items to debug
-                    logger.info(f"EXTRACTION: Found {len(chunk_data['line_items'])} line items in chunk {i+1}")
-                    for idx, item in enumerate(chunk_data['line_items']):
-                        logger.info(f"EXTRACTION: Line {idx+1} from chunk {i+1}: {item}")
-
-                    line_items.extend(chunk_data.pop("line_items", []))
-                
-                # Merge data
-                all_data.update(chunk_data)
-                time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Error processing chunk {i+1}: {e}")
+                chunk_results.append((i, chunk_data))
+        
+        # Merge the chunks in order once they are all back: later chunks override
+        # earlier fields, line items are appended in chunk order
+        merged = {}
+        for i, chunk_data in chunk_results:
+            # Preserve the first invoice number found, directly extracted or from an earlier chunk
+            if "invoice_number" in chunk_data and ("invoice_number" in all_data or "invoice_number" in merged):
+                logger.debug("Keeping invoice number %s, ignoring %s from chunk %d", all_data.get("invoice_number", merged.get("invoice_number")), chunk_data["invoice_number"], i + 1)
+                del chunk_data["invoice_number"]
+            
+            # Handle line items (a null list from the model counts as none)
+            chunk_items = chunk_data.pop("line_items", None) or []
+            if debug_enabled:
+                logger.debug("EXTRACTION: chunk %d line items: %s", i + 1, chunk_items)
+            line_items.extend(chunk_items)
+            
+            merged.update(chunk_data)
+        
+        all_data.update(merged)
         
         # Add line items
         if line_items:
@@ -326,22 +1016,34 @@ class InvoiceService:
             return None
         
         # Final logging
-        logger.info(f"=== FINAL EXTRACTED DATA ===")
-        logger.info(f"Invoice number: {all_data.get('invoice_number', 'NOT FOUND')}")
-        logger.info(f"Invoice date: {all_data.get('invoice_date', 'NOT FOUND')}")
-        logger.info(f"Billing account: {all_data.get('billing_account', 'NOT FOUND')}")
+        logger.info(
+            "Extracted invoice data: number=%s, date=%s, billing account=%s, %d line items",
+            all_data.get('invoice_number', 'NOT FOUND'),
+            all_data.get('invoice_date', 'NOT FOUND'),
+            all_data.get('billing_account', 'NOT FOUND'),
+            len(line_items)
+        )
         
         return all_data
 
 
-    def _extract_payment_details_with_llm(self, content: str) -> Dict[str, Any]:
-        """
-        Extract payment details from invoice text, handling both FIK and bank transfer payments
-        """
-        try:
-            # Create an enhanced prompt that handles multiple payment types
-            prompt = f"""
-                Extract payment method information from this Danish invoice text.
+    def _models(self) -> List[str]:
+        """Models to try in order for an extraction"""
+        if not self.fallback_model or self.fallback_model == self.primary_model:
+            return [self.primary_model]
+        return [self.primary_model, self.fallback_model]
+
+    def _invoice_extras_request(self, content: str, model: Optional[str] = None) -> Dict[str, Any]:
+        """Build the chat completion request for payment details and additional charges extraction"""
+        # One prompt for both, so the full invoice text is only sent once
+        prompt = f"""
+                Extract payment method information and any additional charges or fees from this Danish invoice text.
+                
+                Return ONE JSON object with exactly two keys:
+                - "payment": the payment details described in PART 1
+                - "charges": the additional charges described in PART 2
+                
+                PART 1 - PAYMENT DETAILS
                 
                 CRITICAL: Correctly identify the payment type:
                 
@@ -368,7 +1070,7 @@ class InvoiceService:
                 - If no FIK pattern but bank details exist, use code 42
                 - Double-check: FIK account_id MUST be exactly 8 digits
                 
-                Return JSON with:
+                "payment" fields:
                 - payment_method_type: "FIK", "BANK_TRANSFER", or "UNSPECIFIED"
                 - payment_means_code: 93 (FIK), 42 (bank), or 30 (unspecified)
                 
@@ -388,128 +1090,11 @@ class InvoiceService:
                 - payment_terms: Payment terms text
                 - payment_due_date: Due date in YYYY-MM-DD
                 
-                RETURN ONLY JSON.
-
-                Text:
-                {content}
-            """
-            
-            # Call OpenAI API
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert in Danish invoice payment processing. Identify payment types and extract exact payment details. Return ONLY valid JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.0,
-                max_tokens=500
-            )
-
-            update_token_usage(
-                response.usage.prompt_tokens,
-                response.usage.completion_tokens
-            )
-            
-            # Get and clean the response
-            content = response.choices[0].message.content.strip()
-            
-            # Debug logging
-            logger.debug(f"Raw payment details response: {content}")
-            
-            # Clean up the response (remove markdown, extract JSON)
-            if content.startswith("```json"):
-                content = content.replace("```json", "", 1).strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "", 1).strip()
-                
-            # Find the end of JSON object
-            if content.startswith('{'):
-                brace_count = 0
-                json_end = -1
-                
-                for i, char in enumerate(content):
-                    if char == '{':
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            json_end = i + 1
-                            break
-                
-                if json_end > 0:
-                    content = content[:json_end]
-            
-            if content.endswith("```"):
-                content = content[:-3].strip()
-            
-            # Parse the JSON response
-            try:
-                payment_details = json.loads(content)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse payment details JSON: {e}")
-                logger.error(f"Content: {content}")
-                # Return default payment details
-                return {
-                    "payment_method_type": "UNSPECIFIED",
-                    "payment_means_code": "30",
-                    "payment_due_date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
-                }
-            
-            # Validate based on payment type
-            payment_type = payment_details.get("payment_method_type", "").upper()
-            
-            if payment_type == "FIK":
-                # Validate FIK payment details
-                if payment_details.get("payment_id") in ["71", "73", "75"]:
-                    instruction_id = str(payment_details.get("instruction_id", "")).replace(" ", "")
-                    if len(instruction_id) == 15:
-                        payment_details["instruction_id"] = instruction_id
-                    else:
-                        logger.warning(f"Invalid instruction_id length: {len(instruction_id)}")
-                        
-                    account_id = str(payment_details.get("account_id", "")).replace(" ", "")
-                    if len(account_id) == 8:
-                        payment_details["account_id"] = account_id
-                    else:
-                        logger.warning(f"Invalid account_id length: {len(account_id)}")
-                        
-                    payment_details["payment_means_code"] = "93"
-                    
-            elif payment_type == "BANK_TRANSFER":
-                # Ensure bank transfer has correct code
-                payment_details["payment_means_code"] = "42"
-                
-                # Clean up IBAN if present
-                if "iban" in payment_details:
-                    iban = payment_details["iban"].replace(" ", "").upper()
-                    payment_details["iban"] = iban
-                    
-            else:
-                # Default to credit transfer if unspecified
-                payment_details["payment_means_code"] = payment_details.get("payment_means_code", "30")
-            
-            logger.info(f"Extracted payment details: {payment_details}")
-            
-            return payment_details
-            
-        except Exception as e:
-            logger.error(f"Error extracting payment details with LLM: {e}", exc_info=True)
-            # Fallback to default payment method
-            return {
-                "payment_method_type": "UNSPECIFIED",
-                "payment_means_code": "30",
-                "payment_due_date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
-            }
-
-    def _extract_additional_charges_with_llm(self, content: str) -> Dict[str, Any]:
-        """Extract environmental fees and other additional charges using LLM"""
-        try:
-            prompt = f"""
-                Extract any additional charges or fees from this Danish invoice text.
+                PART 2 - ADDITIONAL CHARGES
                 
                 CRITICAL: Look for any environmental fees, shipping charges, or other additional costs that are NOT regular line items.
                 
-                Return a JSON object with these fields:
+                "charges" fields:
 
                 - environmental_fee: Environmental fee amount (look for "Miljøafgift", "Miljøgebyr", "Environmental fee")
                 - environmental_fee_description: The exact text describing the environmental fee
@@ -534,62 +1119,112 @@ class InvoiceService:
                 - "Fragt/transport 479,79"
                 - Any charge that's not a regular product line item
                 
+                RETURN ONLY JSON.
+
                 Text:
                 {content}
             """
+        
+        return {
+            "model": model or self.primary_model,
+            "messages": [
+                {"role": "system", "content": "You are an expert in Danish invoice processing. Identify payment types and extract exact payment details, and accurately identify and extract all additional charges and fees. Return ONLY valid JSON."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.0,
+            "max_tokens": 1000,
+            "response_format": {"type": "json_object"}
+        }
+
+    def _default_payment_details(self) -> Dict[str, Any]:
+        return {
+            "payment_method_type": "UNSPECIFIED",
+            "payment_means_code": "30",
+            "payment_due_date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
+        }
+
+    def _validate_payment_details(self, payment_details: Dict[str, Any]) -> Dict[str, Any]:
+        """Normalize the extracted payment details based on the payment type"""
+        payment_type = str(payment_details.get("payment_method_type") or "").upper()
+        
+        if payment_type == "FIK":
+            # Validate FIK payment details
+            if payment_details.get("payment_id") in _FIK_PAYMENT_IDS:
+                instruction_id = str(payment_details.get("instruction_id", "")).replace(" ", "")
+                if len(instruction_id) == 15:
+                    payment_details["instruction_id"] = instruction_id
+                else:
+                    logger.warning(f"Invalid instruction_id length: {len(instruction_id)}")
+                    
+                account_id = str(payment_details.get("account_id", "")).replace(" ", "")
+                if len(account_id) == 8:
+                    payment_details["account_id"] = account_id
+                else:
+                    logger.warning(f"Invalid account_id length: {len(account_id)}")
+                    
+                payment_details["payment_means_code"] = "93"
+                
+        elif payment_type == "BANK_TRANSFER":
+            # Ensure bank transfer has correct code
+            payment_details["payment_means_code"] = "42"
             
-            # Call OpenAI API
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert in Danish invoice processing. You must accurately identify and extract all additional charges and fees."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.0,
-                max_tokens=500
-            )
-
-            update_token_usage(
-                response.usage.prompt_tokens,
-                response.usage.completion_tokens
-            )
-            
-            # Get the response content
-            content = response.choices[0].message.content.strip()
-            
-            # Debug logging
-            logger.debug(f"Raw response from LLM: {content}")
-            
-            # If content is empty, return empty dict
-            if not content:
-                logger.warning("Empty response from LLM for additional charges")
-                return {}
-            
-            # Clean up the response if it contains markdown formatting
-            if content.startswith("```json"):
-                content = content.replace("```json", "", 1).strip()
-            elif content.startswith("```"):
-                content = content.replace("```", "", 1).strip()
+            # Clean up IBAN if present
+            if payment_details.get("iban"):
+                iban = payment_details["iban"].replace(" ", "").upper()
+                payment_details["iban"] = iban
+                
+        else:
+            # Default to credit transfer if unspecified
+            payment_details["payment_means_code"] = payment_details.get("payment_means_code", "30")
+        
+        return payment_details
+
+    def _extract_invoice_extras_with_llm(self, content: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Extract additional charges and payment details (FIK or bank transfer) in one LLM call
+        
+        Returns:
+            Tuple of (additional_charges, payment_details)
+        """
+        try:
+            extras = None
+            for model in self._models():
+                # Call OpenAI API
+                response = self._chat_completion(self._invoice_extras_request(content, model))
+                
+                # Debug logging
+                logger.debug(f"Raw payment details and charges response from {model}: {response}")
                 
-            if content.endswith("```"):
-                content = content[:-3].strip()
+                try:
+                    extras = _loads_llm_json(response)
+                except json.JSONDecodeError as e:
+                    logger.error(f"Failed to parse payment details and charges JSON from {model}: {e}")
+                    logger.error(f"Content: {response}")
+                    extras = None
+                    continue
+                
+                # A result without a payment type is treated as low confidence
+                if isinstance(extras, dict) and (extras.get("payment") or {}).get("payment_method_type"):
+                    logger.info(f"Payment details and charges extracted with {model}")
+                    break
+                logger.warning(f"{model} returned no payment method type")
             
-            # Try to parse the JSON response
-            try:
-                charges_data = json.loads(content)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse JSON response: {e}")
-                logger.error(f"Response content: {content}")
-                # Return empty dict if parsing fails
-                return {}
+            if not isinstance(extras, dict):
+                # Return default payment details
+                return {}, self._default_payment_details()
+            
+            charges_data = extras.get("charges") or {}
+            payment_details = self._validate_payment_details(extras.get("payment") or {})
             
             logger.info(f"Extracted additional charges: {charges_data}")
+            logger.info(f"Extracted payment details: {payment_details}")
             
-            return charges_data
+            return charges_data, payment_details
             
         except Exception as e:
-            logger.error(f"Error extracting additional charges with LLM: {e}", exc_info=True)
-            return {}
+            logger.error(f"Error extracting payment details and charges with LLM: {e}", exc_info=True)
+            # Fallback to default payment method
+            return {}, self._default_payment_details()
 
     def _create_extraction_prompt(self, chunk: str) -> str:
         return f"""
@@ -670,166 +1305,183 @@ class InvoiceService:
             {chunk}
         """
     
+    def _count_tokens(self, prompt_tokens: int, completion_tokens: int):
+        with self._token_lock:
+            self.total_prompt_tokens += prompt_tokens
+            self.total_completion_tokens += completion_tokens
+            self.total_tokens += prompt_tokens + completion_tokens
+
     def get_token_usage_summary(self) -> Dict[str, int]:
-        return {
-            "prompt_tokens": getattr(self, "total_prompt_tokens", 0),
-            "completion_tokens": getattr(self, "total_completion_tokens", 0),
-            "total_tokens": getattr(self, "total_tokens", 0)
-        }
+        with self._token_lock:
+            return {
+                "prompt_tokens": self.total_prompt_tokens,
+                "completion_tokens": self.total_completion_tokens,
+                "total_tokens": self.total_tokens
+            }
 
     def lookup_cvr_with_company_mapping(self, company_name: str) -> Optional[str]:
-        import json
-        import os
-        
         # Path to the configuration file
-        config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "company_cvr_map.json")
+        config_path = COMPANY_CVR_MAP_PATH
         
-        # Load the mapping from the configuration file
+        # Load the mapping from the configuration file (parsed once per file version)
         try:
             if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    company_cvr_map = config.get("company_cvr_map", {})
-                    logger.info(f"Loaded {len(company_cvr_map)} company mappings from configuration")
+                cvr_matcher = _load_company_cvr_map_cached(config_path, os.path.getmtime(config_path))
             else:
                 # Fallback to default mapping if config file doesn't exist
                 logger.warning(f"Configuration file not found: {config_path}, using default mapping")
-                company_cvr_map = {
-                    "lego": "47458714",
-                    "lego system": "47458714",
-                    "universal robots": "29138060", 
-                    "danfoss": "20165715",
-                    "novo nordisk": "24256790",
-                    "carlsberg": "25508343",
-                    "carlsberg breweries": "25508343"
-                }
-
-                # Add a new mapping for GLN numbers
-                gln_map = {
-                    "lego": "5790000123456",
-                    "lego system": "5790000123456",
-                    "universal robots": "5790000234567",
-                    "danfoss": "5790000345678", 
-                    "novo nordisk": "5790000456789",
-                    "carlsberg": "5790000567890",
-                    "carlsberg breweries": "5790000567890"
-                }
                 
                 # Check for GLN
-                normalized_name = company_name.lower()
-                for key, gln in gln_map.items():
-                    if key in normalized_name:
-                        return gln
+                gln = _DEFAULT_GLN_MATCHER.find(company_name.lower())
+                if gln is not None:
+                    return gln
+                cvr_matcher = _DEFAULT_CVR_MATCHER
         except Exception as e:
             logger.error(f"Error loading company mapping configuration: {e}")
             # Fallback to default mapping on error
-            company_cvr_map = {
-                "lego": "47458714",
-                "lego system": "47458714",
-                "universal robots": "29138060", 
-                "danfoss": "20165715",
-                "novo nordisk": "24256790",
-                "carlsberg": "25508343",
-                "carlsberg breweries": "25508343"
-            }
+            cvr_matcher = _DEFAULT_CVR_MATCHER
         
         # Normalize the company name (lowercase and remove special chars)
         normalized_name = company_name.lower()
         
-        # Check if any key in our mapping is a substring of the normalized name
-        for key, cvr in company_cvr_map.items():
-            if key in normalized_name:
-                logger.info(f"Found CVR {cvr} for {company_name} in mapping")
-                return cvr
+        # Find the most specific key in our mapping that is a substring of the normalized name
+        cvr = cvr_matcher.find(normalized_name)
+        if cvr is not None:
+            logger.info(f"Found CVR {cvr} for {company_name} in mapping")
+            return cvr
         
         # If we get here, no match was found
         logger.warning(f"No CVR number found in mapping for: {company_name}")
         return None
     
     def enrich_with_cvr_numbers(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        # Look up supplier CVR if needed
-        if 'supplier_name' in data and ('supplier_vat' not in data or not data['supplier_vat']):
-            supplier_name = data['supplier_name']
-            logger.info(f"Looking up CVR number for supplier: {supplier_name}")
-            
-            # Try the lookup using company mapping
-            supplier_cvr = self.lookup_cvr_with_company_mapping(supplier_name)
-            
-            if supplier_cvr:
-                data['supplier_vat'] = supplier_cvr
-                logger.info(f"Found CVR number for supplier: {supplier_cvr}")
-        
-        # Look up customer CVR if needed
-        if 'customer_name' in data and ('customer_vat' not in data or not data['customer_vat']):
-            customer_name = data['customer_name']
-            logger.info(f"Looking up CVR number for customer: {customer_name}")
+        # Look up the supplier and customer CVR numbers if needed
+        for party in ("supplier", "customer"):
+            name = data.get(f"{party}_name")
+            if not name or data.get(f"{party}_vat"):
+                continue
+            logger.info(f"Looking up CVR number for {party}: {name}")
             
             # Try the lookup using company mapping
-            customer_cvr = self.lookup_cvr_with_company_mapping(customer_name)
+            cvr = self.lookup_cvr_with_company_mapping(name)
             
-            if customer_cvr:
-                data['customer_vat'] = customer_cvr
-                logger.info(f"Found CVR number for customer: {customer_cvr}")
+            if cvr:
+                data[f"{party}_vat"] = cvr
+                logger.info(f"Found CVR number for {party}: {cvr}")
         
         return data   
 
+    def _extraction_request(self, prompt: str, model: Optional[str] = None) -> Dict[str, Any]:
+        """Build the chat completion request for a chunk extraction prompt"""
+        return {
+            "model": model or self.primary_model,
+            "messages": [
+                {"role": "system", "content": "You are an expert in extracting structured data from invoice text. Always return valid JSON."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.1,  # Low temperature for deterministic output
+            "max_tokens": 1000,
+            "response_format": {"type": "json_object"}
+        }
+
+    def _chat_completion(self, request: Dict[str, Any], bypass_cache: bool = False) -> str:
+        """Run a chat completion request and return the message content.
+        
+        Responses already fetched through the Batch API or cached on disk are used
+        instead of a live call; cache hits cost no tokens.
+        """
+        request_key = _request_key(request)
+        prefetched = self._prefetched_responses.pop(request_key, None)
+        if prefetched is not None:
+            # Already counted globally when the batch output was read
+            self._count_tokens(*self._prefetched_usage.pop(request_key, (0, 0)))
+            return prefetched
+        
+        if not LLM_CACHE_ENABLED or bypass_cache:
+            return self._live_chat_completion(request)
+        
+        key = cache_key(request)
+        # Identical prompts in flight at the same time wait for the first one's response
+        with single_flight(key):
+            cached = get_cached_response(key)
+            if cached is not None:
+                logger.info("Using cached LLM response")
+                record_cached_response()
+                return cached
+            
+            content = self._live_chat_completion(request)
+            # Only responses the extraction can read are cached, a malformed one is asked again next time
+            if content and _is_llm_json(content):
+                store_response(key, content)
+        
+        return content
+
+    def _live_chat_completion(self, request: Dict[str, Any]) -> str:
+        response = self._create_chat_completion(request)
+
+        # Track token usage globally and for this document
+        update_token_usage(
+            response.usage.prompt_tokens,
+            response.usage.completion_tokens
+        )
+        self._count_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+        
+        return response.choices[0].message.content
+
+    def _create_chat_completion(self, request: Dict[str, Any]):
+        """Call the API, retrying rate limits and timeouts with jittered exponential backoff"""
+        for attempt in range(1, _LLM_RETRY_ATTEMPTS + 1):
+            try:
+                with LLM_SLOTS:
+                    return _get_openai_client().chat.completions.create(**request)
+            except _RETRYABLE_OPENAI_ERRORS as e:
+                if attempt == _LLM_RETRY_ATTEMPTS:
+                    raise
+                # Sleep outside the slot so other requests can use it meanwhile
+                delay = max(1, random.uniform(0, min(_LLM_RETRY_MAX_WAIT, 2 ** attempt)))
+                logger.warning(f"OpenAI request failed ({e.__class__.__name__}), retrying in {delay:.1f}s (attempt {attempt}/{_LLM_RETRY_ATTEMPTS})")
+                time.sleep(delay)
+
     def _extract_data_with_openai(self, prompt: str) -> Optional[Dict[str, Any]]:
         try:
             if not self.api_key:
                 logger.error("Cannot call OpenAI API: No API key provided")
                 return None
             
-            # Use GPT-3.5-turbo for higher rate limits and extraction only task
-            response = openai.chat.completions.create(
-                # model="gpt-3.5-turbo",  # Use 3.5 for higher limits
-                model = "gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert in extracting structured data from invoice text. Always return valid JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1,  # Low temperature for deterministic output
-                max_tokens=1000
-            )
-
-            # Track token usage globally
-            update_token_usage(
-                response.usage.prompt_tokens,
-                response.usage.completion_tokens
-            )
-            
-            # Extract and parse the JSON response
-            content = response.choices[0].message.content.strip()
-            
-            # Handle case where model might add code blocks
-            if content.startswith("```json"):
-                content = content.replace("```json", "", 1)
-            elif content.startswith("```"):
-                content = content.replace("```", "", 1)
+            for model in self._models():
+                # Extract and parse the JSON response
+                content = self._chat_completion(self._extraction_request(prompt, model)).strip()
                 
-            if content.endswith("```"):
-                content = content[:-3]
+                try:
+                    # First try to parse as is
+                    extracted_data = _loads_llm_json(content)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Initial JSON parsing failed for {model}: {e}")
+                    extracted_data = None
+                    continue
                 
-            content = content.strip()
+                # An empty object means the model found nothing usable in the chunk
+                if isinstance(extracted_data, dict) and extracted_data:
+                    logger.info(f"Chunk data extracted with {model}")
+                    return extracted_data
+                logger.warning(f"{model} returned no data for the chunk")
+            
+            # JSON mode output that parsed has nothing to repair
+            if extracted_data is not None:
+                return extracted_data
             
-            # Attempt to fix common JSON issues
+            # Attempt to fix common JSON issues in the last response
+            # 1. Look for unterminated strings
+            fixed_content = self._attempt_json_repair(content)
+            
+            # Try parsing the fixed content
             try:
-                # First try to parse as is
-                extracted_data = json.loads(content)
-            except json.JSONDecodeError as e:
-                logger.warning(f"Initial JSON parsing failed: {e}")
-                
-                # Try to fix common issues with JSON
-                # 1. Look for unterminated strings
-                fixed_content = self._attempt_json_repair(content)
-                
-                # Try parsing the fixed content
-                try:
-                    extracted_data = json.loads(fixed_content)
-                    logger.info("Successfully repaired and parsed JSON")
-                except json.JSONDecodeError as e2:
-                    logger.error(f"Could not repair JSON: {e2}")
-                    # As a last resort, try a more lenient JSON parser or fall back to a default
-                    return self._fallback_extraction()
+                extracted_data = _loads_json(fixed_content)
+                logger.info("Successfully repaired and parsed JSON")
+            except json.JSONDecodeError as e2:
+                logger.error(f"Could not repair JSON: {e2}")
+                # As a last resort, try a more lenient JSON parser or fall back to a default
+                return self._fallback_extraction()
             
             return extracted_data
             
@@ -841,27 +1493,14 @@ class InvoiceService:
         # Replace escaped quotes that might be causing issues
         content = content.replace('\\"', '"')
         
-        # Check for unescaped quotes in strings
-        in_string = False
-        fixed_content = ""
-        i = 0
-        
-        while i < len(content):
-            char = content[i]
-            
-            if char == '"' and (i == 0 or content[i-1] != '\\'):
-                in_string = not in_string
-            
-            # If we're in a string and find a newline, replace it
-            if in_string and char in ['\n', '\r']:
-                fixed_content += '\\n'  # Properly escape the newline
-            else:
-                fixed_content += char
-                
-            i += 1
+        # Split on unescaped quotes: odd parts are string contents, where raw newlines get escaped
+        parts = _UNESCAPED_QUOTE_RE.split(content)
+        for i in range(1, len(parts), 2):
+            parts[i] = _RAW_NEWLINE_RE.sub(r'\\n', parts[i])
+        fixed_content = '"'.join(parts)
         
         # If we ended while still in a string, add closing quote
-        if in_string:
+        if len(parts) % 2 == 0:
             fixed_content += '"'
         
         # Try to balance braces and brackets
@@ -887,8 +1526,8 @@ class InvoiceService:
     
     def _load_invoice_template(self) -> str:
         try:
-            with open(INVOICE_TEMPLATE_PATH, 'r', encoding='utf-8') as f:
-                return f.read()
+            # Keyed on the modification time so an edited template is picked up
+            return _load_template_cached(INVOICE_TEMPLATE_PATH, os.path.getmtime(INVOICE_TEMPLATE_PATH))
         except Exception as e:
             logger.error(f"Error loading invoice template: {e}")
             return ""
@@ -898,17 +1537,19 @@ class InvoiceService:
         Prepare invoice data with proper calculations for environmental fees
         FIXED: Ensure FIK payment data is properly formatted
         """
+        # One clock reading for every generated default, so they agree with each other
+        now = datetime.now()
 
         # 1. Generate unique identifiers if missing
         if "invoice_number" not in data or not data["invoice_number"]:
-            data["invoice_number"] = f"INV-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            data["invoice_number"] = f"INV-{now.strftime('%Y%m%d%H%M%S')}"
             
         if "uuid" not in data:
             data["uuid"] = str(uuid.uuid4())
             
         # 2. Set dates if missing
         if "invoice_date" not in data:
-            data["invoice_date"] = datetime.now().strftime("%Y-%m-%d")
+            data["invoice_date"] = now.strftime("%Y-%m-%d")
             
         # Use the payment due date extracted by LLM if available
         if "payment_due_date" not in data:
@@ -919,7 +1560,7 @@ class InvoiceService:
                 data["payment_due_date"] = due_date.strftime("%Y-%m-%d")
             except Exception as e:
                 logger.error(f"Error calculating due date: {e}")
-                data["payment_due_date"] = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
+                data["payment_due_date"] = (now + timedelta(days=30)).strftime("%Y-%m-%d")
                 
         # 3. Set currency if missing
         if "currency" not in data:
@@ -966,11 +1607,9 @@ class InvoiceService:
         else:
             # Validate and map the payment means code
             current_code = str(data["payment_means_code"])
-            valid_codes = ["1", "10", "20", "31", "42", "48", "49", "50", "93", "97"]
-            
-            if current_code not in valid_codes:
+            if current_code not in _VALID_PAYMENT_MEANS_CODES:
                 # Map common invalid codes to valid ones
-                if current_code in ["71", "73", "75"]:  # FIK payment IDs
+                if current_code in _FIK_PAYMENT_IDS:
                     data["payment_means_code"] = "93"  # Use 93 for FIK payments
                 else:
                     # Default based on payment type
@@ -981,82 +1620,33 @@ class InvoiceService:
                         data["payment_means_code"] = "30"  # Default to credit transfer
                 logger.info(f"Mapped invalid payment code {current_code} to {data['payment_means_code']}")
             
-        # 6. Calculate monetary values
+        # 6. Calculate monetary values; the fees are parsed to floats once here
+        environmental_fee = _parse_money(data.get("environmental_fee", 0), "environmental_fee")
+        freight_fee = _parse_money(data.get("shipping_fee", 0), "shipping_fee")
+        data["environmental_fee"] = environmental_fee
+        # Store individual charge amounts for use in XML generation
+        data["freight_fee"] = freight_fee
+        
+        # Calculate total charges; the fees are charged with or without line items
+        total_charges = environmental_fee + freight_fee
+        data["charge_total_amount"] = total_charges
+
         if line_items:
-            line_total = 0
-            line_tax_total = 0
+            tax_percent = float(data.get("tax_percent", 25))
             
-            for item in line_items:
-                try:
-                    qty = float(item.get("quantity", 0))
-                    unit_price = float(item.get("unit_price", 0))
-                    line_amount = qty * unit_price
-                    
-                    # Apply discount if present
-                    discount = item.get("discount", 0)
-                    if discount:
-                        if isinstance(discount, str):
-                            discount = float(discount.replace('%', '').strip())
-                        else:
-                            discount = float(discount)
-                        line_amount = line_amount * (1 - discount/100)
-                    
-                    line_total += line_amount
-                    
-                    # Calculate tax on line
-                    tax_percent = float(data.get("tax_percent", 25))
-                    line_tax = round(line_amount * tax_percent / 100, 2)
-                    line_tax_total += line_tax
-                except:
-                    continue
+            # Price every line once; lines that can't be priced are skipped
+            line_amounts = [amount for amount in map(_line_amount, line_items) if amount is not None]
             
-            # Round calculations properly
-            line_total = round(line_total, 2)
-            line_tax_total = round(line_tax_total, 2)
+            # Round calculations properly, tax is rounded per line
+            line_total = round(sum(line_amounts), 2)
+            line_tax_total = round(sum(round(amount * tax_percent / 100, 2) for amount in line_amounts), 2)
             
             # Set line extension amount (sum of lines only)
             data["line_extension_amount"] = line_total
             
-            environmental_fee_raw = data.get("environmental_fee", 0)
-            environmental_fee = 0
-            
-            try:
-                if environmental_fee_raw:
-                    # Handle string values
-                    if isinstance(environmental_fee_raw, str):
-                        # Remove common currency symbols and spaces
-                        cleaned_value = environmental_fee_raw.replace('DKK', '').replace('kr', '').replace(',', '.').strip()
-                        environmental_fee = float(cleaned_value)
-                    else:
-                        environmental_fee = float(environmental_fee_raw)
-            except (ValueError, TypeError):
-                logger.warning(f"Could not convert environmental_fee to float: {environmental_fee_raw}")
-                environmental_fee = 0
-
-            # ADD THIS SECTION for freight handling
-            freight_fee_raw = data.get("shipping_fee", 0)
-            freight_fee = 0
-
-            try:
-                if freight_fee_raw:
-                    # Handle string values
-                    if isinstance(freight_fee_raw, str):
-                        # Remove common currency symbols and spaces
-                        cleaned_value = freight_fee_raw.replace('DKK', '').replace('kr', '').replace(',', '.').strip()
-                        freight_fee = float(cleaned_value)
-                    else:
-                        freight_fee = float(freight_fee_raw)
-            except (ValueError, TypeError):
-                logger.warning(f"Could not convert shipping_fee to float: {freight_fee_raw}")
-                freight_fee = 0
-
-            # Calculate total charges
-            total_charges = environmental_fee + freight_fee
-            
             tax_on_charges = 0
             if total_charges > 0:
                 tax_on_charges = round(total_charges * tax_percent / 100, 2)
-                data["charge_total_amount"] = total_charges
             
             # CRITICAL: TaxExclusiveAmount in OIOXML = total tax amount
             total_tax = line_tax_total + tax_on_charges
@@ -1068,9 +1658,6 @@ class InvoiceService:
             
             # Store the taxable amount for TaxSubtotal
             data["taxable_amount"] = line_total + total_charges
-
-            # Store individual charge amounts for use in XML generation
-            data["freight_fee"] = freight_fee
             
             # Also set these for consistency
             data["tax_amount"] = total_tax
@@ -1086,10 +1673,7 @@ class InvoiceService:
             data["taxable_amount"] = 0
         
         # 7. Add additional OIOXML metadata
-        data["invoice_type_code"] = 380  # Standard invoice
-        data["profile_id"] = "urn:www.nesubl.eu:profiles:profile5:ver2.0"
-        data["schema_agency_id"] = 320
-        data["schema_id"] = "urn:oioubl:id:profileid-1.2"
+        data.update(_OIOXML_METADATA)
         data["line_count"] = len(line_items)
         
         # 8. Generate missing order references
@@ -1121,8 +1705,9 @@ class InvoiceService:
             # Extract line items for separate processing
             line_items = data.get("line_items", [])
             
-            # Create a copy of data without line items to reduce prompt size
-            base_data = {k: v for k, v in data.items() if k != "line_items"}
+            # Create a copy of data without line items; the caller's dict must stay untouched
+            base_data = data.copy()
+            base_data.pop("line_items", None)
             
             # Enrich base data with defaults and calculated values
             base_data = self._prepare_invoice_data(base_data, line_items)
@@ -1163,47 +1748,43 @@ class InvoiceService:
                 logger.warning(f"LLM-extracted order number too long ({len(order_number_from_llm)} digits), might be incorrect: {order_number_from_llm}")
 
         # If LLM extraction failed or produced invalid results, try direct pattern matching
-        if not valid_order_number:
-            # Look directly for SAGS. NR. in the text
-            if hasattr(self, 'current_content'):
-                content_lines = self.current_content.split('\n')
-                
-                # Log a sample of the content to see what we're working with
-                logger.info(f"Searching for 'SAGS. NR.' in document with {len(content_lines)} lines")
+        if not valid_order_number and hasattr(self, 'current_content'):
+            content_lines = self.current_content.split('\n')
+            
+            # Log a sample of the content to see what we're working with
+            logger.info(f"Searching for 'SAGS. NR.' in document with {len(content_lines)} lines")
+            if logger.isEnabledFor(logging.DEBUG):
                 for i, line in enumerate(content_lines[:20]):  # Log first 20 lines for debugging
                     logger.debug(f"Line {i}: {line.strip()}")
-                    
-                # Search for SAGS. NR.
+            
+            # One pass for both: SAGS. NR. wins, the first KUNDE NR is kept as the alternative
+            kunde_number = ""
+            for line in content_lines:
+                match = _SAGS_NR_RE.search(line)
+                if match:
+                    # Extract just the number after SAGS. NR.
+                    order_number = match.group(1)
+                    logger.info(f"Found SAGS. NR.: {order_number}")
+                    break
+                if not kunde_number:
+                    match = _KUNDE_NR_RE.search(line)
+                    if match:
+                        kunde_number = match.group(1)
+            
+            if not order_number:
+                # If no match found, log the specific lines containing "SAGS"
+                logger.info("No match using regex, looking for lines containing 'SAGS':")
                 for line in content_lines:
-                    if "SAGS. NR" in line:
-                        # Extract just the number after SAGS. NR.
-                        import re
-                        match = re.search(r'SAGS\.\s*NR.*?[:\.\s]+(\d+)', line)
-                        if match:
-                            order_number = match.group(1)
-                            logger.info(f"Found SAGS. NR.: {order_number}")
-                            break
+                    if "SAGS" in line:
+                        logger.info(f"Line with 'SAGS': {line.strip()}")
                 
-                # If no match found, log the specific lines containing "SAGS"
-                if not order_number:
-                    logger.info("No match using regex, looking for lines containing 'SAGS':")
-                    for line in content_lines:
-                        if "SAGS" in line:
-                            logger.info(f"Line with 'SAGS': {line.strip()}")
+                # Check for "KUNDE NR" as alternative
+                if kunde_number:
+                    order_number = kunde_number
+                    logger.info(f"Found KUNDE NR.: {order_number}")
 
         # Check for alternate order number fields
         if not order_number:
-            # Check for "KUNDE NR" as alternative
-            if hasattr(self, 'current_content'):
-                for line in self.current_content.split('\n'):
-                    if "KUNDE NR" in line:
-                        import re
-                        match = re.search(r'KUNDE\s*NR.*?[:\.\s]+(\d+)', line)
-                        if match:
-                            order_number = match.group(1)
-                            logger.info(f"Found KUNDE NR.: {order_number}")
-                            break
-            
             # Try looking for other fields in data
             if not order_number:
                 for field in ["sags_nr", "ordrenr", "order_id"]:
@@ -1225,17 +1806,14 @@ class InvoiceService:
             logger.info("Fixed encoding for Føtex Ølgod")
 
         # Extract order date (if needed)
-        order_date = data.get("order_date", data.get("invoice_date", datetime.now().strftime("%Y-%m-%d")))
+        order_date = data["order_date"] if "order_date" in data else _invoice_date(data)
         
         return customer_ref, order_number, order_date
     
     def load_default_customer_config(self) -> Dict[str, str]:
         """Load default customer configuration from JSON file"""
-        import json
-        import os
-        
         # Path to the configuration file
-        config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "default_customer.json")
+        config_path = DEFAULT_CUSTOMER_CONFIG_PATH
         
         # Default fallback values
         default_config = {
@@ -1251,11 +1829,9 @@ class InvoiceService:
         
         try:
             if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    customer_config = config.get("default_customer", default_config)
-                    logger.info(f"Loaded default customer configuration from {config_path}")
-                    return customer_config
+                # Parsed once per file version; hand out a copy so callers can't alter the cache
+                customer_config = _load_default_customer_cached(config_path, os.path.getmtime(config_path))
+                return dict(customer_config) if customer_config is not None else default_config
             else:
                 logger.warning(f"Configuration file not found: {config_path}, using default values")
                 return default_config
@@ -1270,53 +1846,41 @@ class InvoiceService:
         FIXED: Correct TaxTotal to show document-level tax, not line-level
         """
         try:
-            # Initialize line taxes collector
-            self._line_taxes = []
-
-            # Add storage for line extension amounts
+            # Add storage for line extension amounts and where each one sits in xml_parts
             line_extension_amounts = []
+            line_extension_positions = []
 
-            # Create XML string manually
-            xml_parts = []
+            # Create XML string manually, starting from the XML declaration and the Invoice root element
+            xml_parts = list(_OIOXML_HEADER)
             
-            # XML declaration
-            xml_parts.append('<?xml version="1.0" encoding="UTF-8"?>')
-            
-            # Invoice root element with namespaces
-            xml_parts.append('<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2" ' +
-                            'xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" ' +
-                            'xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2" ' +
-                            'xmlns:ccts="urn:un:unece:uncefact:documentation:2" ' +
-                            'xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2" ' +
-                            'xmlns:qdt="urn:oasis:names:specification:ubl:schema:xsd:QualifiedDatatypes-2" ' +
-                            'xmlns:udt="urn:un:unece:uncefact:data:specification:UnqualifiedDataTypesSchemaModule:2" ' +
-                            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' +
-                            'xsi:schemaLocation="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2 UBL-Invoice-2.0.xsd">')
+            # Values written in several places, looked up and escaped once
+            currency = data.get("currency", "DKK")
+            invoice_date = _invoice_date(data)
+            supplier_name = escape(str(data.get("supplier_name", "Unknown Supplier")))
+            supplier_contact = escape(str(data.get("supplier_contact", data.get("supplier_name", "Contact Person"))))
+            # Amounts written twice, formatted once
+            payable_amount = self.format_amount(data.get("payable_amount", "0"))
             
             # Document information
-            xml_parts.append('  <cbc:UBLVersionID>2.0</cbc:UBLVersionID>')
-            xml_parts.append('  <cbc:CustomizationID>OIOUBL-2.02</cbc:CustomizationID>')
-            xml_parts.append(f'  <cbc:ProfileID schemeAgencyID="{data.get("schema_agency_id", "320")}" ' +
-                            f'schemeID="{data.get("schema_id", "urn:oioubl:id:profileid-1.2")}">' +
-                            f'{data.get("profile_id", "urn:www.nesubl.eu:profiles:profile5:ver2.0")}</cbc:ProfileID>')
-            xml_parts.append(f'  <cbc:ID>{data.get("invoice_number", "UNKNOWN")}</cbc:ID>')
-            xml_parts.append('  <cbc:CopyIndicator>false</cbc:CopyIndicator>')
-            xml_parts.append(f'  <cbc:UUID>{data.get("uuid", str(uuid.uuid4()))}</cbc:UUID>')
-            xml_parts.append(f'  <cbc:IssueDate>{data.get("invoice_date", datetime.now().strftime("%Y-%m-%d"))}</cbc:IssueDate>')
-            xml_parts.append(f'  <cbc:InvoiceTypeCode listAgencyID="320" listID="urn:oioubl:codelist:invoicetypecode-1.1">' +
-                            f'{data.get("invoice_type_code", "380")}</cbc:InvoiceTypeCode>')
+            document_fields = {
+                "schema_agency_id": data.get("schema_agency_id", "320"),
+                "schema_id": data.get("schema_id", "urn:oioubl:id:profileid-1.2"),
+                "profile_id": data.get("profile_id", "urn:www.nesubl.eu:profiles:profile5:ver2.0"),
+                "invoice_number": escape(str(data.get("invoice_number", "UNKNOWN"))),
+                "uuid": data.get("uuid", str(uuid.uuid4())),
+                "invoice_date": invoice_date,
+                "invoice_type_code": data.get("invoice_type_code", "380"),
+                "currency": currency,
+                "line_count": data.get("line_count", len(line_items)),
+            }
+            xml_parts.append(_OIOXML_DOCUMENT_INFO.format_map(document_fields))
             
             # Add note if present
             if "note" in data:
-                xml_parts.append(f'  <cbc:Note>{data.get("note", "")}</cbc:Note>')
-                
-            xml_parts.append(f'  <cbc:DocumentCurrencyCode>{data.get("currency", "DKK")}</cbc:DocumentCurrencyCode>')
-            xml_parts.append(f'  <cbc:LineCountNumeric>{data.get("line_count", len(line_items))}</cbc:LineCountNumeric>')
+                xml_parts.append(f'  <cbc:Note>{escape(str(data.get("note", "")))}</cbc:Note>')
             
-            # Invoice period
-            xml_parts.append('  <cac:InvoicePeriod>')
-            xml_parts.append(f'    <cbc:StartDate>{data.get("invoice_date", datetime.now().strftime("%Y-%m-%d"))}</cbc:StartDate>')
-            xml_parts.append('  </cac:InvoicePeriod>')
+            # Currency, line count and invoice period
+            xml_parts.append(_OIOXML_DOCUMENT_PERIOD.format_map(document_fields))
 
             # Order reference
             customer_ref, order_number, order_date = self.extract_order_reference_data(data)
@@ -1329,14 +1893,14 @@ class InvoiceService:
 
             # Generate OrderReference section
             xml_parts.append('  <cac:OrderReference>')
-            xml_parts.append(f'    <cbc:ID>{customer_ref}</cbc:ID>')
-            xml_parts.append(f'    <cbc:SalesOrderID>{order_number}</cbc:SalesOrderID>')
+            xml_parts.append(f'    <cbc:ID>{escape(str(customer_ref))}</cbc:ID>')
+            xml_parts.append(f'    <cbc:SalesOrderID>{escape(str(order_number))}</cbc:SalesOrderID>')
             xml_parts.append(f'    <cbc:IssueDate>{order_date}</cbc:IssueDate>')
             xml_parts.append('  </cac:OrderReference>')
             
             # Contract document reference (NEW)
             xml_parts.append('  <cac:ContractDocumentReference>')
-            xml_parts.append(f'    <cbc:ID schemeID="CT">{data.get("contract_id", "1")}</cbc:ID>')
+            xml_parts.append(f'    <cbc:ID schemeID="CT">{escape(str(data.get("contract_id", "1")))}</cbc:ID>')
             xml_parts.append('  </cac:ContractDocumentReference>')
             
             # Accounting Supplier Party (Seller)
@@ -1358,100 +1922,58 @@ class InvoiceService:
             xml_parts.append(f'      <cbc:EndpointID schemeID="DK:CVR">DK{supplier_cvr}</cbc:EndpointID>')
             
             # Clean the CVR (ensure 8 digits)
-            supplier_cvr = ''.join(c for c in supplier_cvr if c.isdigit())
+            supplier_cvr = _NON_DIGIT_RE.sub('', supplier_cvr)
             if len(supplier_cvr) != 8:
                 supplier_cvr = "00000000"  # Default if invalid format
                 logger.warning(f"Invalid supplier CVR format, using default")
 
-
-            # Fix: Only include GLN if we have a valid 13-digit GLN
-            supplier_gln = data.get("supplier_gln", "")
-            if supplier_gln and len(supplier_gln) == 13:
-                xml_parts.append('      <cac:PartyIdentification>')
-                xml_parts.append(f'        <cbc:ID schemeAgencyID="9" schemeID="GLN">{supplier_gln}</cbc:ID>')
-                xml_parts.append('      </cac:PartyIdentification>')
-            
-            # Supplier name
-            xml_parts.append('      <cac:PartyName>')
-            xml_parts.append(f'        <cbc:Name>{data.get("supplier_name", "Unknown Supplier")}</cbc:Name>')
-            xml_parts.append('      </cac:PartyName>')
-
-            # Fix: Ensure address fields are never empty
-            supplier_street = data.get("supplier_street", "Unknown Street")
-            supplier_city = data.get("supplier_city", "Unknown City")
-            supplier_postal = data.get("supplier_postal_code", "0000")
-            
-            # Supplier address
-            xml_parts.append('      <cac:PostalAddress>')
-            xml_parts.append('        <cbc:AddressFormatCode listAgencyID="320" listID="urn:oioubl:codelist:addressformatcode-1.1">StructuredDK</cbc:AddressFormatCode>')
-            xml_parts.append(f'        <cbc:StreetName>{supplier_street}</cbc:StreetName>')
-            xml_parts.append('        <cbc:BuildingNumber>.</cbc:BuildingNumber>')
-            xml_parts.append(f'        <cbc:CityName>{supplier_city}</cbc:CityName>')
-            xml_parts.append(f'        <cbc:PostalZone>{supplier_postal}</cbc:PostalZone>')
-            xml_parts.append('        <cac:Country>')
-            xml_parts.append(f'          <cbc:IdentificationCode>{data.get("supplier_country", "DK")}</cbc:IdentificationCode>')
-            xml_parts.append('        </cac:Country>')
-            xml_parts.append('      </cac:PostalAddress>')
-            
-            # Supplier tax scheme
-            xml_parts.append('      <cac:PartyTaxScheme>')
-
+            # Supplier tax scheme VAT number
             supplier_vat = data.get("supplier_vat", "")
-            if not supplier_vat or len(supplier_vat) < 10:  # Not present or invalid format
+            vat_match = _DANISH_VAT_RE.fullmatch(_NON_ALNUM_RE.sub('', str(supplier_vat)))
+            if vat_match:
+                # Ensure proper format (DK + 8 digits)
+                supplier_vat = f"DK{vat_match.group(1)}"
+            elif not supplier_vat:
                 # Use CVR to create VAT if missing
                 supplier_vat = f"DK{supplier_cvr}"
                 logger.info(f"Created supplier VAT from CVR: {supplier_vat}")
-
-            # Ensure proper format (DK + 8 digits)
-            if not supplier_vat.startswith("DK"):
-                supplier_vat = f"DK{supplier_vat}"
-            supplier_vat = ''.join(c for c in supplier_vat if c.isalnum())  # Keep only alphanumeric
-            if len(supplier_vat) != 10 or not supplier_vat.startswith("DK"):
+            else:
                 supplier_vat = f"DK{supplier_cvr}"  # Fallback to CVR-based VAT
                 logger.warning(f"Invalid supplier VAT format, using CVR-based: {supplier_vat}")
 
-            xml_parts.append(f'        <cbc:CompanyID schemeID="DK:SE">{supplier_vat}</cbc:CompanyID>')
-            xml_parts.append('        <cac:TaxScheme>')
-            xml_parts.append('          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-            xml_parts.append('          <cbc:Name>Moms</cbc:Name>')
-            xml_parts.append('        </cac:TaxScheme>')
-            xml_parts.append('      </cac:PartyTaxScheme>')
-            
-            # Supplier legal entity
-            xml_parts.append('      <cac:PartyLegalEntity>')
-            xml_parts.append(f'        <cbc:RegistrationName>{data.get("supplier_name", "Unknown Supplier")}</cbc:RegistrationName>')
-            xml_parts.append(f'        <cbc:CompanyID schemeID="DK:CVR">DK{supplier_cvr}</cbc:CompanyID>')
-            xml_parts.append('      </cac:PartyLegalEntity>')
-            
-            # Supplier contact
-            xml_parts.append('      <cac:Contact>')
-            xml_parts.append('        <cbc:ID>n/a</cbc:ID>')
-            xml_parts.append(f'        <cbc:Name>{data.get("supplier_contact", data.get("supplier_name", "Contact Person"))}</cbc:Name>')
-            xml_parts.append('      </cac:Contact>')
+            # Fix: Only include GLN if we have a valid 13-digit GLN
+            supplier_gln = data.get("supplier_gln", "")
+            supplier_gln_identification = ""
+            if supplier_gln and len(supplier_gln) == 13:
+                supplier_gln_identification = _OIOXML_PARTY_GLN.format(gln=supplier_gln)
+
+            # Supplier name, address (fix: never empty) and tax scheme, shared with the Seller Supplier Party
+            supplier_details = _OIOXML_SUPPLIER_DETAILS.format_map({
+                "gln_identification": supplier_gln_identification,
+                "name": supplier_name,
+                "street": escape(str(data.get("supplier_street", "Unknown Street"))),
+                "city": escape(str(data.get("supplier_city", "Unknown City"))),
+                "postal": data.get("supplier_postal_code", "0000"),
+                "country": data.get("supplier_country", "DK"),
+                "vat": supplier_vat,
+            })
+            xml_parts.append(supplier_details)
+            
+            # Supplier legal entity and contact
+            xml_parts.append(_OIOXML_SUPPLIER_LEGAL_ENTITY.format(name=supplier_name, company_id=f"DK{supplier_cvr}", contact=supplier_contact))
             
             xml_parts.append('    </cac:Party>')
             xml_parts.append('  </cac:AccountingSupplierParty>')
 
             if USE_DEFAULT_CUSTOMER_ONLY:
-                customer_vat = default_customer["vat"]
-                customer_name = default_customer["name"]
-                customer_street = default_customer["street"]
-                customer_city = default_customer["city"]
-                customer_postal = default_customer["postal_code"]
-                customer_country = default_customer["country"]
-                customer_contact = default_customer["contact_name"]
-                customer_phone = default_customer["contact_phone"]
+                customer_values = [default_customer[key] for _, key in _CUSTOMER_FIELDS]
             else:
-                customer_vat = data.get("customer_vat", default_customer["vat"])
-                customer_name = data.get("customer_name", default_customer["name"])
-                customer_street = data.get("customer_street", default_customer["street"])
-                customer_city = data.get("customer_city", default_customer["city"])
-                customer_postal = data.get("customer_postal_code", default_customer["postal_code"])
-                customer_country = data.get("customer_country", default_customer["country"])
-                customer_contact = data.get("customer_contact", default_customer["contact_name"])
-                customer_phone = data.get("customer_phone", default_customer["contact_phone"])
+                customer_values = [data.get(field, default_customer[key]) for field, key in _CUSTOMER_FIELDS]
+            (customer_vat, customer_name, customer_street, customer_city,
+             customer_postal, customer_country, customer_contact, customer_phone) = customer_values
             
-            customer_name = customer_name.encode('utf-8').decode('utf-8', errors='replace')
+            # Escaped once, the name is written twice
+            customer_name = escape(customer_name)
             
             # Accounting Customer Party (Buyer)
             xml_parts.append('  <cac:AccountingCustomerParty>')
@@ -1471,9 +1993,9 @@ class InvoiceService:
             # Customer address
             xml_parts.append('      <cac:PostalAddress>')
             xml_parts.append('        <cbc:AddressFormatCode listAgencyID="320" listID="urn:oioubl:codelist:addressformatcode-1.1">StructuredDK</cbc:AddressFormatCode>')
-            xml_parts.append(f'        <cbc:StreetName>{customer_street}</cbc:StreetName>')
+            xml_parts.append(f'        <cbc:StreetName>{escape(str(customer_street))}</cbc:StreetName>')
             xml_parts.append('        <cbc:BuildingNumber>.</cbc:BuildingNumber>')
-            xml_parts.append(f'        <cbc:CityName>{customer_city}</cbc:CityName>')
+            xml_parts.append(f'        <cbc:CityName>{escape(str(customer_city))}</cbc:CityName>')
             xml_parts.append(f'        <cbc:PostalZone>{customer_postal}</cbc:PostalZone>')
             xml_parts.append('        <cac:Country>')
             xml_parts.append(f'          <cbc:IdentificationCode>{customer_country}</cbc:IdentificationCode>')
@@ -1498,63 +2020,18 @@ class InvoiceService:
             # Customer contact
             xml_parts.append('      <cac:Contact>')
             xml_parts.append('        <cbc:ID>n/a</cbc:ID>')
-            xml_parts.append(f'        <cbc:Name>{customer_contact}</cbc:Name>')
-            xml_parts.append(f'        <cbc:Telephone>{customer_phone}</cbc:Telephone>')
+            xml_parts.append(f'        <cbc:Name>{escape(str(customer_contact))}</cbc:Name>')
+            xml_parts.append(f'        <cbc:Telephone>{escape(str(customer_phone))}</cbc:Telephone>')
             xml_parts.append('      </cac:Contact>')
             
             xml_parts.append('    </cac:Party>')
             xml_parts.append('  </cac:AccountingCustomerParty>')
             
-            # Seller Supplier Party (copy of supplier info)
+            # Seller Supplier Party (copy of supplier info, the legal entity uses the VAT number)
             xml_parts.append('  <cac:SellerSupplierParty>')
             xml_parts.append('    <cac:Party>')
-            
-            # Only include GLN if valid
-            if supplier_gln and len(supplier_gln) == 13:
-                xml_parts.append('      <cac:PartyIdentification>')
-                xml_parts.append(f'        <cbc:ID schemeAgencyID="9" schemeID="GLN">{supplier_gln}</cbc:ID>')
-                xml_parts.append('      </cac:PartyIdentification>')
-            
-            # Supplier name
-            supplier_name = data.get("supplier_name", "Unknown Supplier")
-            supplier_name = supplier_name.encode('utf-8').decode('utf-8', errors='replace')
-            xml_parts.append('      <cac:PartyName>')
-            xml_parts.append(f'        <cbc:Name>{supplier_name}</cbc:Name>')
-            xml_parts.append('      </cac:PartyName>')
-            
-            # Use same address values as above
-            xml_parts.append('      <cac:PostalAddress>')
-            xml_parts.append('        <cbc:AddressFormatCode listAgencyID="320" listID="urn:oioubl:codelist:addressformatcode-1.1">StructuredDK</cbc:AddressFormatCode>')
-            xml_parts.append(f'        <cbc:StreetName>{supplier_street}</cbc:StreetName>')
-            xml_parts.append('        <cbc:BuildingNumber>.</cbc:BuildingNumber>')
-            xml_parts.append(f'        <cbc:CityName>{supplier_city}</cbc:CityName>')
-            xml_parts.append(f'        <cbc:PostalZone>{supplier_postal}</cbc:PostalZone>')
-            xml_parts.append('        <cac:Country>')
-            xml_parts.append(f'          <cbc:IdentificationCode>{data.get("supplier_country", "DK")}</cbc:IdentificationCode>')
-            xml_parts.append('        </cac:Country>')
-            xml_parts.append('      </cac:PostalAddress>')
-            
-            # Supplier tax scheme
-            xml_parts.append('      <cac:PartyTaxScheme>')
-            xml_parts.append(f'        <cbc:CompanyID schemeID="DK:SE">{supplier_vat}</cbc:CompanyID>')
-            xml_parts.append('        <cac:TaxScheme>')
-            xml_parts.append('          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-            xml_parts.append('          <cbc:Name>Moms</cbc:Name>')
-            xml_parts.append('        </cac:TaxScheme>')
-            xml_parts.append('      </cac:PartyTaxScheme>')
-            
-            # Supplier legal entity
-            xml_parts.append('      <cac:PartyLegalEntity>')
-            xml_parts.append(f'        <cbc:RegistrationName>{data.get("supplier_name", "Unknown Supplier")}</cbc:RegistrationName>')
-            xml_parts.append(f'        <cbc:CompanyID schemeID="DK:CVR">{supplier_vat}</cbc:CompanyID>')
-            xml_parts.append('      </cac:PartyLegalEntity>')
-            
-            # Supplier contact
-            xml_parts.append('      <cac:Contact>')
-            xml_parts.append('        <cbc:ID>n/a</cbc:ID>')
-            xml_parts.append(f'        <cbc:Name>{data.get("supplier_contact", data.get("supplier_name", "Contact Person"))}</cbc:Name>')
-            xml_parts.append('      </cac:Contact>')
-            
+            xml_parts.append(supplier_details)
+            xml_parts.append(_OIOXML_SUPPLIER_LEGAL_ENTITY.format(name=supplier_name, company_id=supplier_vat, contact=supplier_contact))
             xml_parts.append('    </cac:Party>')
             xml_parts.append('  </cac:SellerSupplierParty>')
             
@@ -1566,257 +2043,100 @@ class InvoiceService:
             xml_parts.append(f'    <cbc:PaymentDueDate>{data.get("payment_due_date", "")}</cbc:PaymentDueDate>')
 
             # Add payment channel code based on payment type
-            if payment_means_code == "93":
-                # FIK payment
-                xml_parts.append('    <cbc:PaymentChannelCode listAgencyID="320" listID="urn:oioubl:codelist:paymentchannelcode-1.1">DK:FIK</cbc:PaymentChannelCode>')
-            elif payment_means_code == "42":
-                # Bank transfer
-                xml_parts.append('    <cbc:PaymentChannelCode listAgencyID="320" listID="urn:oioubl:codelist:paymentchannelcode-1.1">DK:BANK</cbc:PaymentChannelCode>')
-
-            # Handle different payment types
-            payment_method_type = data.get("payment_method_type", "").upper()
+            payment_channel = _PAYMENT_CHANNEL_CODES.get(payment_means_code)
+            if payment_channel:
+                xml_parts.append(payment_channel)
 
-            if payment_method_type == "FIK" or payment_means_code == "93":
-                # FIK payment
-                
-                # InstructionID (optional, but usually present for FIK)
-                if "instruction_id" in data:
-                    xml_parts.append(f'    <cbc:InstructionID>{data["instruction_id"]}</cbc:InstructionID>')
-                
-                # PaymentID (mandatory for FIK)
-                payment_id = data.get("payment_id", "71")
-                if payment_id not in ["71", "73", "75"]:
-                    logger.warning(f"Invalid payment_id: {payment_id}, defaulting to 71")
-                    payment_id = "71"
-                xml_parts.append(f'    <cbc:PaymentID schemeAgencyID="320" schemeID="urn:oioubl:id:paymentid-1.1">{payment_id}</cbc:PaymentID>')
-                
-                # CreditAccount (aggregate element, comes last)
-                account_id = str(data.get("account_id", "")).strip()
-                if len(account_id) != 8:
-                    logger.warning(f"FIK account_id must be 8 chars, got {len(account_id)}: {account_id}")
-                    if len(account_id) < 8:
-                        account_id = account_id.zfill(8)  # Pad left with zeros
-                    else:
-                        account_id = account_id[:8]  # Truncate to 8
-                
-                xml_parts.append('    <cac:CreditAccount>')
-                xml_parts.append(f'      <cbc:AccountID>{account_id}</cbc:AccountID>')
-                xml_parts.append('    </cac:CreditAccount>')
-
-            elif payment_method_type == "BANK_TRANSFER" or payment_means_code == "42":
-                # Bank transfer payment
-                
-                # PayeeFinancialAccount (aggregate element)
-                xml_parts.append('    <cac:PayeeFinancialAccount>')
-                
-                # Extract account details
-                account_number = ""
-                reg_number = ""
-                
-                # Use the extracted values from LLM
-                if "reg_number" in data and data["reg_number"]:
-                    reg_number = str(data["reg_number"]).strip()
-                
-                if "account_number" in data and data["account_number"]:
-                    account_number = str(data["account_number"]).strip()
-                elif "bank_account" in data and data["bank_account"]:
-                    # Fallback: if we have combined bank_account
-                    bank_account = str(data["bank_account"])
-                    bank_account_clean = bank_account.replace(" ", "").replace("-", "")
-                    
-                    if len(bank_account_clean) > 10 and not account_number:
-                        if not reg_number:
-                            reg_number = bank_account_clean[:4]
-                        account_number = bank_account_clean[-10:]
-                    else:
-                        account_number = bank_account_clean
-                
-                # Validate
-                if not reg_number:
-                    reg_number = "0000"
-                if not account_number:
-                    account_number = "0000000000"
-                
-                reg_number = reg_number.zfill(4)
-                
-                xml_parts.append(f'      <cbc:ID>{account_number}</cbc:ID>')
-                xml_parts.append(f'      <cbc:Name>{data.get("supplier_name", "")}</cbc:Name>')
-                
-                # FinancialInstitutionBranch
-                xml_parts.append('      <cac:FinancialInstitutionBranch>')
-                xml_parts.append(f'        <cbc:ID>{reg_number}</cbc:ID>')
-                
-                # Add BIC if available
-                if "bic" in data and data["bic"]:
-                    xml_parts.append('        <cac:FinancialInstitution>')
-                    xml_parts.append(f'          <cbc:ID schemeID="BIC">{data["bic"]}</cbc:ID>')
-                    xml_parts.append('        </cac:FinancialInstitution>')
-                
-                xml_parts.append('      </cac:FinancialInstitutionBranch>')
-                xml_parts.append('    </cac:PayeeFinancialAccount>')
-
-            else:
-                # Default/unspecified payment
-                pass
+            # Handle different payment types, a FIK or bank transfer code decides unless the type is FIK
+            payment_method_type = data.get("payment_method_type", "").upper()
+            if payment_method_type != "FIK":
+                payment_method_type = _PAYMENT_METHOD_BY_CODE.get(payment_means_code) or payment_method_type
+            payment_means_details = _PAYMENT_MEANS_DETAILS.get(payment_method_type)
+            if payment_means_details:
+                xml_parts.extend(payment_means_details(data))
 
             xml_parts.append('  </cac:PaymentMeans>')
             # End of PaymentMeans
             
             # Payment terms
-            xml_parts.append('  <cac:PaymentTerms>')
-            xml_parts.append('    <cbc:ID>1</cbc:ID>')
-            xml_parts.append('    <cbc:PaymentMeansID>1</cbc:PaymentMeansID>')
-            xml_parts.append('    <cbc:SettlementDiscountPercent>0.00</cbc:SettlementDiscountPercent>')
-            xml_parts.append(f'    <cbc:Amount currencyID="{data.get("currency", "DKK")}">{self.format_amount(data.get("payable_amount", "0"))}</cbc:Amount>')
-            xml_parts.append('    <cac:SettlementPeriod>')
-            xml_parts.append(f'      <cbc:EndDate>{data.get("payment_due_date", "")}</cbc:EndDate>')
-            xml_parts.append('    </cac:SettlementPeriod>')
-            xml_parts.append('  </cac:PaymentTerms>')
+            xml_parts.append(_OIOXML_PAYMENT_TERMS.format(currency=currency, amount=payable_amount, due_date=data.get("payment_due_date", "")))
 
             # AllowanceCharge for environmental fee (if exists)
             environmental_fee = data.get("environmental_fee", 0)
-            if environmental_fee and environmental_fee > 0:
-                environmental_fee = float(environmental_fee)  # Ensure it's a float
-                xml_parts.append('  <cac:AllowanceCharge>')
-                xml_parts.append('    <cbc:ChargeIndicator>true</cbc:ChargeIndicator>')
-                xml_parts.append('    <cbc:AllowanceChargeReasonCode>ENV</cbc:AllowanceChargeReasonCode>')
-                xml_parts.append('    <cbc:AllowanceChargeReason>Miljøafgift</cbc:AllowanceChargeReason>')
-                xml_parts.append(f'    <cbc:Amount currencyID="{data.get("currency", "DKK")}">{self.format_amount(environmental_fee)}</cbc:Amount>')
-                xml_parts.append('    <cac:TaxCategory>')
-                xml_parts.append('      <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>')
-                # xml_parts.append(f'      <cbc:Percent>{data.get("tax_percent", "25")}</cbc:Percent>')
-                xml_parts.append('          <cbc:Percent>25.00</cbc:Percent>')
-                xml_parts.append('      <cac:TaxScheme>')
-                xml_parts.append('        <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-                xml_parts.append('        <cbc:Name>Moms</cbc:Name>')
-                xml_parts.append('      </cac:TaxScheme>')
-                xml_parts.append('    </cac:TaxCategory>')
-                xml_parts.append('  </cac:AllowanceCharge>')
-
-            # AllowanceCharge for freight fee (if exists)
+            if environmental_fee > 0:
+                xml_parts.append(_OIOXML_ALLOWANCE_CHARGE.format(
+                    reason_code="ENV", reason="Miljøafgift", currency=currency, amount=self.format_amount(environmental_fee)))
+
+            # AllowanceCharge for freight fee (if exists), FC = Freight Charge
             freight_fee = data.get("freight_fee", 0)
-            if freight_fee and freight_fee > 0:
-                freight_fee = float(freight_fee)  # Ensure it's a float
-                xml_parts.append('  <cac:AllowanceCharge>')
-                xml_parts.append('    <cbc:ChargeIndicator>true</cbc:ChargeIndicator>')
-                xml_parts.append('    <cbc:AllowanceChargeReasonCode>FC</cbc:AllowanceChargeReasonCode>')  # FC = Freight Charge
-                xml_parts.append('    <cbc:AllowanceChargeReason>Fragt</cbc:AllowanceChargeReason>')
-                xml_parts.append(f'    <cbc:Amount currencyID="{data.get("currency", "DKK")}">{self.format_amount(freight_fee)}</cbc:Amount>')
-                xml_parts.append('    <cac:TaxCategory>')
-                xml_parts.append('      <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>')
-                # xml_parts.append(f'      <cbc:Percent>{data.get("tax_percent", "25")}</cbc:Percent>')
-                xml_parts.append('          <cbc:Percent>25.00</cbc:Percent>')
-                xml_parts.append('      <cac:TaxScheme>')
-                xml_parts.append('        <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-                xml_parts.append('        <cbc:Name>Moms</cbc:Name>')
-                xml_parts.append('      </cac:TaxScheme>')
-                xml_parts.append('    </cac:TaxCategory>')
-                xml_parts.append('  </cac:AllowanceCharge>')
-
-            # CRITICAL FIX: Calculate the correct tax amounts
-            # The real tax should be 25% of tax_exclusive_amount
-            tax_exclusive = float(data.get("tax_exclusive_amount", 0))
-            real_tax_amount = round(tax_exclusive * float(data.get("tax_percent", 25)) / 100, 2)
-            
-            # Tax total
-            xml_parts.append('  <cac:TaxTotal>')
-            
+            if freight_fee > 0:
+                xml_parts.append(_OIOXML_ALLOWANCE_CHARGE.format(
+                    reason_code="FC", reason="Fragt", currency=currency, amount=self.format_amount(freight_fee)))
+
             # Get the total tax amount from data (which should already be calculated correctly)
-            total_tax = float(data.get("tax_amount", 0))
+            total_tax = self.format_amount(float(data.get("tax_amount", 0)))
             
             # Get the taxable amount (what the tax is calculated on)
             taxable_amount = float(data.get("taxable_amount", data.get("line_extension_amount", 0)))
             
-            xml_parts.append(f'    <cbc:TaxAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(total_tax)}</cbc:TaxAmount>')
-            xml_parts.append('    <cac:TaxSubtotal>')
-            xml_parts.append(f'      <cbc:TaxableAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(taxable_amount)}</cbc:TaxableAmount>')
-            xml_parts.append(f'      <cbc:TaxAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(total_tax)}</cbc:TaxAmount>')
-            xml_parts.append('      <cac:TaxCategory>')
-            xml_parts.append('        <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>')
-            # xml_parts.append(f'        <cbc:Percent>{data.get("tax_percent", "25.00")}</cbc:Percent>')
-            xml_parts.append('          <cbc:Percent>25.00</cbc:Percent>')
-            xml_parts.append('        <cac:TaxScheme>')
-            xml_parts.append('          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-            xml_parts.append('          <cbc:Name>Moms</cbc:Name>')
-            xml_parts.append('        </cac:TaxScheme>')
-            xml_parts.append('      </cac:TaxCategory>')
-            xml_parts.append('    </cac:TaxSubtotal>')
-            xml_parts.append('  </cac:TaxTotal>')
+            # Tax total
+            xml_parts.append(_OIOXML_TAX_TOTAL.format(currency=currency, tax_amount=total_tax, taxable_amount=self.format_amount(taxable_amount)))
 
             # Log the calculation for debugging
             # logger.info(f"Validator workaround: TaxExclusive={tax_exclusive}, LinesTaxSum={line_taxes_sum}, AdjustedDocTax={document_tax_adjusted}")
             
             # Legal monetary total with precise amounts
             xml_parts.append('  <cac:LegalMonetaryTotal>')
-            xml_parts.append(f'    <cbc:LineExtensionAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(data.get("line_extension_amount", "0"))}</cbc:LineExtensionAmount>')
+            xml_parts.append(f'    <cbc:LineExtensionAmount currencyID="{currency}">{self.format_amount(data.get("line_extension_amount", "0"))}</cbc:LineExtensionAmount>')
             ## FIX: Use the total tax amount calculated above
-            xml_parts.append(f'    <cbc:TaxExclusiveAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(total_tax)}</cbc:TaxExclusiveAmount>')
-            xml_parts.append(f'    <cbc:TaxInclusiveAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(data.get("tax_inclusive_amount", "0"))}</cbc:TaxInclusiveAmount>')
+            xml_parts.append(f'    <cbc:TaxExclusiveAmount currencyID="{currency}">{total_tax}</cbc:TaxExclusiveAmount>')
+            xml_parts.append(f'    <cbc:TaxInclusiveAmount currencyID="{currency}">{self.format_amount(data.get("tax_inclusive_amount", "0"))}</cbc:TaxInclusiveAmount>')
             # Add ChargeTotalAmount when charges exist
-            if data.get("charge_total_amount", 0) > 0:
-                xml_parts.append(f'    <cbc:ChargeTotalAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(data.get("charge_total_amount", "0"))}</cbc:ChargeTotalAmount>')
-            xml_parts.append(f'    <cbc:PayableAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(data.get("payable_amount", "0"))}</cbc:PayableAmount>')
+            charge_total_amount = data.get("charge_total_amount", 0)
+            if charge_total_amount > 0:
+                xml_parts.append(f'    <cbc:ChargeTotalAmount currencyID="{currency}">{self.format_amount(charge_total_amount)}</cbc:ChargeTotalAmount>')
+            xml_parts.append(f'    <cbc:PayableAmount currencyID="{currency}">{payable_amount}</cbc:PayableAmount>')
             xml_parts.append('  </cac:LegalMonetaryTotal>')
             
-            # Invoice lines
+            # Invoice lines; the order reference is the same for every line
+            order_reference = {
+                "order_id": escape(str(order_id)),
+                "sales_order_id": escape(str(data.get("sales_order_id", order_id))),
+                "order_date": data.get("order_date", data.get("invoice_date", "")),
+                "customer_reference": "",
+                "currency": currency,
+            }
+            if data.get("customer_reference"):
+                order_reference["customer_reference"] = f'\n        <cbc:CustomerReference>{escape(str(data.get("customer_reference")))}</cbc:CustomerReference>'
+            
+            # The tax rate is the same for every line
+            tax_percent = float(data.get("tax_percent", 25))
+            
             for idx, item in enumerate(line_items, 1):
-                xml_parts.append('  <cac:InvoiceLine>')
-                xml_parts.append(f'    <cbc:ID>{idx}</cbc:ID>')
-
-                # Extract quantity first
-                quantity = item.get("quantity", "1.000")
-                if isinstance(quantity, (int, float)):
-                    quantity = f"{float(quantity):.3f}"
-                else:
-                    # Clean and format the quantity
-                    quantity = str(quantity).replace(',', '.')
-                    try:
-                        quantity = f"{float(quantity):.3f}"
-                    except:
-                        quantity = "1.000"
+                # Extract quantity first, 1 when it is missing or unreadable
+                quantity = f"{_to_float(item.get('quantity'), 1.0):.3f}"
                 
                 # Quantity with unit code
                 unit = item.get("unit", "EA")  # Default to EA (Each)
 
-                # Map common Danish units to valid UN/ECE codes
-                unit_mapping = {
-                    "stk": "EA",      # stykker -> Each
-                    "stk.": "EA",     # stykker -> Each
-                    "szet": "SET",    # sæt -> Set
-                    "sæt": "SET",     # sæt -> Set
-                    "pk": "PK",       # pakke -> Package
-                    "pk.": "PK",      # pakke -> Package
-                    "m": "MTR",       # meter -> Metre
-                    "kg": "KGM",      # kilogram -> Kilogram
-                    "l": "LTR",       # liter -> Litre
-                    "timer": "HUR",   # timer -> Hour
-                    "time": "HUR",    # time -> Hour
-                    "dag": "DAY",     # dag -> Day
-                    "dage": "DAY",    # dage -> Day
-                    "kasse": "CS",    # kasse -> Case
-                    "rulle": "RO",    # rulle -> Roll
-                    "flaske": "BO",   # flaske -> Bottle
-                    "palle": "PF",    # palle -> Pallet
-                    "boks": "BX",     # boks -> Box
-                }
-
-                # Convert to lowercase for comparison and map
+                # Map common Danish units to valid UN/ECE codes, compared in lowercase
                 unit_lower = unit.lower()
 
-                if unit_lower in unit_mapping:
-                    unit = unit_mapping[unit_lower]
+                if unit_lower in _UNIT_CODES:
+                    unit = _UNIT_CODES[unit_lower]
                 else:
                     # If no mapping found and it's not already uppercase, capitalize it
-                    if unit != unit.upper():
+                    unit_upper = unit.upper()
+                    if unit != unit_upper:
                         # Check if it might be a known code in wrong case
-                        if unit.upper() in ["EA", "SET", "PK", "KGM", "MTR", "LTR", "HUR", "DAY"]:
-                            unit = unit.upper()
+                        if unit_upper in _KNOWN_UNIT_CODES:
+                            unit = unit_upper
                         else:
                             # Default to EA for unknown units
                             logger.warning(f"Unknown unit '{unit}', defaulting to EA")
                             unit = "EA"
 
-                xml_parts.append(f'    <cbc:InvoicedQuantity unitCode="{unit}">{quantity}</cbc:InvoicedQuantity>')
+                xml_parts.append(_OIOXML_LINE_START.format(idx=idx, unit=unit, quantity=quantity))
                 
                 # Calculate line extension amount
                 try:
@@ -1824,14 +2144,10 @@ class InvoiceService:
                     unit_price = float(item.get("unit_price", 0))
                     
                     # IMPORTANT: Check if there's a discount
-                    discount = item.get("discount", 0)
+                    discount = _discount_percent(item)
                     discounted_unit_price = unit_price  # Default to original price
                     
                     if discount:
-                        if isinstance(discount, str):
-                            discount = float(discount.replace('%', '').strip())
-                        else:
-                            discount = float(discount)
                         # Calculate the discounted unit price
                         discounted_unit_price = unit_price * (1 - discount/100)
                     
@@ -1844,123 +2160,63 @@ class InvoiceService:
                 except:
                     line_amount_raw = float(item.get("amount", 0))
 
-                 # Tax total for line
-                tax_percent = float(data.get("tax_percent", 25))
+                # Tax total for line
                 tax_amount_raw = round(line_amount_raw * tax_percent / 100, 2)
                 
                 line_amount = self.format_amount(line_amount_raw)
                 tax_amount = self.format_amount(tax_amount_raw)
 
-                # Store raw tax amount for later aggregation
-                if not hasattr(self, '_line_taxes'):
-                    self._line_taxes = []
-                self._line_taxes.append(tax_amount_raw)
-
-                # Store the line extension amount for later validation
+                # Store the line extension amount for later validation; it stays a separate entry so it can be adjusted
                 line_extension_amounts.append(line_amount_raw)
+                line_extension_positions.append(len(xml_parts))
                 
-                xml_parts.append(f'    <cbc:LineExtensionAmount currencyID="{data.get("currency", "DKK")}">{line_amount}</cbc:LineExtensionAmount>')
-                
-                # Order line reference
-                xml_parts.append('    <cac:OrderLineReference>')
-                xml_parts.append(f'      <cbc:LineID>{idx}</cbc:LineID>')
-                xml_parts.append('      <cac:OrderReference>')
-                xml_parts.append(f'        <cbc:ID>{order_id}</cbc:ID>')
-                xml_parts.append(f'        <cbc:SalesOrderID schemeID="VN">{data.get("sales_order_id", order_id)}</cbc:SalesOrderID>')
-                xml_parts.append(f'        <cbc:IssueDate>{data.get("order_date", data.get("invoice_date", ""))}</cbc:IssueDate>')
-                if data.get("customer_reference"):
-                    xml_parts.append(f'        <cbc:CustomerReference>{data.get("customer_reference")}</cbc:CustomerReference>')
-                xml_parts.append('      </cac:OrderReference>')
-                xml_parts.append('    </cac:OrderLineReference>')
+                xml_parts.append(f'    <cbc:LineExtensionAmount currencyID="{currency}">{line_amount}</cbc:LineExtensionAmount>')
                 
-                # Pricing reference
-                xml_parts.append('    <cac:PricingReference>')
-                xml_parts.append('      <cac:AlternativeConditionPrice>')
-                original_price = item.get('original_unit_price', item.get("unit_price", "0"))
-                xml_parts.append(f'        <cbc:PriceAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(original_price)}</cbc:PriceAmount>')
-                xml_parts.append('        <cbc:PriceTypeCode listID="UN/ECE 5387">AAB</cbc:PriceTypeCode>')
-                xml_parts.append('      </cac:AlternativeConditionPrice>')
-                xml_parts.append('    </cac:PricingReference>')
-                
-                # Tax total for line
-                xml_parts.append('    <cac:TaxTotal>')
-                xml_parts.append(f'      <cbc:TaxAmount currencyID="{data.get("currency", "DKK")}">{tax_amount}</cbc:TaxAmount>')
-                xml_parts.append('      <cac:TaxSubtotal>')
-                xml_parts.append(f'        <cbc:TaxableAmount currencyID="{data.get("currency", "DKK")}">{line_amount}</cbc:TaxableAmount>')
-                xml_parts.append(f'        <cbc:TaxAmount currencyID="{data.get("currency", "DKK")}">{tax_amount}</cbc:TaxAmount>')
-                xml_parts.append('        <cac:TaxCategory>')
-                xml_parts.append('          <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxcategoryid-1.1">StandardRated</cbc:ID>')
-                # xml_parts.append(f'          <cbc:Percent>{tax_percent}</cbc:Percent>')
-                xml_parts.append(f'          <cbc:Percent>25.00</cbc:Percent>')
-                xml_parts.append('          <cac:TaxScheme>')
-                xml_parts.append('            <cbc:ID schemeAgencyID="320" schemeID="urn:oioubl:id:taxschemeid-1.1">63</cbc:ID>')
-                xml_parts.append('            <cbc:Name>Moms</cbc:Name>')
-                xml_parts.append('          </cac:TaxScheme>')
-                xml_parts.append('        </cac:TaxCategory>')
-                xml_parts.append('      </cac:TaxSubtotal>')
-                xml_parts.append('    </cac:TaxTotal>')
-                
-                # Item details
-                xml_parts.append('    <cac:Item>')
-                description = item.get("description", f"Item {idx}")
-                xml_parts.append(f'      <cbc:Description>{description}</cbc:Description>')
-                xml_parts.append(f'      <cbc:Name>{description}</cbc:Name>')
-                
-                # Item identification
+                # Optional item identifications: seller's item number, GTIN and catalog ID
+                item_identification = ""
                 item_number = item.get("item_number", "")
                 if item_number:
-                    xml_parts.append('      <cac:SellersItemIdentification>')
-                    xml_parts.append(f'        <cbc:ID schemeID="SA">{item_number}</cbc:ID>')
-                    xml_parts.append('      </cac:SellersItemIdentification>')
-                
-                # Add standard item identification (GTIN) if available
+                    item_identification += _OIOXML_ITEM_IDENTIFICATION.format(element="SellersItemIdentification", scheme="SA", value=escape(str(item_number)))
                 gtin = item.get("gtin", item.get("ean", ""))
                 if gtin:
-                    xml_parts.append('      <cac:StandardItemIdentification>')
-                    xml_parts.append(f'        <cbc:ID schemeID="GTIN">{gtin}</cbc:ID>')
-                    xml_parts.append('      </cac:StandardItemIdentification>')
-                
-                # Add catalog item identification if available
+                    item_identification += _OIOXML_ITEM_IDENTIFICATION.format(element="StandardItemIdentification", scheme="GTIN", value=escape(str(gtin)))
                 catalog_id = item.get("catalog_id", "")
                 if catalog_id:
-                    xml_parts.append('      <cac:CatalogueItemIdentification>')
-                    xml_parts.append(f'        <cbc:ID schemeID="MP">{catalog_id}</cbc:ID>')
-                    xml_parts.append('      </cac:CatalogueItemIdentification>')
-                    
-                xml_parts.append('    </cac:Item>')
-                
-                # Price - use discounted price if available
-                discounted_price = item.get('discounted_unit_price', item.get("unit_price", "0"))
-                xml_parts.append('    <cac:Price>')
-                xml_parts.append(f'      <cbc:PriceAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(discounted_price)}</cbc:PriceAmount>')
-                xml_parts.append(f'      <cbc:BaseQuantity unitCode="{unit}">1</cbc:BaseQuantity>')
-                xml_parts.append('      <cbc:OrderableUnitFactorRate>1</cbc:OrderableUnitFactorRate>')
-                xml_parts.append('    </cac:Price>')
-                
-                xml_parts.append('  </cac:InvoiceLine>')
+                    item_identification += _OIOXML_ITEM_IDENTIFICATION.format(element="CatalogueItemIdentification", scheme="MP", value=escape(str(catalog_id)))
+                
+                # Order line reference, pricing reference, tax total, item details and price - use discounted price if available
+                xml_parts.append(_OIOXML_LINE_BODY.format_map({
+                    **order_reference,
+                    "idx": idx,
+                    "unit": unit,
+                    "line_amount": line_amount,
+                    "tax_amount": tax_amount,
+                    "original_price": self.format_amount(item.get('original_unit_price', item.get("unit_price", "0"))),
+                    "discounted_price": self.format_amount(item.get('discounted_unit_price', item.get("unit_price", "0"))),
+                    "description": escape(str(item.get("description", f"Item {idx}"))),
+                    "item_identification": item_identification,
+                }))
 
             # Calculate sum of all line extension amounts
             line_extension_sum = sum(line_extension_amounts)
-            logger.info(f"Sum of all line extension amounts: {line_extension_sum}")
+            logger.info("Sum of all line extension amounts: %s", line_extension_sum)
             
             # Get the expected total
             expected_total = float(data.get("line_extension_amount", 0))
-            logger.info(f"Expected line extension amount total: {expected_total}")
+            logger.info("Expected line extension amount total: %s", expected_total)
             
             # Check if there's a difference
             difference = expected_total - line_extension_sum
-            logger.info(f"Difference in line extension amounts: {difference}")
+            logger.info("Difference in line extension amounts: %s", difference)
 
             # If there's a small difference, adjust the last non-zero line
             if 0 < abs(difference) < 0.1:  # Allow for a small tolerance
                 logger.info(f"Detected difference in line extension amounts: {difference}")
                 
                 # Find the last non-zero line extension amount
-                adjustment_idx = -1
-                for i in range(len(line_extension_amounts) - 1, -1, -1):
-                    if line_extension_amounts[i] > 0.01:
-                        adjustment_idx = i
-                        break
+                adjustment_idx = next(
+                    (i for i in range(len(line_extension_amounts) - 1, -1, -1) if line_extension_amounts[i] > 0.01), -1
+                )
                 
                 if adjustment_idx >= 0:
                     # Adjust the line to make the sum match
@@ -1969,34 +2225,12 @@ class InvoiceService:
                     
                     logger.info(f"Adjusting line {adjustment_idx + 1} extension amount from {original_amount} to {corrected_amount}")
                     
-                    # Fix the specific line in XML
+                    # Fix the specific line in XML, its LineExtensionAmount element is one entry of xml_parts
                     line_idx = adjustment_idx + 1  # Line numbers are 1-based
-                    
-                    # Find the LineExtensionAmount element for this line
-                    line_tag_start = f'  <cac:InvoiceLine>\n    <cbc:ID>{line_idx}</cbc:ID>'
-                    amount_tag = f'<cbc:LineExtensionAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(original_amount)}</cbc:LineExtensionAmount>'
-                    corrected_tag = f'<cbc:LineExtensionAmount currencyID="{data.get("currency", "DKK")}">{self.format_amount(corrected_amount)}</cbc:LineExtensionAmount>'
-                    
-                    # Join XML parts into a temporary string to do the replacement
-                    xml_temp = '\n'.join(xml_parts)
-                    
-                    # Find the line and replace the amount
-                    line_start_pos = xml_temp.find(line_tag_start)
-                    if line_start_pos >= 0:
-                        # Find the amount tag after the line start
-                        amount_start_pos = xml_temp.find(amount_tag, line_start_pos)
-                        if amount_start_pos >= 0:
-                            # Replace the amount
-                            xml_temp = xml_temp[:amount_start_pos] + corrected_tag + xml_temp[amount_start_pos + len(amount_tag):]
-                            
-                            # Update xml_parts (we need to regenerate from the string)
-                            xml_parts = xml_temp.split('\n')
-                            
-                            logger.info(f"Successfully adjusted line {line_idx} extension amount in XML")
-                        else:
-                            logger.warning(f"Could not find amount tag for line {line_idx}")
-                    else:
-                        logger.warning(f"Could not find line {line_idx} in XML")
+                    xml_parts[line_extension_positions[adjustment_idx]] = (
+                        f'    <cbc:LineExtensionAmount currencyID="{currency}">{self.format_amount(corrected_amount)}</cbc:LineExtensionAmount>'
+                    )
+                    logger.info(f"Successfully adjusted line {line_idx} extension amount in XML")
                 else:
                     logger.warning("No suitable line found to adjust the difference")  
             
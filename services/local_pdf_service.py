@@ -1,12 +1,13 @@
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pathlib import Path
-from typing import List, Tuple
-from config.settings import LOCAL_PDF_DIR, PROCESSED_PDF_DIR, OUTPUT_DIR
+from typing import List, Optional, Tuple
+from config.settings import LOCAL_PDF_DIR, PROCESSED_PDF_DIR, OUTPUT_DIR, LOCAL_PDF_WORKERS, USE_OPENAI_BATCH_API
 from services.pdf_service import PDFService
 from services.invoice_service import InvoiceService
+from utils.file_utils import ensure_dir
 
 logger = logging.getLogger(__name__)
 
@@ -21,17 +22,13 @@ class LocalPDFService:
     def get_pdf_files(self) -> List[str]:
         """Get all PDF files from the local directory"""
         try:
-            pdf_files = []
-            local_path = Path(LOCAL_PDF_DIR)
-            
-            if not local_path.exists():
+            if not os.path.isdir(LOCAL_PDF_DIR):
                 logger.warning(f"Local PDF directory does not exist: {LOCAL_PDF_DIR}")
-                return pdf_files
+                return []
                 
-            # Find all PDF files
-            for file_path in local_path.glob("*.pdf"):
-                if file_path.is_file():
-                    pdf_files.append(str(file_path))
+            # Find all PDF files, in any case; scandir entries know whether they are files without a stat per file
+            with os.scandir(LOCAL_PDF_DIR) as entries:
+                pdf_files = [entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith(".pdf")]
                     
             logger.info(f"Found {len(pdf_files)} PDF files in local directory")
             return sorted(pdf_files)  # Sort for consistent processing order
@@ -40,15 +37,20 @@ class LocalPDFService:
             logger.error(f"Error getting PDF files: {e}")
             return []
     
-    def process_single_pdf(self, pdf_path: str) -> Tuple[bool, str, dict]:
+    def process_single_pdf(self, pdf_path: str, invoice_service: Optional[InvoiceService] = None) -> Tuple[bool, str, dict]:
         """
         Process a single PDF file
         
+        Args:
+            pdf_path: Path to the PDF file
+            invoice_service: Invoice service to use instead of the shared one,
+                needed when files are processed in parallel
+        
         Returns:
             Tuple of (success, message, token_usage)
         """
+        filename = os.path.basename(pdf_path)
         try:
-            filename = os.path.basename(pdf_path)
             logger.info(f"Processing PDF: {filename}")
             
             # Convert PDF to markdown
@@ -59,7 +61,8 @@ class LocalPDFService:
                 return False, error_msg, {}
             
             # Generate invoice from markdown
-            invoice_file_path, invoice_data, token_usage = self.invoice_service.generate_invoice(markdown_content)
+            invoice_service = invoice_service or self.invoice_service
+            invoice_file_path, invoice_data, token_usage = invoice_service.generate_invoice(markdown_content)
             
             if not invoice_file_path or not invoice_data:
                 error_msg = f"Failed to generate invoice from PDF: {filename}"
@@ -75,10 +78,55 @@ class LocalPDFService:
             return True, success_msg, token_usage or {}
             
         except Exception as e:
-            error_msg = f"Error processing {os.path.basename(pdf_path)}: {str(e)}"
+            error_msg = f"Error processing {filename}: {str(e)}"
             logger.error(error_msg, exc_info=True)
             return False, error_msg, {}
     
+    def process_pdfs_with_batch_api(self, pdf_files: List[str]) -> List[Tuple[bool, str, dict]]:
+        """
+        Process PDF files with all their LLM requests sent as one OpenAI Batch API job
+        
+        Returns:
+            List of (success, message, token_usage) in the same order as pdf_files
+        """
+        with ThreadPoolExecutor(max_workers=max(1, LOCAL_PDF_WORKERS)) as executor:
+            markdown_contents = list(executor.map(self.pdf_service.convert_to_markdown, pdf_files))
+        
+        outcomes = [None] * len(pdf_files)
+        converted = []
+        for index, (pdf_path, markdown_content) in enumerate(zip(pdf_files, markdown_contents)):
+            if markdown_content:
+                converted.append(index)
+            else:
+                error_msg = f"Failed to extract content from PDF: {os.path.basename(pdf_path)}"
+                logger.error(error_msg)
+                outcomes[index] = (False, error_msg, {})
+        
+        invoices = self.invoice_service.generate_invoices_with_batch_api(
+            [markdown_contents[index] for index in converted]
+        )
+        
+        for index, (invoice_file_path, invoice_data, token_usage) in zip(converted, invoices):
+            filename = os.path.basename(pdf_files[index])
+            
+            if not invoice_file_path or not invoice_data:
+                error_msg = f"Failed to generate invoice from PDF: {filename}"
+                logger.error(error_msg)
+                outcomes[index] = (False, error_msg, token_usage or {})
+                continue
+            
+            try:
+                self.move_to_processed(pdf_files[index])
+            except Exception as e:
+                outcomes[index] = (False, f"Error processing {filename}: {str(e)}", token_usage or {})
+                continue
+            
+            success_msg = f"Successfully processed {filename} -> {os.path.basename(invoice_file_path)}"
+            logger.info(success_msg)
+            outcomes[index] = (True, success_msg, token_usage or {})
+        
+        return outcomes
+    
     def move_to_processed(self, pdf_path: str) -> str:
         """Move PDF file to processed directory"""
         try:
@@ -88,7 +136,7 @@ class LocalPDFService:
             # Create unique filename to avoid conflicts
             name, ext = os.path.splitext(filename)
             processed_filename = f"{name}_{timestamp}{ext}"
-            processed_path = os.path.join(PROCESSED_PDF_DIR, processed_filename)
+            processed_path = os.path.join(ensure_dir(PROCESSED_PDF_DIR), processed_filename)
             
             # Move the file
             shutil.move(pdf_path, processed_path)
@@ -127,9 +175,21 @@ class LocalPDFService:
             
             logger.info(f"Starting to process {len(pdf_files)} PDF files")
             
-            for pdf_path in pdf_files:
+            if USE_OPENAI_BATCH_API:
+                outcomes = self.process_pdfs_with_batch_api(pdf_files)
+            else:
+                # Conversion and LLM calls are independent per file, so run them in
+                # parallel. InvoiceService keeps per-document state, so every file
+                # gets its own instance.
+                with ThreadPoolExecutor(max_workers=max(1, LOCAL_PDF_WORKERS)) as executor:
+                    outcomes = list(executor.map(
+                        lambda path: self.process_single_pdf(path, InvoiceService()),
+                        pdf_files
+                    ))
+            
+            status_lines = []
+            for pdf_path, (success, message, token_usage) in zip(pdf_files, outcomes):
                 filename = os.path.basename(pdf_path)
-                success, message, token_usage = self.process_single_pdf(pdf_path)
                 
                 # Accumulate token usage
                 for key in total_token_usage:
@@ -145,10 +205,13 @@ class LocalPDFService:
                 
                 if success:
                     successful += 1
-                    print(f"✓ {message}")
+                    status_lines.append(f"✓ {message}")
                 else:
                     failed += 1
-                    print(f"✗ {message}")
+                    status_lines.append(f"✗ {message}")
+            
+            # One write for all the per-file status lines
+            print("\n".join(status_lines))
             
             # Summary statistics
             stats = {
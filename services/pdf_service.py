@@ -1,18 +1,96 @@
+import hashlib
 import logging
-from markitdown import MarkItDown
+import os
+import threading
+import time
+from typing import Optional
+from config.settings import MARKDOWN_CACHE_ENABLED, MARKDOWN_CACHE_DIR, MARKDOWN_CACHE_TTL_DAYS, MARKDOWN_CACHE_MAX_ENTRIES
+from utils.file_utils import ensure_dir, write_text_atomic, prune_cache_dir
 
 logger = logging.getLogger(__name__)
 
 class PDFService:
     """Service for processing PDF files and extracting data"""
     
-    def __init__(self, enable_plugins=False):
+    def __init__(self, enable_plugins=False, cache_dir: Optional[str] = None):
         logger.info("Initializing PDF Service")
-        # Initialize the MarkItDown object during service initialization
-        self.markitdown = MarkItDown(enable_plugins=enable_plugins)
+        # MarkItDown is imported and set up on the first conversion, importing it loads every converter backend
+        self.enable_plugins = enable_plugins
+        self._markitdown = None
+        self._markitdown_lock = threading.Lock()
+        # Conversions are cached by PDF content, so a re-dropped or reprocessed file skips MarkItDown
+        self.cache_dir = cache_dir or (MARKDOWN_CACHE_DIR if MARKDOWN_CACHE_ENABLED else None)
+    
+    @property
+    def markitdown(self):
+        if self._markitdown is None:
+            with self._markitdown_lock:
+                if self._markitdown is None:
+                    from markitdown import MarkItDown
+                    self._markitdown = MarkItDown(enable_plugins=self.enable_plugins)
+        return self._markitdown
+    
+    @markitdown.setter
+    def markitdown(self, value):
+        self._markitdown = value
+    
+    def _cache_path(self, file_path: str) -> Optional[str]:
+        """Cache entry for the PDF's content, None when caching is off or the file can't be read"""
+        if not self.cache_dir:
+            return None
+        
+        digest = hashlib.sha256()
+        try:
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        
+        key = digest.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.md")
+    
+    def _get_cached_markdown(self, cache_path: str) -> Optional[str]:
+        try:
+            # Drop entries older than the TTL
+            if time.time() - os.path.getmtime(cache_path) > MARKDOWN_CACHE_TTL_DAYS * 86400:
+                os.remove(cache_path)
+                return None
+            with open(cache_path, 'r', encoding='utf-8') as file:
+                return file.read()
+        except OSError:
+            return None
+    
+    def _store_markdown(self, cache_path: str, markdown_content: str):
+        try:
+            ensure_dir(os.path.dirname(cache_path))
+            write_text_atomic(cache_path, markdown_content)
+        except OSError as e:
+            logger.warning(f"Could not store markdown in cache: {e}")
+    
+    def prune_cache(self, max_entries: int = MARKDOWN_CACHE_MAX_ENTRIES):
+        """Remove expired cache entries, then the oldest ones beyond max_entries"""
+        if not self.cache_dir:
+            return
+        
+        try:
+            removed = prune_cache_dir(self.cache_dir, '.md', max_entries, MARKDOWN_CACHE_TTL_DAYS)
+        except OSError as e:
+            logger.warning(f"Could not prune markdown cache: {e}")
+            return
+        
+        if removed:
+            logger.info(f"Pruned {removed} entries from the markdown cache")
     
     def convert_to_markdown(self, file_path: str) -> str:
         try:
+            cache_path = self._cache_path(file_path)
+            if cache_path:
+                markdown_content = self._get_cached_markdown(cache_path)
+                if markdown_content:
+                    logger.info(f"Using cached markdown for {file_path}, length: {len(markdown_content)} characters")
+                    return markdown_content
+            
             logger.info(f"Converting PDF to markdown using MarkItDown: {file_path}")
             
             # Use MarkItDown to convert PDF to markdown
@@ -23,8 +101,12 @@ class PDFService:
             
             logger.info(f"PDF successfully converted to markdown, length: {len(markdown_content)} characters")
             
-            return markdown_content
+            # Only real content is cached, an empty conversion is retried next time
+            if cache_path and markdown_content:
+                self._store_markdown(cache_path, markdown_content)
             
+            return markdown_content
+        
         except Exception as e:
             logger.error(f"Error converting PDF to markdown: {e}", exc_info=True)
             return ""
\ No newline at end of file
@@ -1,16 +1,32 @@
 import pytest
 import os
-from unittest.mock import patch, MagicMock, mock_open
+from types import SimpleNamespace
+from unittest.mock import patch, Mock, MagicMock
 from services.email_service import EmailService
+from services.graph_client import GraphClient
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def email_service():
-    with patch('services.email_service.GraphClient') as mock_client:
+    # A plain Mock limited to the GraphClient API is cheaper than a MagicMock and catches typos
+    with patch('services.email_service.GraphClient', return_value=Mock(spec=GraphClient)) as mock_client:
         service = EmailService()
         service.client = mock_client.return_value
         yield service
 
-def test_get_unread_emails(email_service):
+@pytest.fixture(autouse=True)
+def reset_client(email_service):
+    """The service is shared by the module, so every test starts from a fresh client mock"""
+    yield
+    email_service.client.reset_mock(return_value=True, side_effect=True)
+
+@pytest.fixture
+def invoice_file():
+    """A 1 KB invoice file on disk, as far as send_invoice can tell"""
+    with patch("os.stat", return_value=MagicMock(st_size=1024)) as mock_stat, \
+         patch("services.email_service.encode_file_base64", return_value="encoded_content") as mock_encode:
+        yield SimpleNamespace(stat=mock_stat, encode=mock_encode)
+
+def test_iter_unread_emails_single_page(email_service):
     # Mock data
     mock_emails = {
         "value": [
@@ -23,7 +39,7 @@ def test_get_unread_emails(email_service):
     email_service.client.get.return_value = mock_emails
    
     # Call the method
-    result = email_service.get_unread_emails()
+    result = list(email_service.iter_unread_emails())
    
     # Verify the result
     assert len(result) == 2
@@ -35,16 +51,51 @@ def test_get_unread_emails(email_service):
     args = email_service.client.get.call_args[0]
     assert "/users/" in args[0]
 
-def test_get_unread_emails_empty(email_service):
+def test_iter_unread_emails_empty(email_service):
     # Test when no emails are found
     mock_emails = {"value": []}
     email_service.client.get.return_value = mock_emails
     
-    result = email_service.get_unread_emails()
+    result = list(email_service.iter_unread_emails())
     
     assert len(result) == 0
     assert result == []
 
+def test_iter_unread_emails_follows_next_link(email_service):
+    next_link = "https://graph.microsoft.com/v1.0/users/test/messages?$skiptoken=abc"
+    email_service.client.get.side_effect = [
+        {"value": [{"id": "email1"}, {"id": "email2"}], "@odata.nextLink": next_link},
+        {"value": [{"id": "email3"}]}
+    ]
+    
+    result = list(email_service.iter_unread_emails(page_size=2))
+    
+    assert [email["id"] for email in result] == ["email1", "email2", "email3"]
+    assert email_service.client.get.call_count == 2
+    assert email_service.client.get.call_args_list[0][0][1]["$top"] == 2
+    # The next page is requested with the link exactly as returned
+    assert email_service.client.get.call_args_list[1][0] == (next_link,)
+
+def test_unread_listing_excludes_body(email_service):
+    email_service.client.get.return_value = {"value": []}
+    
+    list(email_service.iter_unread_emails())
+    
+    params = email_service.client.get.call_args[0][1]
+    assert "body" not in params["$select"].split(",")
+    # Attachments are listed without their content
+    assert params["$expand"] == "attachments($select=id,name,contentType,size)"
+
+def test_get_email_body(email_service):
+    email_service.client.get.return_value = {"body": {"contentType": "HTML", "content": "<p>Hi</p>"}}
+    
+    result = email_service.get_email_body("email_id")
+    
+    assert result == {"contentType": "HTML", "content": "<p>Hi</p>"}
+    args = email_service.client.get.call_args[0]
+    assert args[0].endswith("/messages/email_id")
+    assert args[1] == {"$select": "body"}
+
 def test_get_email_attachments(email_service):
     # Test attachment retrieval
     mock_attachments = {
@@ -83,35 +134,51 @@ def test_get_email_attachments_none(email_service):
     
     assert len(result) == 0
 
+def test_get_attachments_batch(email_service):
+    # Graph returns binary batch bodies base64 encoded
+    email_service.client.batch.return_value = [
+        {"id": "0", "status": 200, "body": "YWFh"},
+        {"id": "1", "status": 200, "body": "YmJi"}
+    ]
+    
+    result = email_service.get_attachments_batch("email_id", ["att1", "att2"])
+    
+    assert result == {"att1": "YWFh", "att2": "YmJi"}
+    
+    # Verify a single batch was sent
+    email_service.client.batch.assert_called_once()
+    requests_list = email_service.client.batch.call_args[0][0]
+    assert len(requests_list) == 2
+    assert requests_list[0]["url"].endswith("/attachments/att1/$value")
+
+def test_get_attachments_batch_failure(email_service):
+    # Test that a failed sub-request is surfaced as an error
+    email_service.client.batch.return_value = [{"id": "0", "status": 404, "body": {"error": {}}}]
+    
+    with pytest.raises(Exception):
+        email_service.get_attachments_batch("email_id", ["att1"])
+
 def test_download_attachment(email_service):
-    # Mock binary content
-    mock_content = b"PDF file content"
-    email_service.client.get_binary.return_value = mock_content
-    
-    # Mock file operations
-    with patch("builtins.open", mock_open()) as mock_file:
-        with patch("os.path.join", return_value="test_invoice.pdf"):
-            result = email_service.download_attachment("email_id", "att_id", "test_invoice.pdf")
-    
-    # Verify file was written
-    mock_file.assert_called_once_with("test_invoice.pdf", 'wb')
-    mock_file().write.assert_called_once_with(mock_content)
+    result = email_service.download_attachment("email_id", "att_id", "test_invoice.pdf")
+    
+    # Verify the content was streamed to the target file
+    email_service.client.download_to_file.assert_called_once()
+    endpoint, file_path = email_service.client.download_to_file.call_args[0]
+    assert endpoint.endswith("/attachments/att_id/$value")
+    assert file_path == "test_invoice.pdf"
     assert result == "test_invoice.pdf"
 
 def test_download_attachment_no_filename(email_service):
     # Test downloading attachment without provided filename
-    mock_content = b"PDF content"
     mock_attachment_info = {"name": "auto_generated.pdf"}
     
-    email_service.client.get_binary.return_value = mock_content
     email_service.client.get.return_value = mock_attachment_info
     
-    with patch("builtins.open", mock_open()) as mock_file:
-        with patch("os.path.join", return_value="auto_generated.pdf"):
-            result = email_service.download_attachment("email_id", "att_id")
+    result = email_service.download_attachment("email_id", "att_id")
     
     # Should get filename from attachment info
     assert result == "auto_generated.pdf"
+    email_service.client.download_to_file.assert_called_once()
 
 def test_mark_as_read(email_service):
     # Mock data
@@ -128,27 +195,45 @@ def test_mark_as_read(email_service):
     args = email_service.client.patch.call_args[0]
     assert f"/users/{email_service.target_email}/messages/{email_id}" in args[0]
 
-@patch.dict('os.environ', {'INVOICE_RECIPIENT': 'test@company.com'})
-@patch("os.path.exists", return_value=True)
-def test_send_invoice_success(mock_exists, email_service):
+def test_mark_as_read_batch(email_service):
+    email_service.client.batch.return_value = [{"id": "0", "status": 200}, {"id": "1", "status": 200}]
+    
+    result = email_service.mark_as_read_batch(["email1", "email2"])
+    
+    assert result is True
+    requests_list = email_service.client.batch.call_args[0][0]
+    assert [request["method"] for request in requests_list] == ["PATCH", "PATCH"]
+    assert requests_list[1]["url"].endswith("/messages/email2")
+    assert requests_list[0]["body"] == {"isRead": True}
+
+def test_mark_as_read_batch_partial_failure(email_service):
+    email_service.client.batch.return_value = [{"id": "0", "status": 200}, {"id": "1", "status": 429}]
+    
+    assert email_service.mark_as_read_batch(["email1", "email2"]) is False
+
+def test_mark_as_read_batch_missing_sub_response_fails(email_service):
+    # batch() returns {} for ids missing from the reply
+    email_service.client.batch.return_value = [{"id": "0", "status": 200}, {}]
+    
+    assert email_service.mark_as_read_batch(["email1", "email2"]) is False
+
+@patch('services.email_service.INVOICE_RECIPIENT', 'test@company.com')
+def test_send_invoice_success(email_service, invoice_file):
     # Mock successful email sending
     email_service.client.post.return_value = None
     
-    # Mock file reading
-    with patch("builtins.open", mock_open(read_data=b"XML content")):
-        with patch("base64.b64encode", return_value=b"encoded_content"):
-            with patch("os.path.basename", return_value="invoice.xml"):
-                result = email_service.send_invoice(
-                    "test_invoice.xml", 
-                    {"invoice_number": "123", "direct_xml": False}, 
-                    {"subject": "Test"}, 
-                    {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
-                )
+    result = email_service.send_invoice(
+        "test_invoice.xml", 
+        {"invoice_number": "123", "direct_xml": False}, 
+        {"subject": "Test"}, 
+        {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+    )
     
     assert result is True
     email_service.client.post.assert_called_once()
+    invoice_file.encode.assert_called_once_with("test_invoice.xml")
 
-@patch.dict('os.environ', {}, clear=True)
+@patch('services.email_service.INVOICE_RECIPIENT', None)
 def test_send_invoice_missing_recipient(email_service):
     # Test error handling when recipient is missing
     result = email_service.send_invoice(
@@ -159,9 +244,9 @@ def test_send_invoice_missing_recipient(email_service):
     
     assert result is False
 
-@patch.dict('os.environ', {'INVOICE_RECIPIENT': 'test@company.com'})
-@patch("os.path.exists", return_value=False)
-def test_send_invoice_file_not_found(mock_exists, email_service):
+@patch('services.email_service.INVOICE_RECIPIENT', 'test@company.com')
+@patch("os.stat", side_effect=FileNotFoundError)
+def test_send_invoice_file_not_found(mock_stat, email_service):
     # Test when invoice file doesn't exist
     result = email_service.send_invoice(
         "nonexistent.xml", 
@@ -171,20 +256,16 @@ def test_send_invoice_file_not_found(mock_exists, email_service):
     
     assert result is False
 
-@patch.dict('os.environ', {'INVOICE_RECIPIENT': 'test@company.com'})
-@patch("os.path.exists", return_value=True)
-def test_send_invoice_direct_xml(mock_exists, email_service):
+@patch('services.email_service.INVOICE_RECIPIENT', 'test@company.com')
+def test_send_invoice_direct_xml(email_service, invoice_file):
     # Test sending direct XML (forwarded email)
     email_service.client.post.return_value = None
     
-    with patch("builtins.open", mock_open(read_data=b"XML content")):
-        with patch("base64.b64encode", return_value=b"encoded_content"):
-            with patch("os.path.basename", return_value="invoice.xml"):
-                result = email_service.send_invoice(
-                    "direct_invoice.xml", 
-                    {"invoice_number": "456", "direct_xml": True}, 
-                    {"subject": "Direct XML"}
-                )
+    result = email_service.send_invoice(
+        "direct_invoice.xml", 
+        {"invoice_number": "456", "direct_xml": True}, 
+        {"subject": "Direct XML"}
+    )
     
     assert result is True
     
@@ -194,4 +275,35 @@ def test_send_invoice_direct_xml(mock_exists, email_service):
     
     # Check that it's a forwarded email (different subject pattern)
     message_data = call_args[0][1]
-    assert "Forwarded" in message_data["message"]["subject"]
\ No newline at end of file
+    assert "Forwarded" in message_data["message"]["subject"]
+def test_processed_email_body_token_usage(email_service):
+    token_usage = {"prompt_tokens": 12000, "completion_tokens": 500, "total_tokens": 12500}
+    
+    body = email_service._create_processed_pdf_email_body("INV-1", "January 01, 2025 at 10:00", token_usage)
+    
+    assert "INV-1" in body
+    assert "12,500" in body
+    assert "$0.0190" in body
+    assert "Processing Stats" not in email_service._create_processed_pdf_email_body("INV-1", "January 01, 2025 at 10:00")
+
+@patch('services.email_service.INVOICE_RECIPIENT', 'test@company.com')
+def test_send_invoice_large_attachment(email_service, tmp_path):
+    # Files over the sendMail limit go through a draft and an upload session
+    invoice_file = tmp_path / "large_invoice.xml"
+    invoice_file.write_bytes(b"x" * 100)
+    email_service.client.post.side_effect = [
+        {"id": "draft1"},
+        {"uploadUrl": "https://upload.example/session"},
+        None
+    ]
+    
+    with patch("services.email_service.LARGE_ATTACHMENT_THRESHOLD", 50):
+        result = email_service.send_invoice(str(invoice_file), {"invoice_number": "789"}, {"subject": "Large"})
+    
+    assert result is True
+    endpoints = [call[0][0] for call in email_service.client.post.call_args_list]
+    assert endpoints[0].endswith("/messages")
+    assert "attachments" not in email_service.client.post.call_args_list[0][0][1]
+    assert endpoints[1].endswith("/messages/draft1/attachments/createUploadSession")
+    assert endpoints[2].endswith("/messages/draft1/send")
+    email_service.client.upload_file.assert_called_once_with("https://upload.example/session", str(invoice_file))
@@ -0,0 +1,45 @@
+import os
+import stat
+import pytest
+from unittest.mock import patch
+from utils.file_utils import write_text_atomic
+
+def test_write_text_atomic_replaces_file(tmp_path):
+    path = tmp_path / "invoice.xml"
+    path.write_text("old", encoding="utf-8")
+    
+    write_text_atomic(str(path), "<Invoice>æøå</Invoice>")
+    
+    assert path.read_text(encoding="utf-8") == "<Invoice>æøå</Invoice>"
+    assert os.listdir(tmp_path) == ["invoice.xml"]
+
+def test_write_text_atomic_keeps_old_file_on_failure(tmp_path):
+    path = tmp_path / "invoice.xml"
+    path.write_text("old", encoding="utf-8")
+    
+    with patch('utils.file_utils.os.replace', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            write_text_atomic(str(path), "new")
+    
+    assert path.read_text(encoding="utf-8") == "old"
+    assert os.listdir(tmp_path) == ["invoice.xml"]
+
+def test_write_text_atomic_file_mode_matches_plain_open(tmp_path):
+    new_path = tmp_path / "new.xml"
+    plain_path = tmp_path / "plain.xml"
+    plain_path.write_text("plain", encoding="utf-8")
+    existing_path = tmp_path / "existing.xml"
+    existing_path.write_text("old", encoding="utf-8")
+    existing_path.chmod(0o640)
+    
+    write_text_atomic(str(new_path), "new")
+    write_text_atomic(str(existing_path), "new")
+    
+    # New files follow the umask, replaced files keep their mode
+    assert stat.S_IMODE(new_path.stat().st_mode) == stat.S_IMODE(plain_path.stat().st_mode)
+    assert stat.S_IMODE(existing_path.stat().st_mode) == 0o640
+
+def test_safe_filename_replaces_invalid_characters():
+    from utils.file_utils import safe_filename
+    
+    assert safe_filename("faktura 112262 (kopi)/æ.pdf") == "faktura_112262__kopi__æ.pdf"
@@ -0,0 +1,189 @@
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+from services import graph_client as graph_client_module
+from services.graph_client import GraphClient, GraphRetry, SESSION
+
+@pytest.fixture(autouse=True)
+def token_cache():
+    # Start every test without a cached token
+    with patch.dict('services.graph_client._TOKEN_CACHE', {"value": None, "exp": 0}):
+        yield
+
+@pytest.fixture
+def mock_token():
+    with patch('services.graph_client.get_access_token_with_expiry', return_value=("test_token", 3600)) as mock:
+        yield mock
+
+def make_session():
+    session = MagicMock()
+    session.headers = {}
+    return session
+
+@pytest.fixture
+def graph_client(mock_token):
+    return GraphClient(session=make_session())
+
+def test_default_session_is_shared():
+    # Every client reuses the process-wide pooled session
+    assert GraphClient().session is SESSION
+    assert GraphClient().session is GraphClient().session
+    assert SESSION.headers["Content-Type"] == "application/json"
+
+def test_get_uses_session(graph_client):
+    graph_client.session.get.return_value.json.return_value = {"value": []}
+    
+    result = graph_client.get("/users/test/messages", {"$top": 5})
+    
+    assert result == {"value": []}
+    graph_client.session.get.assert_called_once()
+    args, kwargs = graph_client.session.get.call_args
+    assert args[0].endswith("/users/test/messages")
+    assert kwargs["params"] == {"$top": 5}
+    # The token goes on the request, the shared session's headers are left alone
+    assert kwargs["headers"] == {"Authorization": "Bearer test_token"}
+    assert "Authorization" not in graph_client.session.headers
+
+def test_get_with_absolute_url(graph_client):
+    # @odata.nextLink values are complete URLs
+    next_link = "https://graph.microsoft.com/v1.0/users/test/messages?$skiptoken=abc"
+    
+    graph_client.get(next_link)
+    
+    assert graph_client.session.get.call_args[0][0] == next_link
+
+def test_post_without_content(graph_client):
+    # sendMail returns 202 with an empty body
+    graph_client.session.post.return_value.content = b""
+    
+    result = graph_client.post("/users/test/sendMail", {"message": {}})
+    
+    assert result is None
+    graph_client.session.post.assert_called_once()
+
+def test_batch_orders_responses(graph_client):
+    # Sub-responses may come back in any order
+    graph_client.session.post.return_value.json.return_value = {
+        "responses": [{"id": "1", "status": 204}, {"id": "0", "status": 200}]
+    }
+    
+    result = graph_client.batch([
+        {"method": "GET", "url": "/a"},
+        {"method": "PATCH", "url": "/b", "body": {"isRead": True}}
+    ])
+    
+    assert [item["status"] for item in result] == [200, 204]
+    payload = json.loads(graph_client.session.post.call_args[1]["data"])
+    assert payload["requests"][1]["headers"] == {"Content-Type": "application/json"}
+
+def test_batch_splits_into_chunks(graph_client):
+    # More than 20 sub-requests are spread over several $batch calls
+    graph_client.session.post.return_value.json.side_effect = [
+        {"responses": [{"id": str(i), "status": 200} for i in range(20)]},
+        {"responses": [{"id": str(i), "status": 200} for i in range(5)]}
+    ]
+    
+    result = graph_client.batch([{"method": "GET", "url": f"/item/{i}"} for i in range(25)])
+    
+    assert len(result) == 25
+    assert graph_client.session.post.call_count == 2
+
+def test_batch_resends_throttled_sub_requests(graph_client):
+    graph_client.session.post.return_value.json.side_effect = [
+        {"responses": [{"id": "0", "status": 200}, {"id": "1", "status": 429, "headers": {"Retry-After": "2"}}]},
+        {"responses": [{"id": "1", "status": 204}]}
+    ]
+    
+    with patch('services.graph_client.time.sleep') as mock_sleep:
+        result = graph_client.batch([{"method": "GET", "url": "/a"}, {"method": "PATCH", "url": "/b", "body": {"isRead": True}}])
+    
+    assert [item["status"] for item in result] == [200, 204]
+    mock_sleep.assert_called_once_with(2.0)
+    # Only the throttled sub-request is sent again
+    payload = json.loads(graph_client.session.post.call_args[1]["data"])
+    assert [item["url"] for item in payload["requests"]] == ["/b"]
+
+def test_batch_gives_up_on_persistent_throttling(graph_client):
+    graph_client.session.post.return_value.json.return_value = {"responses": [{"id": "0", "status": 429}]}
+    
+    with patch('services.graph_client.time.sleep'):
+        result = graph_client.batch([{"method": "GET", "url": "/a"}])
+    
+    assert result == [{"id": "0", "status": 429}]
+    assert graph_client.session.post.call_count == graph_client_module.BATCH_THROTTLE_RETRIES + 1
+
+def test_token_shared_between_clients(mock_token):
+    # The token is acquired once and reused by every client
+    first = GraphClient(session=make_session())
+    second = GraphClient(session=make_session())
+    
+    first.get("/me")
+    second.get("/me")
+    
+    assert mock_token.call_count == 1
+
+def test_token_refreshed_before_expiry(mock_token):
+    mock_token.return_value = ("short_token", 30)
+    client = GraphClient(session=make_session())
+    
+    client.get("/me")
+    client.get("/me")
+    
+    # Tokens inside the 60 second safety margin are not reused
+    assert mock_token.call_count == 2
+
+def test_unauthorized_refreshes_token_and_retries(graph_client, mock_token):
+    mock_token.side_effect = [("expired_token", 3600), ("fresh_token", 3600)]
+    unauthorized = MagicMock(status_code=401)
+    ok = MagicMock(status_code=200)
+    ok.json.return_value = {"id": "me"}
+    graph_client.session.get.side_effect = [unauthorized, ok]
+    
+    result = graph_client.get("/me")
+    
+    assert result == {"id": "me"}
+    assert graph_client.session.get.call_count == 2
+    assert [call[1]["headers"]["Authorization"] for call in graph_client.session.get.call_args_list] == ["Bearer expired_token", "Bearer fresh_token"]
+    assert graph_client_module._TOKEN_CACHE["value"] == "fresh_token"
+
+def test_upload_file_sends_byte_ranges(graph_client, tmp_path):
+    upload_file = tmp_path / "invoice.xml"
+    upload_file.write_bytes(b"a" * 10)
+    
+    graph_client.upload_file("https://upload.example/session", str(upload_file), chunk_size=4)
+    
+    ranges = [call[1]["headers"]["Content-Range"] for call in graph_client.session.put.call_args_list]
+    assert ranges == ["bytes 0-3/10", "bytes 4-7/10", "bytes 8-9/10"]
+    # The pre-authenticated upload URL must not receive the Graph token
+    assert graph_client.session.put.call_args[1]["headers"]["Authorization"] is None
+
+def test_download_to_file_streams_chunks(graph_client, tmp_path):
+    response = graph_client.session.get.return_value
+    response.status_code = 200
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [b"%PDF", b"-1.4"]
+    target = tmp_path / "invoice.pdf"
+    
+    result = graph_client.download_to_file("/me/messages/1/attachments/2/$value", str(target))
+    
+    assert result == str(target)
+    assert target.read_bytes() == b"%PDF-1.4"
+
+def test_post_serializes_body(graph_client):
+    graph_client.session.post.return_value.content = b""
+    
+    graph_client.post("/users/test/sendMail", {"message": {"subject": "Faktura 123 – æøå"}})
+    
+    kwargs = graph_client.session.post.call_args[1]
+    assert json.loads(kwargs["data"]) == {"message": {"subject": "Faktura 123 – æøå"}}
+
+def test_retry_policy_only_retries_writes_when_throttled():
+    retry = GraphRetry(total=5, status_forcelist=[429, 500, 502, 503, 504])
+    
+    assert retry.is_retry("GET", 500)
+    assert retry.is_retry("POST", 429)
+    assert retry.is_retry("PATCH", 503)
+    # A 500 on sendMail may already have delivered the message
+    assert not retry.is_retry("POST", 500)
+    assert not GraphRetry(total=0).is_retry("POST", 429)
+    assert isinstance(SESSION.get_adapter("https://graph.microsoft.com").max_retries, GraphRetry)
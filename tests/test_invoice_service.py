@@ -0,0 +1,832 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
+import pytest
+from unittest.mock import patch, MagicMock
+from services.invoice_service import InvoiceService
+
+@pytest.fixture
+def invoice_service():
+    return InvoiceService()
+
+@pytest.fixture(autouse=True)
+def llm_memory_cache():
+    # Keep the in-memory response cache from leaking between tests
+    with patch('utils.llm_cache._memory', OrderedDict()):
+        yield
+
+@pytest.fixture
+def mock_openai():
+    client = MagicMock()
+    with patch('services.invoice_service._get_openai_client', return_value=client):
+        yield client
+
+def test_generate_invoice_batch_preserves_order(invoice_service):
+    # Each document is generated independently, results come back in input order
+    def fake_generate(self, markdown_content):
+        return f"/output/{markdown_content}.xml", {"invoice_number": markdown_content}, {}
+    
+    with patch.object(InvoiceService, 'generate_invoice', autospec=True, side_effect=fake_generate):
+        results = invoice_service.generate_invoice_batch(["a", "b", "c"], max_concurrency=2)
+    
+    assert [result[0] for result in results] == ["/output/a.xml", "/output/b.xml", "/output/c.xml"]
+    assert results[1][1]["invoice_number"] == "b"
+
+def test_generate_invoice_batch_empty(invoice_service):
+    assert invoice_service.generate_invoice_batch([]) == []
+
+def test_extract_invoice_data_merges_llm_results_in_order(invoice_service):
+    # Later chunks override earlier ones and line items keep chunk order,
+    # even though the calls run concurrently
+    chunk_results = {
+        "chunk one": {"currency": "DKK", "supplier_name": "A", "line_items": [{"description": "first"}]},
+        "chunk two": {"supplier_name": "B", "line_items": [{"description": "second"}]}
+    }
+    
+    with patch.object(invoice_service, '_extract_invoice_extras_with_llm', return_value=({"shipping_fee": "141,00"}, {"payment_means_code": "42"})), \
+         patch.object(invoice_service, '_create_extraction_prompt', side_effect=lambda chunk: chunk), \
+         patch.object(invoice_service, '_extract_data_with_openai', side_effect=lambda prompt: dict(chunk_results[prompt])):
+        data = invoice_service._extract_invoice_data_from_chunks(["chunk one", "chunk two"])
+    
+    assert data["shipping_fee"] == "141,00"
+    assert data["payment_means_code"] == "42"
+    assert data["supplier_name"] == "B"
+    assert [item["description"] for item in data["line_items"]] == ["first", "second"]
+
+def test_split_content_into_chunks_with_overlap(invoice_service):
+    invoice_service.CHUNK_SIZE = 10  # 40 characters
+    invoice_service.CHUNK_OVERLAP = 3  # 12 characters
+    paragraphs = ["a" * 20, "b" * 15, "c" * 10, "d" * 30]
+    
+    chunks = invoice_service._split_content_into_chunks("\n\n".join(paragraphs))
+    
+    # The second chunk repeats the shortest tail of the first that exceeds the overlap
+    assert chunks == [
+        "a" * 20 + "\n\n" + "b" * 15,
+        "b" * 15 + "\n\n" + "c" * 10,
+        "b" * 15 + "\n\n" + "c" * 10 + "\n\n" + "d" * 30
+    ]
+
+def test_split_content_into_chunks_keeps_original_text(invoice_service):
+    content = "Faktura 1\n  \nLinje 1\nLinje 2"
+    
+    assert invoice_service._split_content_into_chunks(content) == [content]
+
+def test_split_content_into_chunks_counts_tokens_with_tokenizer(invoice_service):
+    # One token per word with a stand-in tokenizer
+    encoding = MagicMock()
+    encoding.encode.side_effect = lambda text, disallowed_special: text.split()
+    invoice_service.CHUNK_SIZE = 3
+    invoice_service.CHUNK_OVERLAP = 0
+    
+    with patch('services.invoice_service._get_token_encoding', return_value=encoding):
+        chunks = invoice_service._split_content_into_chunks("en to\n\ntre\n\nfire fem")
+    
+    assert chunks == ["en to\n\ntre", "tre\n\nfire fem"]
+
+def test_invoice_extras_split_into_charges_and_payment(invoice_service):
+    response = json.dumps({
+        "payment": {"payment_method_type": "BANK_TRANSFER", "iban": "dk50 0040 0440 1162 43", "note": "brace } inside"},
+        "charges": {"environmental_fee": "12,50"}
+    })
+    
+    with patch.object(invoice_service, '_chat_completion', return_value=response) as mock_chat:
+        charges, payment = invoice_service._extract_invoice_extras_with_llm("invoice text")
+    
+    # One call covers both, and it is pinned to JSON mode
+    mock_chat.assert_called_once()
+    assert mock_chat.call_args.args[0]["response_format"] == {"type": "json_object"}
+    assert charges == {"environmental_fee": "12,50"}
+    assert payment["payment_means_code"] == "42"
+    assert payment["iban"] == "DK5000400440116243"
+    assert payment["note"] == "brace } inside"
+
+def test_invoice_extras_default_payment_on_invalid_json(invoice_service):
+    with patch.object(invoice_service, '_chat_completion', return_value="no json here"):
+        charges, payment = invoice_service._extract_invoice_extras_with_llm("invoice text")
+    
+    assert charges == {}
+    assert payment["payment_method_type"] == "UNSPECIFIED"
+
+def test_load_invoice_template_reads_file_once_until_modified(invoice_service, tmp_path):
+    template_path = tmp_path / "template.xml"
+    template_path.write_text("<Invoice/>", encoding="utf-8")
+    
+    with patch('services.invoice_service.INVOICE_TEMPLATE_PATH', str(template_path)):
+        assert invoice_service._load_invoice_template() == "<Invoice/>"
+        
+        with patch('builtins.open', side_effect=AssertionError("template re-read")):
+            assert invoice_service._load_invoice_template() == "<Invoice/>"
+        
+        template_path.write_text("<Invoice>v2</Invoice>", encoding="utf-8")
+        os.utime(template_path, (0, 0))
+        assert invoice_service._load_invoice_template() == "<Invoice>v2</Invoice>"
+
+def test_load_invoice_template_missing_file(invoice_service, tmp_path):
+    with patch('services.invoice_service.INVOICE_TEMPLATE_PATH', str(tmp_path / "missing.xml")):
+        assert invoice_service._load_invoice_template() == ""
+
+def test_loads_llm_json_uses_orjson_when_available():
+    from services.invoice_service import _loads_llm_json
+    fake_orjson = MagicMock(JSONDecodeError=json.JSONDecodeError)
+    fake_orjson.loads.side_effect = json.loads
+    
+    with patch('services.invoice_service.orjson', fake_orjson):
+        assert _loads_llm_json(' {"a": 1}\n') == {"a": 1}
+        # Trailing text makes orjson fail, raw_decode still finds the object
+        assert _loads_llm_json('{"a": 2}\nHope this helps') == {"a": 2}
+    
+    assert fake_orjson.loads.call_count == 2
+
+def test_enrich_with_cvr_numbers_reads_mapping_once(invoice_service, tmp_path):
+    map_path = tmp_path / "company_cvr_map.json"
+    map_path.write_text(json.dumps({"company_cvr_map": {"acme": "12345678", "globex": "87654321"}}), encoding="utf-8")
+    
+    with patch('services.invoice_service.COMPANY_CVR_MAP_PATH', str(map_path)), \
+         patch('services.invoice_service._loads_json', wraps=json.loads) as mock_load:
+        data = invoice_service.enrich_with_cvr_numbers({"supplier_name": "ACME A/S", "customer_name": "Globex ApS"})
+        invoice_service.enrich_with_cvr_numbers({"supplier_name": "Acme"})
+    
+    assert data["supplier_vat"] == "12345678"
+    assert data["customer_vat"] == "87654321"
+    assert mock_load.call_count == 1
+
+def test_lookup_cvr_prefers_most_specific_company_key(invoice_service, tmp_path):
+    map_path = tmp_path / "company_cvr_map.json"
+    map_path.write_text(json.dumps({"company_cvr_map": {"nordic": "11111111", "Nordic Steel": "22222222"}}), encoding="utf-8")
+    
+    with patch('services.invoice_service.COMPANY_CVR_MAP_PATH', str(map_path)):
+        assert invoice_service.lookup_cvr_with_company_mapping("Nordic Steel A/S") == "22222222"
+        assert invoice_service.lookup_cvr_with_company_mapping("Nordic Trading") == "11111111"
+
+def test_config_files_are_parsed_from_raw_bytes(invoice_service, tmp_path):
+    config_path = tmp_path / "default_customer.json"
+    config_path.write_text(json.dumps({"default_customer": {"name": "Føtex Ølgod"}}, ensure_ascii=False), encoding="utf-8")
+    fake_orjson = MagicMock()
+    fake_orjson.loads.side_effect = json.loads
+    
+    with patch('services.invoice_service.DEFAULT_CUSTOMER_CONFIG_PATH', str(config_path)), \
+         patch('services.invoice_service.orjson', fake_orjson):
+        assert invoice_service.load_default_customer_config() == {"name": "Føtex Ølgod"}
+    
+    assert isinstance(fake_orjson.loads.call_args.args[0], bytes)
+
+def test_load_default_customer_config_cached_copy(invoice_service, tmp_path):
+    config_path = tmp_path / "default_customer.json"
+    config_path.write_text(json.dumps({"default_customer": {"name": "Kunde ApS", "vat": "DK12345678"}}), encoding="utf-8")
+    
+    with patch('services.invoice_service.DEFAULT_CUSTOMER_CONFIG_PATH', str(config_path)):
+        first = invoice_service.load_default_customer_config()
+        first["name"] = "changed"
+        with patch('builtins.open', side_effect=AssertionError("config re-read")):
+            second = invoice_service.load_default_customer_config()
+    
+    assert second == {"name": "Kunde ApS", "vat": "DK12345678"}
+
+def _extract_header_only(invoice_service, content):
+    with patch.object(invoice_service, '_extract_invoice_extras_with_llm', return_value=({}, {})), \
+         patch.object(invoice_service, '_extract_data_with_openai', return_value={}):
+        return invoice_service._extract_invoice_data_from_chunks([content])
+
+def test_extract_invoice_number_from_faktura_header(invoice_service):
+    data = _extract_header_only(invoice_service, "Faktura 112-262\nSide 1")
+    
+    assert data["invoice_number"] == "112-262"
+
+def test_extract_header_values_from_vertical_labels(invoice_service):
+    content = "Fakturadato\nFakturakonto\nNummer\n\n15.03.2024\n40012\n998877"
+    data = _extract_header_only(invoice_service, content)
+    
+    assert data["invoice_date"] == "15.03.2024"
+    assert data["billing_account"] == "40012"
+    assert data["invoice_number"] == "998877"
+
+def test_faktura_header_ignores_non_numeric_values(invoice_service):
+    data = _extract_header_only(invoice_service, "Faktura\n---\nFaktura 2024-01")
+    
+    assert data["invoice_number"] == "2024-01"
+
+def test_extract_invoice_data_bounds_threads_for_long_documents(invoice_service):
+    chunks = [f"chunk {i}" for i in range(40)]
+    
+    with patch('services.invoice_service.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as mock_pool, \
+         patch('services.invoice_service.OPENAI_MAX_CONCURRENCY', 4), \
+         patch.object(invoice_service, '_extract_invoice_extras_with_llm', return_value=({}, {})), \
+         patch.object(invoice_service, '_create_extraction_prompt', side_effect=lambda chunk: chunk), \
+         patch.object(invoice_service, '_extract_data_with_openai', side_effect=lambda prompt: {"line_items": [{"description": prompt}]}):
+        data = invoice_service._extract_invoice_data_from_chunks(chunks)
+    
+    assert mock_pool.call_args.kwargs["max_workers"] == 4
+    assert [item["description"] for item in data["line_items"]] == chunks
+
+def test_extract_invoice_data_keeps_first_invoice_number_and_skips_null_items(invoice_service):
+    chunk_results = {
+        "chunk one": {"invoice_number": "1001", "line_items": [{"description": "first"}]},
+        "chunk two": {"invoice_number": "9999", "line_items": None, "currency": "DKK"}
+    }
+    
+    with patch.object(invoice_service, '_extract_invoice_extras_with_llm', return_value=({}, {})), \
+         patch.object(invoice_service, '_create_extraction_prompt', side_effect=lambda chunk: chunk), \
+         patch.object(invoice_service, '_extract_data_with_openai', side_effect=lambda prompt: dict(chunk_results[prompt])):
+        data = invoice_service._extract_invoice_data_from_chunks(["chunk one", "chunk two"])
+    
+    assert data["invoice_number"] == "1001"
+    assert data["currency"] == "DKK"
+    assert data["line_items"] == [{"description": "first"}]
+
+def test_generate_invoices_with_batch_api_serves_calls_from_batch_output(invoice_service, mock_openai):
+    seen = {}
+    
+    def fake_generate(self, markdown_content):
+        # The regular pipeline runs with the batch responses preloaded
+        seen[markdown_content] = dict(self._prefetched_responses)
+        return f"/output/{markdown_content}.xml", {}, {}
+    
+    output_text = {}
+    with patch('services.invoice_service.update_token_usage') as mock_usage, \
+         patch.object(InvoiceService, 'generate_invoice', autospec=True, side_effect=fake_generate):
+        mock_openai.files.create.return_value = MagicMock(id="file-in")
+        mock_openai.batches.create.return_value = MagicMock(id="batch-1", status="completed", output_file_id="file-out")
+        
+        def capture_input(file, purpose):
+            output_text["value"] = "\n".join(
+                json.dumps({
+                    "custom_id": json.loads(line)["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [{"message": {"content": "{}"}}],
+                            "usage": {"prompt_tokens": 10, "completion_tokens": 2}
+                        }
+                    }
+                })
+                for line in file.read().decode("utf-8").splitlines()
+            )
+            return MagicMock(id="file-in")
+        
+        mock_openai.files.create.side_effect = capture_input
+        mock_openai.files.content.side_effect = lambda file_id: MagicMock(text=output_text["value"])
+        
+        results = invoice_service.generate_invoices_with_batch_api(["doc a", "doc b"], poll_interval=0)
+    
+    assert [result[0] for result in results] == ["/output/doc a.xml", "/output/doc b.xml"]
+    # Charges and payment details in one request, plus one chunk extraction per document
+    assert len(seen["doc a"]) == 2
+    assert mock_usage.call_count == 4
+    mock_openai.batches.create.assert_called_once()
+
+def test_generate_invoices_with_batch_api_splits_large_runs(invoice_service, mock_openai):
+    seen = {}
+    uploads = []
+    
+    def fake_generate(self, markdown_content):
+        seen[markdown_content] = dict(self._prefetched_responses)
+        return f"/output/{markdown_content}.xml", {}, {}
+    
+    def capture_input(file, purpose):
+        uploads.append([json.loads(line)["custom_id"] for line in file.read().decode("utf-8").splitlines()])
+        return MagicMock(id=f"file-{len(uploads) - 1}")
+    
+    def create_batch(input_file_id, endpoint, completion_window):
+        index = int(input_file_id.split("-")[1])
+        # The second job fails, its requests are left for live calls
+        status = "failed" if index == 1 else "completed"
+        return MagicMock(id=f"batch-{index}", status=status, output_file_id=f"out-{index}")
+    
+    def output_for(file_id):
+        index = int(file_id.split("-")[1])
+        return MagicMock(text="\n".join(
+            json.dumps({
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "body": {
+                    "choices": [{"message": {"content": "{}"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1}
+                }}
+            })
+            for custom_id in uploads[index]
+        ))
+    
+    mock_openai.files.create.side_effect = capture_input
+    mock_openai.batches.create.side_effect = create_batch
+    mock_openai.files.content.side_effect = output_for
+    
+    with patch('services.invoice_service.update_token_usage'), \
+         patch.object(InvoiceService, 'generate_invoice', autospec=True, side_effect=fake_generate):
+        invoice_service.generate_invoices_with_batch_api(["doc a", "doc b"], poll_interval=0, max_requests_per_batch=3)
+    
+    assert uploads == [["0:0", "0:1", "1:0"], ["1:1"]]
+    assert len(seen["doc a"]) == 2
+    assert len(seen["doc b"]) == 1
+
+def test_generate_invoices_with_batch_api_falls_back_on_failure(invoice_service, mock_openai):
+    with patch.object(invoice_service, 'generate_invoice_batch', return_value=["direct"]) as mock_direct:
+        mock_openai.files.create.return_value = MagicMock(id="file-in")
+        mock_openai.batches.create.return_value = MagicMock(id="batch-1", status="failed", output_file_id=None)
+        
+        results = invoice_service.generate_invoices_with_batch_api(["doc a"], poll_interval=0)
+    
+    assert results == ["direct"]
+    mock_direct.assert_called_once_with(["doc a"])
+
+def test_openai_client_is_created_once():
+    from services.invoice_service import _get_openai_client
+    _get_openai_client.cache_clear()
+    
+    with patch('services.invoice_service.openai.OpenAI') as mock_client_cls:
+        first = _get_openai_client()
+        second = _get_openai_client()
+    _get_openai_client.cache_clear()
+    
+    assert first is second
+    mock_client_cls.assert_called_once()
+    assert mock_client_cls.call_args.kwargs["max_retries"] == 3
+
+def test_extract_data_with_openai_uses_json_mode(invoice_service):
+    with patch.object(invoice_service, '_chat_completion', return_value='{"invoice_number": "112262"}') as mock_chat:
+        data = invoice_service._extract_data_with_openai("prompt")
+    
+    assert data == {"invoice_number": "112262"}
+    assert mock_chat.call_args.args[0]["response_format"] == {"type": "json_object"}
+
+def test_extract_data_with_openai_falls_back_to_larger_model(invoice_service):
+    responses = {"gpt-4o-mini": "{}", "gpt-4o": '{"invoice_number": "112262"}'}
+    
+    with patch.object(invoice_service, '_chat_completion', side_effect=lambda request: responses[request["model"]]) as mock_chat:
+        data = invoice_service._extract_data_with_openai("prompt")
+    
+    assert data == {"invoice_number": "112262"}
+    assert [call.args[0]["model"] for call in mock_chat.call_args_list] == ["gpt-4o-mini", "gpt-4o"]
+
+def test_extract_data_with_openai_only_repairs_unparseable_json(invoice_service):
+    with patch.object(invoice_service, '_chat_completion', return_value='{}'), \
+         patch.object(invoice_service, '_attempt_json_repair') as mock_repair:
+        assert invoice_service._extract_data_with_openai("prompt") == {}
+    mock_repair.assert_not_called()
+    
+    with patch.object(invoice_service, '_chat_completion', return_value='{"invoice_number": "112262'):
+        assert invoice_service._extract_data_with_openai("prompt") == {"invoice_number": "112262"}
+
+def test_invoice_extras_stay_on_primary_model_when_complete(invoice_service):
+    response = json.dumps({"payment": {"payment_method_type": "UNSPECIFIED"}, "charges": {}})
+    
+    with patch.object(invoice_service, '_chat_completion', return_value=response) as mock_chat:
+        invoice_service._extract_invoice_extras_with_llm("invoice text")
+    
+    assert [call.args[0]["model"] for call in mock_chat.call_args_list] == ["gpt-4o-mini"]
+
+def test_invoice_extras_fall_back_on_invalid_json(invoice_service):
+    responses = {"gpt-4o-mini": "not json", "gpt-4o": json.dumps({"payment": {"payment_method_type": "BANK_TRANSFER"}})}
+    
+    with patch.object(invoice_service, '_chat_completion', side_effect=lambda request: responses[request["model"]]):
+        charges, payment = invoice_service._extract_invoice_extras_with_llm("invoice text")
+    
+    assert charges == {}
+    assert payment["payment_means_code"] == "42"
+
+def test_chat_completion_serves_cache_hit_without_api_call(invoice_service, mock_openai, tmp_path):
+    request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+    
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', True), \
+         patch('services.invoice_service.update_token_usage') as mock_usage:
+        mock_openai.chat.completions.create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content='{"a": 1}'))],
+            usage=MagicMock(prompt_tokens=10, completion_tokens=5)
+        )
+        
+        first = invoice_service._chat_completion(request)
+        second = invoice_service._chat_completion(request)
+    
+    assert first == second == '{"a": 1}'
+    mock_openai.chat.completions.create.assert_called_once()
+    mock_usage.assert_called_once_with(10, 5)
+
+def test_chat_completion_bypass_cache(invoice_service, mock_openai, tmp_path):
+    request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+    
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', True), \
+         patch('services.invoice_service.update_token_usage'):
+        mock_openai.chat.completions.create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content="fresh"))],
+            usage=MagicMock(prompt_tokens=1, completion_tokens=1)
+        )
+        
+        invoice_service._chat_completion(request)
+        invoice_service._chat_completion(request, bypass_cache=True)
+    
+    assert mock_openai.chat.completions.create.call_count == 2
+
+def test_chat_completion_counts_tokens_per_instance(invoice_service, mock_openai):
+    from services.invoice_service import _request_key
+    live_request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "live"}]}
+    batch_request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "batch"}]}
+    invoice_service._prefetched_responses = {_request_key(batch_request): "{}"}
+    invoice_service._prefetched_usage = {_request_key(batch_request): (7, 3)}
+    
+    with patch('services.invoice_service.LLM_CACHE_ENABLED', False), \
+         patch('services.invoice_service.update_token_usage') as mock_usage:
+        mock_openai.chat.completions.create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content="{}"))],
+            usage=MagicMock(prompt_tokens=10, completion_tokens=5)
+        )
+        
+        invoice_service._chat_completion(live_request)
+        invoice_service._chat_completion(batch_request)
+    
+    # Batch responses were already counted globally when the batch output was read
+    mock_usage.assert_called_once_with(10, 5)
+    assert invoice_service.get_token_usage_summary() == {"prompt_tokens": 17, "completion_tokens": 8, "total_tokens": 25}
+    assert InvoiceService().get_token_usage_summary()["total_tokens"] == 0
+
+def test_chat_completion_does_not_cache_unreadable_response(invoice_service, mock_openai, tmp_path):
+    request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+    
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', True), \
+         patch('services.invoice_service.update_token_usage'):
+        mock_openai.chat.completions.create.return_value = MagicMock(
+            choices=[MagicMock(message=MagicMock(content='{"invoice_number": '))],
+            usage=MagicMock(prompt_tokens=1, completion_tokens=1)
+        )
+        
+        invoice_service._chat_completion(request)
+        invoice_service._chat_completion(request)
+    
+    assert mock_openai.chat.completions.create.call_count == 2
+    assert list(tmp_path.iterdir()) == []
+
+def test_chat_completion_retries_rate_limits(invoice_service, mock_openai):
+    response = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="ok"))],
+        usage=MagicMock(prompt_tokens=1, completion_tokens=1)
+    )
+    mock_openai.chat.completions.create.side_effect = [TimeoutError("slow"), TimeoutError("slow"), response]
+    
+    with patch('services.invoice_service._RETRYABLE_OPENAI_ERRORS', (TimeoutError,)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', False), \
+         patch('services.invoice_service.update_token_usage'), \
+         patch('services.invoice_service.time.sleep') as mock_sleep:
+        assert invoice_service._chat_completion({"model": "gpt-4o", "messages": []}) == "ok"
+    
+    assert mock_openai.chat.completions.create.call_count == 3
+    assert mock_sleep.call_count == 2
+    assert all(1 <= call.args[0] <= 30 for call in mock_sleep.call_args_list)
+
+def test_chat_completion_gives_up_after_max_attempts(invoice_service, mock_openai):
+    mock_openai.chat.completions.create.side_effect = TimeoutError("slow")
+    
+    with patch('services.invoice_service._RETRYABLE_OPENAI_ERRORS', (TimeoutError,)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', False), \
+         patch('services.invoice_service.time.sleep'):
+        with pytest.raises(TimeoutError):
+            invoice_service._chat_completion({"model": "gpt-4o", "messages": []})
+    
+    assert mock_openai.chat.completions.create.call_count == 5
+
+def test_identical_prompts_in_flight_share_one_api_call(invoice_service, mock_openai, tmp_path):
+    request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "same chunk"}]}
+    started = threading.Event()
+    release = threading.Event()
+    
+    def slow_create(**kwargs):
+        started.set()
+        release.wait(5)
+        return MagicMock(
+            choices=[MagicMock(message=MagicMock(content='{"shared": true}'))],
+            usage=MagicMock(prompt_tokens=1, completion_tokens=1)
+        )
+    
+    mock_openai.chat.completions.create.side_effect = slow_create
+    
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path)), \
+         patch('services.invoice_service.LLM_CACHE_ENABLED', True), \
+         patch('services.invoice_service.update_token_usage'), \
+         patch('services.invoice_service.record_cached_response') as mock_cached:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(invoice_service._chat_completion, request)
+            started.wait(5)
+            second = executor.submit(InvoiceService()._chat_completion, request)
+            release.set()
+            results = [first.result(), second.result()]
+    
+    assert results == ['{"shared": true}', '{"shared": true}']
+    mock_openai.chat.completions.create.assert_called_once()
+    mock_cached.assert_called_once()
+
+def test_order_reference_prefers_sags_over_earlier_kunde_nr(invoice_service):
+    invoice_service.current_content = "KUNDE NR. 12345\nFoo\nSAGS. NR.: 4028204\n"
+    
+    _, order_number, _ = invoice_service.extract_order_reference_data({"order_number": ""})
+    
+    assert order_number == "4028204"
+
+def test_order_reference_falls_back_to_kunde_nr(invoice_service):
+    invoice_service.current_content = "Foo\nKUNDE NR. 12345\nKUNDE NR. 67890\n"
+    
+    _, order_number, _ = invoice_service.extract_order_reference_data({"order_number": "123456789"})
+    
+    assert order_number == "12345"
+
+def test_attempt_json_repair_escapes_newlines_in_strings_and_closes_object(invoice_service):
+    content = '{"description": "Ost\nmælk", "note": "cut off\n'
+    
+    repaired = invoice_service._attempt_json_repair(content)
+    
+    assert json.loads(repaired) == {"description": "Ost\nmælk", "note": "cut off\n"}
+
+@pytest.mark.parametrize("use_automaton", [False, True])
+def test_company_matcher_picks_most_specific_key(use_automaton):
+    from services import invoice_service as module
+    if use_automaton:
+        pytest.importorskip("ahocorasick")
+    
+    with patch.object(module, 'ahocorasick', module.ahocorasick if use_automaton else None):
+        matcher = module._CompanyMatcher({"Acme": "1", "Nordic Steel": "2", "nordic": "3", "Steel": "4"})
+        
+        assert (matcher.automaton is not None) == use_automaton
+        assert matcher.find("acme nordic steel a/s") == "2"
+        assert matcher.find("nordic trading") == "3"
+        assert matcher.find("acme steel") == "4"
+        assert matcher.find("globex") is None
+
+def test_prepare_invoice_data_totals_skip_unpriceable_lines(invoice_service):
+    line_items = [
+        {"quantity": 2, "unit_price": 10.5},
+        {"quantity": "3", "unit_price": "4.99", "discount": "10%"},
+        {"quantity": "n/a", "unit_price": 100},
+    ]
+    
+    data = invoice_service._prepare_invoice_data({"tax_percent": 25, "shipping_fee": "50 kr"}, line_items)
+    
+    assert data["line_extension_amount"] == 34.47
+    assert data["tax_amount"] == pytest.approx(5.25 + 3.37 + 12.5)
+    assert data["payable_amount"] == pytest.approx(34.47 + 21.12 + 50)
+
+def test_decimal_comma_quantity_lines_add_up_to_monetary_total(invoice_service):
+    import xml.etree.ElementTree as ET
+    ns = {"cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+          "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"}
+    line_items = [{"description": "Mel", "quantity": "1,5", "unit_price": 175}, {"description": "Gær", "quantity": 2, "unit_price": 10}]
+    data = invoice_service._prepare_invoice_data({"invoice_number": "1", "tax_percent": 25}, line_items)
+    
+    root = ET.fromstring(invoice_service._generate_enhanced_oioxml(data, line_items).encode("utf-8"))
+    
+    line_amounts = [float(line.find("cbc:LineExtensionAmount", ns).text) for line in root.findall("cac:InvoiceLine", ns)]
+    total = float(root.find("cac:LegalMonetaryTotal/cbc:LineExtensionAmount", ns).text)
+    assert line_amounts == [262.5, 20.0]
+    assert sum(line_amounts) == total
+
+def test_prepare_invoice_data_text_fees_reach_the_oioxml_charges(invoice_service):
+    data = invoice_service._prepare_invoice_data(
+        {"tax_percent": 25, "environmental_fee": "12,50 kr", "shipping_fee": "50 kr"},
+        [{"quantity": 1, "unit_price": 100}],
+    )
+    
+    assert data["environmental_fee"] == 12.5
+    assert data["charge_total_amount"] == 62.5
+    xml = invoice_service._generate_enhanced_oioxml(data, [{"quantity": 1, "unit_price": 100}])
+    assert '<cbc:AllowanceChargeReasonCode>ENV</cbc:AllowanceChargeReasonCode>' in xml
+    assert '<cbc:ChargeTotalAmount currencyID="DKK">62.50</cbc:ChargeTotalAmount>' in xml
+
+def test_prepare_invoice_data_fees_without_line_items_keep_charge_total(invoice_service):
+    data = invoice_service._prepare_invoice_data({"tax_percent": 25, "environmental_fee": "12,50 kr", "shipping_fee": "50 kr"}, [])
+    
+    assert data["charge_total_amount"] == 62.5
+    xml = invoice_service._generate_enhanced_oioxml(data, [])
+    assert '<cbc:AllowanceChargeReasonCode>FC</cbc:AllowanceChargeReasonCode>' in xml
+    assert '<cbc:ChargeTotalAmount currencyID="DKK">62.50</cbc:ChargeTotalAmount>' in xml
+
+def test_lookup_cvr_falls_back_to_read_only_defaults(invoice_service, tmp_path):
+    from services.invoice_service import _DEFAULT_COMPANY_CVR_MAP
+    
+    with patch('services.invoice_service.COMPANY_CVR_MAP_PATH', str(tmp_path / "missing.json")):
+        assert invoice_service.lookup_cvr_with_company_mapping("Carlsberg Breweries A/S") == "5790000567890"
+    with patch('services.invoice_service.COMPANY_CVR_MAP_PATH', str(tmp_path)):  # a directory can't be read
+        assert invoice_service.lookup_cvr_with_company_mapping("Danfoss A/S") == "20165715"
+    with pytest.raises(TypeError):
+        _DEFAULT_COMPANY_CVR_MAP["danfoss"] = "0"
+
+def test_generate_enhanced_oioxml_starts_with_shared_header(invoice_service):
+    from services.invoice_service import _OIOXML_HEADER
+    
+    xml = invoice_service._generate_enhanced_oioxml({"invoice_number": "1", "tax_percent": 25}, [{"quantity": 1, "unit_price": 10}])
+    
+    assert xml.startswith('\n'.join(_OIOXML_HEADER) + '\n  <cbc:UBLVersionID>2.0</cbc:UBLVersionID>')
+    assert xml.endswith('</Invoice>')
+
+@pytest.mark.parametrize("value, expected", [
+    ("125,50 kr", 125.5),
+    ("DKK 50", 50.0),
+    ("kr. 75", 75.0),
+    (40, 40.0),
+    ("", 0),
+    (None, 0),
+    ("1.234,50 kr", 0),  # thousands separators stay unsupported
+    ("gratis", 0),
+])
+def test_parse_money(value, expected):
+    from services.invoice_service import _parse_money
+    
+    assert _parse_money(value, "shipping_fee") == expected
+
+@pytest.mark.parametrize("code, expected", [("42", "42"), ("71", "93"), ("99", "30")])
+def test_prepare_invoice_data_maps_payment_means_code(invoice_service, code, expected):
+    data = invoice_service._prepare_invoice_data({"payment_means_code": code}, [])
+    
+    assert data["payment_means_code"] == expected
+
+def test_prepare_invoice_data_adds_oioxml_metadata(invoice_service):
+    data = invoice_service._prepare_invoice_data({"profile_id": "extracted"}, [{"quantity": 1, "unit_price": 1}])
+    
+    assert data["profile_id"] == "urn:www.nesubl.eu:profiles:profile5:ver2.0"
+    assert (data["invoice_type_code"], data["schema_agency_id"], data["line_count"]) == (380, 320, 1)
+
+def test_generate_xml_from_data_leaves_extracted_data_untouched(invoice_service):
+    data = {"line_items": [{"quantity": 1, "unit_price": 10}], "tax_percent": 25}
+    
+    xml = invoice_service._generate_xml_from_data("", data)
+    
+    assert "<cbc:ID>INV-" in xml
+    assert sorted(data) == ["line_items", "tax_percent"]
+
+def test_generate_enhanced_oioxml_escapes_free_text(invoice_service):
+    import xml.etree.ElementTree as ET
+    data = {"invoice_number": "1", "tax_percent": 25, "supplier_name": "Jensen & Søn <A/S>", "customer_name": "Bager & Co"}
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, [{"description": "Rugbrød 1kg <økologisk>", "quantity": 1, "unit_price": 10}])
+    
+    root = ET.fromstring(xml.encode("utf-8"))
+    texts = {element.text for element in root.iter()}
+    assert {"Jensen & Søn <A/S>", "Bager & Co", "Rugbrød 1kg <økologisk>"} <= texts
+
+def test_generate_enhanced_oioxml_escapes_identifiers(invoice_service):
+    import xml.etree.ElementTree as ET
+    data = {"invoice_number": "F&K-1", "tax_percent": 25, "contract_id": "<rammeaftale>"}
+    line_items = [{"description": "Mel", "quantity": 1, "unit_price": 10, "item_number": "A&B", "gtin": "<n/a>", "catalog_id": "K&1"}]
+    
+    root = ET.fromstring(invoice_service._generate_enhanced_oioxml(data, line_items).encode("utf-8"))
+    
+    texts = {element.text for element in root.iter()}
+    assert {"F&K-1", "<rammeaftale>", "A&B", "<n/a>", "K&1"} <= texts
+
+def test_enrich_with_cvr_numbers_only_looks_up_missing_vat(invoice_service):
+    with patch.object(invoice_service, 'lookup_cvr_with_company_mapping', return_value="12345678") as mock_lookup:
+        data = invoice_service.enrich_with_cvr_numbers({"supplier_name": "Acme", "supplier_vat": "DK1", "customer_name": "Globex", "customer_vat": ""})
+        invoice_service.enrich_with_cvr_numbers({"supplier_name": None})
+    
+    assert data["supplier_vat"] == "DK1"
+    assert data["customer_vat"] == "12345678"
+    mock_lookup.assert_called_once_with("Globex")
+
+def test_prepare_invoice_data_defaults_share_one_timestamp(invoice_service):
+    with patch('services.invoice_service.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime(2024, 3, 1, 12, 30, 45)
+        mock_datetime.strptime.side_effect = datetime.strptime
+        data = invoice_service._prepare_invoice_data({}, [])
+    
+    mock_datetime.now.assert_called_once()
+    assert data["invoice_number"] == "INV-20240301123045"
+    assert (data["invoice_date"], data["payment_due_date"]) == ("2024-03-01", "2024-03-31")
+
+def test_generate_enhanced_oioxml_adjusts_last_line_to_expected_total(invoice_service):
+    data = {"invoice_number": "1", "tax_percent": 25, "line_extension_amount": 30.05}
+    line_items = [{"description": "x", "quantity": 1, "unit_price": 10}, {"description": "y", "quantity": 2, "unit_price": 10}]
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, line_items)
+    
+    assert '<cbc:LineExtensionAmount currencyID="DKK">20.05</cbc:LineExtensionAmount>' in xml
+    assert '<cbc:LineExtensionAmount currencyID="DKK">10.00</cbc:LineExtensionAmount>' in xml
+
+def test_generate_enhanced_oioxml_invoice_line_units_and_identifiers(invoice_service):
+    import xml.etree.ElementTree as ET
+    ns = {"cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+          "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"}
+    line_items = [{"description": "Skruer", "quantity": "2,5", "unit": "kasse", "unit_price": 10, "gtin": "5701234567890"},
+                  {"description": "Timeløn", "quantity": 3, "unit": "hur", "unit_price": 400}]
+    
+    xml = invoice_service._generate_enhanced_oioxml({"invoice_number": "1", "tax_percent": 25, "customer_reference": "Kantine"}, line_items)
+    
+    lines = ET.fromstring(xml.encode("utf-8")).findall("cac:InvoiceLine", ns)
+    assert [line.find("cbc:InvoicedQuantity", ns).attrib["unitCode"] for line in lines] == ["CS", "HUR"]
+    assert lines[0].find("cac:Item/cac:StandardItemIdentification/cbc:ID", ns).text == "5701234567890"
+    assert lines[1].find("cac:Item/cac:StandardItemIdentification", ns) is None
+    assert {line.find("cac:OrderLineReference/cac:OrderReference/cbc:CustomerReference", ns).text for line in lines} == {"Kantine"}
+
+def test_generate_enhanced_oioxml_cleans_supplier_cvr_and_vat(invoice_service):
+    data = {"invoice_number": "1", "tax_percent": 25, "supplier_cvr": "12 34-56.78", "supplier_vat": "dk 12 34 56 78"}
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, [{"quantity": 1, "unit_price": 10}])
+    
+    assert '<cbc:CompanyID schemeID="DK:CVR">DK12345678</cbc:CompanyID>' in xml
+    assert '<cbc:CompanyID schemeID="DK:SE">DK12345678</cbc:CompanyID>' in xml
+
+def test_generate_enhanced_oioxml_seller_party_repeats_supplier_details(invoice_service):
+    data = {"invoice_number": "1", "tax_percent": 25, "supplier_name": "Jensen & Søn", "supplier_cvr": "12345678", "supplier_gln": "5790000123456"}
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, [{"quantity": 1, "unit_price": 10}])
+    
+    accounting = xml.split("<cac:AccountingSupplierParty>")[1].split("</cac:AccountingSupplierParty>")[0]
+    seller = xml.split("<cac:SellerSupplierParty>")[1].split("</cac:SellerSupplierParty>")[0]
+    assert accounting.count("5790000123456") == seller.count("5790000123456") == 1
+    assert '<cbc:CompanyID schemeID="DK:CVR">DK12345678</cbc:CompanyID>' in accounting
+    details = lambda party: party[party.index("<cac:PartyIdentification>"):party.index("</cac:PartyTaxScheme>")]
+    assert details(accounting) == details(seller)
+
+def test_extracted_dates_do_not_read_the_clock(invoice_service):
+    data = {"invoice_number": "1", "tax_percent": 25, "invoice_date": "2024-03-01", "order_date": "2024-02-28"}
+    
+    with patch('services.invoice_service.datetime') as mock_datetime:
+        xml = invoice_service._generate_enhanced_oioxml(data, [])
+    
+    mock_datetime.now.assert_not_called()
+    assert "<cbc:IssueDate>2024-03-01</cbc:IssueDate>" in xml
+    assert "<cbc:IssueDate>2024-02-28</cbc:IssueDate>" in xml
+
+@pytest.mark.parametrize("default_only, expected_name", [(True, "Default Kantine ApS"), (False, "Jensen &amp; Søn")])
+def test_generate_enhanced_oioxml_customer_party_falls_back_to_default_customer(invoice_service, default_only, expected_name):
+    default_customer = {"vat": "11111111", "name": "Default Kantine ApS", "street": "Vej 1", "city": "Aarhus",
+                        "postal_code": "8000", "country": "DK", "contact_name": "Ole", "contact_phone": "12345678"}
+    data = {"invoice_number": "1", "tax_percent": 25, "customer_name": "Jensen & Søn", "customer_city": "Odense"}
+    
+    with patch('services.invoice_service.USE_DEFAULT_CUSTOMER_ONLY', default_only), \
+         patch.object(invoice_service, 'load_default_customer_config', return_value=default_customer):
+        xml = invoice_service._generate_enhanced_oioxml(data, [])
+    
+    customer = xml.split("<cac:AccountingCustomerParty>")[1].split("</cac:AccountingCustomerParty>")[0]
+    assert f"<cbc:RegistrationName>{expected_name}</cbc:RegistrationName>" in customer
+    assert f"<cbc:CityName>{'Aarhus' if default_only else 'Odense'}</cbc:CityName>" in customer
+    assert '<cbc:EndpointID schemeID="DK:CVR">11111111</cbc:EndpointID>' in customer
+
+@pytest.mark.parametrize("code, method_type, expected", [
+    ("93", "BANK_TRANSFER", "<cac:CreditAccount>"),
+    ("42", "FIK", "<cac:CreditAccount>"),
+    ("42", "", "<cac:PayeeFinancialAccount>"),
+    ("31", "bank_transfer", "<cac:PayeeFinancialAccount>"),
+    ("31", "CARD", None),
+])
+def test_generate_enhanced_oioxml_payment_means_details(invoice_service, code, method_type, expected):
+    data = {"invoice_number": "1", "payment_means_code": code, "payment_method_type": method_type, "account_id": "12345678"}
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, [])
+    
+    payment_means = xml.split("<cac:PaymentMeans>")[1].split("</cac:PaymentMeans>")[0]
+    for element in ("<cac:CreditAccount>", "<cac:PayeeFinancialAccount>"):
+        assert (element in payment_means) == (element == expected)
+    assert ("DK:FIK</cbc:PaymentChannelCode>" in payment_means) == (code == "93")
+    assert ("DK:BANK</cbc:PaymentChannelCode>" in payment_means) == (code == "42")
+
+@pytest.mark.parametrize("account_id, expected", [("123", "00000123"), ("123456789012", "12345678"), ("12345678", "12345678")])
+def test_fik_payment_means_pads_or_truncates_account_id(account_id, expected):
+    from services.invoice_service import _fik_payment_means
+    
+    assert f'      <cbc:AccountID>{expected}</cbc:AccountID>' in _fik_payment_means({"account_id": account_id})
+
+def test_bank_payment_means_splits_combined_bank_account():
+    from services.invoice_service import _bank_payment_means
+    
+    parts = _bank_payment_means({"bank_account": "1234 - 5678 901-234"})
+    
+    assert '      <cbc:ID>5678901234</cbc:ID>' in parts
+    assert '        <cbc:ID>1234</cbc:ID>' in parts
+
+@pytest.mark.parametrize("supplier_vat, expected", [
+    ("DK 87 65 43 21", "DK87654321"),
+    ("dk87654321", "DK87654321"),
+    ("87654321", "DK87654321"),
+    ("", "DK12345678"),
+    ("DK1234", "DK12345678"),
+    ("SE556677889901", "DK12345678"),
+])
+def test_generate_enhanced_oioxml_supplier_vat_falls_back_to_cvr(invoice_service, supplier_vat, expected):
+    data = {"invoice_number": "1", "supplier_cvr": "12345678", "supplier_vat": supplier_vat}
+    
+    xml = invoice_service._generate_enhanced_oioxml(data, [])
+    
+    assert f'<cbc:CompanyID schemeID="DK:SE">{expected}</cbc:CompanyID>' in xml
+
+@pytest.mark.parametrize("value, expected", [(2, 2.0), ("2,5", 2.5), (" 3.25 ", 3.25), ("", 1.0), (None, 1.0), ("2 stk", 1.0)])
+def test_to_float_reads_decimal_commas(value, expected):
+    from services.invoice_service import _to_float
+    
+    assert _to_float(value, 1.0) == expected
+
+@pytest.mark.parametrize("amount, expected", [(2.675, "2.67"), ("19.999", "20.00"), (-0.001, "-0.00"), (7, "7.00"), ("12,50", "0.00"), (None, "0.00")])
+def test_format_amount_rounds_to_two_decimals(invoice_service, amount, expected):
+    assert invoice_service.format_amount(amount) == expected
+
+@pytest.mark.parametrize("discount, expected", [(None, 0.0), (0, 0.0), ("", 0.0), (10, 10.0), ("10%", 10.0), (" 12,5 % ", 12.5)])
+def test_discount_percent_reads_extracted_discounts(discount, expected):
+    from services.invoice_service import _discount_percent
+    
+    assert _discount_percent({"discount": discount}) == expected
+
+def test_discount_percent_raises_on_unreadable_discount():
+    from services.invoice_service import _discount_percent, _line_amount
+    
+    with pytest.raises(ValueError):
+        _discount_percent({"discount": "se aftale"})
+    assert _line_amount({"quantity": 1, "unit_price": 10, "discount": "se aftale"}) is None
@@ -0,0 +1,26 @@
+import os
+import time
+from unittest.mock import patch
+from utils import llm_cache
+
+def test_prune_cache_removes_expired_and_oldest_entries(tmp_path):
+    now = time.time()
+    paths = []
+    for index, age_days in enumerate([0, 1, 2, 40]):
+        key = f"{index:02x}" * 32
+        path = tmp_path / key[:2] / f"{key}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('{"created": 0, "content": "{}"}', encoding="utf-8")
+        os.utime(path, (now - age_days * 86400, now - age_days * 86400))
+        paths.append(path)
+    
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path)):
+        llm_cache.prune_cache(max_entries=10)
+        assert [path.exists() for path in paths] == [True, True, True, False]
+        
+        llm_cache.prune_cache(max_entries=2)
+        assert [path.exists() for path in paths] == [True, True, False, False]
+
+def test_prune_cache_without_cache_directory(tmp_path):
+    with patch('utils.llm_cache.LLM_CACHE_DIR', str(tmp_path / "missing")):
+        llm_cache.prune_cache()
@@ -1,110 +1,87 @@
 import pytest
-import os
-from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, Mock, MagicMock
 from services.local_pdf_service import LocalPDFService
+from services.pdf_service import PDFService
+from services.invoice_service import InvoiceService
 
 @pytest.fixture
 def local_pdf_service():
-    with patch('services.local_pdf_service.PDFService'), \
-         patch('services.local_pdf_service.InvoiceService'):
+    with patch('services.local_pdf_service.PDFService', return_value=Mock(spec=PDFService)), \
+         patch('services.local_pdf_service.InvoiceService', return_value=Mock(spec=InvoiceService)):
         return LocalPDFService()
 
-@patch('services.local_pdf_service.LOCAL_PDF_DIR', '/fake/local')
-def test_get_pdf_files_success(local_pdf_service):
-    # Create proper mock Path objects
-    mock_file1 = MagicMock(spec=Path)
-    mock_file1.is_file.return_value = True
-    mock_file1.__str__.return_value = "/fake/local/invoice1.pdf"
+def test_get_pdf_files_success(local_pdf_service, tmp_path):
+    (tmp_path / "invoice2.pdf").write_bytes(b"%PDF")
+    (tmp_path / "invoice1.PDF").write_bytes(b"%PDF")
+    (tmp_path / "notes.txt").write_text("not a pdf")
+    (tmp_path / "folder.pdf").mkdir()
     
-    mock_file2 = MagicMock(spec=Path)
-    mock_file2.is_file.return_value = True
-    mock_file2.__str__.return_value = "/fake/local/invoice2.pdf"
-    
-    mock_file3 = MagicMock(spec=Path)
-    mock_file3.is_file.return_value = False
-    mock_file3.__str__.return_value = "/fake/local/not_a_file"
-    
-    mock_files = [mock_file1, mock_file2, mock_file3]
-    
-    with patch('pathlib.Path.exists', return_value=True), \
-         patch('pathlib.Path.glob', return_value=mock_files):
-        
+    with patch('services.local_pdf_service.LOCAL_PDF_DIR', str(tmp_path)):
         result = local_pdf_service.get_pdf_files()
-        
-        # Should return only actual files, sorted
-        assert len(result) == 2
-        assert "/fake/local/invoice1.pdf" in result
-        assert "/fake/local/invoice2.pdf" in result
+    
+    # Only actual PDF files, any extension case, sorted
+    assert result == [str(tmp_path / "invoice1.PDF"), str(tmp_path / "invoice2.pdf")]
 
 @patch('services.local_pdf_service.LOCAL_PDF_DIR', '/nonexistent')
 def test_get_pdf_files_directory_not_exists(local_pdf_service):
-    with patch('pathlib.Path.exists', return_value=False):
-        result = local_pdf_service.get_pdf_files()
-        assert result == []
+    result = local_pdf_service.get_pdf_files()
+    assert result == []
 
-def test_get_pdf_files_empty_directory(local_pdf_service):
-    with patch('pathlib.Path.exists', return_value=True), \
-         patch('pathlib.Path.glob', return_value=[]):
-        
+def test_get_pdf_files_empty_directory(local_pdf_service, tmp_path):
+    with patch('services.local_pdf_service.LOCAL_PDF_DIR', str(tmp_path)):
         result = local_pdf_service.get_pdf_files()
         assert result == []
 
-def test_process_single_pdf_success(local_pdf_service):
-    # Mock successful processing
-    local_pdf_service.pdf_service.convert_to_markdown.return_value = "Markdown content"
-    local_pdf_service.invoice_service.generate_invoice.return_value = (
-        "/output/invoice.xml", 
-        {"invoice_number": "123"}, 
-        {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
-    )
+@pytest.mark.parametrize("markdown, generated, expected_success, expected_message, expected_usage", [
+    # Successful processing
+    ("Markdown content", ("/output/invoice.xml", {"invoice_number": "123"}, {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}),
+     True, "Successfully processed", {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}),
+    # Markdown conversion failure
+    ("", None, False, "Failed to extract content", {}),
+    # Successful markdown but failed invoice generation
+    ("Content", (None, None, {}), False, "Failed to generate invoice", {}),
+])
+def test_process_single_pdf(local_pdf_service, markdown, generated, expected_success, expected_message, expected_usage):
+    local_pdf_service.pdf_service.convert_to_markdown.return_value = markdown
+    local_pdf_service.invoice_service.generate_invoice.return_value = generated
     
-    with patch.object(local_pdf_service, 'move_to_processed', return_value="/processed/file.pdf"):
-        result = local_pdf_service.process_single_pdf("/local/test.pdf")
-        
-        success, message, token_usage = result
-        assert success is True
-        assert "Successfully processed" in message
-        assert token_usage["total_tokens"] == 150
-
-def test_process_single_pdf_markdown_failure(local_pdf_service):
-    # Mock markdown conversion failure
-    local_pdf_service.pdf_service.convert_to_markdown.return_value = ""
+    with patch.object(local_pdf_service, 'move_to_processed', return_value="/processed/file.pdf") as mock_move:
+        success, message, token_usage = local_pdf_service.process_single_pdf("/local/test.pdf")
     
-    result = local_pdf_service.process_single_pdf("/local/test.pdf")
-    
-    success, message, token_usage = result
-    assert success is False
-    assert "Failed to extract content" in message
-    assert token_usage == {}
+    assert success is expected_success
+    assert expected_message in message
+    assert token_usage == expected_usage
+    # Only processed files are moved out of the input folder
+    assert mock_move.called is expected_success
 
-def test_process_single_pdf_invoice_generation_failure(local_pdf_service):
-    # Mock successful markdown but failed invoice generation
-    local_pdf_service.pdf_service.convert_to_markdown.return_value = "Content"
-    local_pdf_service.invoice_service.generate_invoice.return_value = (None, None, {})
+def test_process_single_pdf_uses_given_invoice_service(local_pdf_service):
+    # Parallel workers pass their own invoice service
+    local_pdf_service.pdf_service.convert_to_markdown.return_value = "Markdown content"
+    worker_invoice_service = MagicMock()
+    worker_invoice_service.generate_invoice.return_value = (
+        "/output/invoice.xml", {"invoice_number": "123"}, {}
+    )
     
-    result = local_pdf_service.process_single_pdf("/local/test.pdf")
+    with patch.object(local_pdf_service, 'move_to_processed'):
+        success, _, _ = local_pdf_service.process_single_pdf("/local/test.pdf", worker_invoice_service)
     
-    success, message, token_usage = result
-    assert success is False
-    assert "Failed to generate invoice" in message
+    assert success is True
+    worker_invoice_service.generate_invoice.assert_called_once_with("Markdown content")
+    local_pdf_service.invoice_service.generate_invoice.assert_not_called()
 
-@patch('shutil.move')
-@patch('os.path.splitext')
-@patch('os.path.basename')
-def test_move_to_processed(mock_basename, mock_splitext, mock_move, local_pdf_service):
-    # Mock file operations
-    mock_basename.return_value = "test.pdf"
-    mock_splitext.return_value = ("test", ".pdf")
+def test_move_to_processed(local_pdf_service, tmp_path):
+    pdf_file = tmp_path / "test.pdf"
+    pdf_file.write_bytes(b"%PDF-1.4")
+    processed_dir = tmp_path / "processed"
     
-    with patch('services.local_pdf_service.datetime') as mock_datetime:
+    with patch('services.local_pdf_service.PROCESSED_PDF_DIR', str(processed_dir)), \
+         patch('services.local_pdf_service.datetime') as mock_datetime:
         mock_datetime.now.return_value.strftime.return_value = "20241201_123000"
-        
-        with patch('os.path.join', return_value="/processed/test_20241201_123000.pdf"):
-            result = local_pdf_service.move_to_processed("/local/test.pdf")
-            
-            assert result == "/processed/test_20241201_123000.pdf"
-            mock_move.assert_called_once()
+        result = local_pdf_service.move_to_processed(str(pdf_file))
+    
+    assert result == str(processed_dir / "test_20241201_123000.pdf")
+    assert (processed_dir / "test_20241201_123000.pdf").read_bytes() == b"%PDF-1.4"
+    assert not pdf_file.exists()
 
 def test_process_all_pdfs_success(local_pdf_service):
     # Mock multiple PDFs
@@ -166,4 +143,33 @@ def test_process_all_pdfs_output_format(mock_print, local_pdf_service):
             # Verify that success message was printed
             mock_print.assert_called()
             calls = [str(call) for call in mock_print.call_args_list]
-            assert any("✓" in call for call in calls)  # Success indicator
\ No newline at end of file
+            assert any("✓" in call for call in calls)  # Success indicator
+def test_process_pdfs_with_batch_api(local_pdf_service):
+    # Files that fail conversion never reach the batch; results keep file order
+    local_pdf_service.pdf_service.convert_to_markdown.side_effect = lambda path: "" if "empty" in path else f"Markdown {path}"
+    local_pdf_service.invoice_service.generate_invoices_with_batch_api.return_value = [
+        ("/output/invoice1.xml", {"invoice_number": "1"}, {"total_tokens": 10}),
+        (None, None, {})
+    ]
+    
+    with patch.object(local_pdf_service, 'move_to_processed') as mock_move:
+        outcomes = local_pdf_service.process_pdfs_with_batch_api(
+            ["/local/invoice1.pdf", "/local/empty.pdf", "/local/invoice2.pdf"]
+        )
+    
+    local_pdf_service.invoice_service.generate_invoices_with_batch_api.assert_called_once_with(
+        ["Markdown /local/invoice1.pdf", "Markdown /local/invoice2.pdf"]
+    )
+    assert [outcome[0] for outcome in outcomes] == [True, False, False]
+    mock_move.assert_called_once_with("/local/invoice1.pdf")
+
+@patch('services.local_pdf_service.USE_OPENAI_BATCH_API', True)
+def test_process_all_pdfs_uses_batch_api_when_enabled(local_pdf_service):
+    with patch.object(local_pdf_service, 'get_pdf_files', return_value=["/local/invoice1.pdf"]), \
+         patch.object(local_pdf_service, 'process_pdfs_with_batch_api', return_value=[(True, "Success", {})]) as mock_batch, \
+         patch.object(local_pdf_service, 'process_single_pdf') as mock_single:
+        result = local_pdf_service.process_all_pdfs()
+    
+    mock_batch.assert_called_once_with(["/local/invoice1.pdf"])
+    mock_single.assert_not_called()
+    assert result["successful"] == 1
@@ -1,16 +1,21 @@
+import os
+import time
 import pytest
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, Mock, MagicMock
 from services.pdf_service import PDFService
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def pdf_service():
-    # Mock MarkItDown at the service initialization level
-    with patch('services.pdf_service.MarkItDown') as mock_markitdown:
-        mock_instance = MagicMock()
-        mock_markitdown.return_value = mock_instance
-        service = PDFService()
-        service.markitdown = mock_instance
-        yield service
+    # MarkItDown is only set up on first use, so a plain Mock can stand in for it without patching
+    service = PDFService()
+    service.markitdown = Mock()
+    return service
+
+@pytest.fixture(autouse=True)
+def reset_markitdown(pdf_service):
+    """The service is shared by the module, so every test starts from a fresh MarkItDown mock"""
+    yield
+    pdf_service.markitdown.reset_mock(return_value=True, side_effect=True)
 
 def test_convert_to_markdown_success(pdf_service):
     # Mock MarkItDown response
@@ -80,7 +85,7 @@ def test_convert_to_markdown_danish_content(pdf_service):
 
 def test_pdf_service_initialization():
     # Test that PDFService initializes correctly with mocked MarkItDown
-    with patch('services.pdf_service.MarkItDown') as mock_markitdown:
+    with patch('markitdown.MarkItDown') as mock_markitdown:
         mock_instance = MagicMock()
         mock_markitdown.return_value = mock_instance
         
@@ -88,4 +93,66 @@ def test_pdf_service_initialization():
         assert service.markitdown is not None
         
         service_with_plugins = PDFService(enable_plugins=True)
-        assert service_with_plugins.markitdown is not None
\ No newline at end of file
+        assert service_with_plugins.markitdown is not None
+def test_convert_to_markdown_reuses_cached_conversion(tmp_path):
+    pdf_path = tmp_path / "invoice.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 faktura")
+    copy_path = tmp_path / "invoice_copy.pdf"
+    copy_path.write_bytes(b"%PDF-1.4 faktura")
+    
+    with patch('markitdown.MarkItDown') as mock_markitdown:
+        mock_markitdown.return_value.convert.return_value = MagicMock(text_content="# Faktura 112262")
+        service = PDFService(cache_dir=str(tmp_path / "cache"))
+        
+        assert service.convert_to_markdown(str(pdf_path)) == "# Faktura 112262"
+        assert service.convert_to_markdown(str(copy_path)) == "# Faktura 112262"
+    
+    # Same bytes under another name is a cache hit
+    service.markitdown.convert.assert_called_once_with(str(pdf_path))
+
+def test_convert_to_markdown_does_not_cache_empty_conversion(tmp_path):
+    pdf_path = tmp_path / "scan.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 scan")
+    
+    with patch('markitdown.MarkItDown') as mock_markitdown:
+        mock_markitdown.return_value.convert.return_value = MagicMock(text_content="")
+        service = PDFService(cache_dir=str(tmp_path / "cache"))
+        
+        assert service.convert_to_markdown(str(pdf_path)) == ""
+        assert service.convert_to_markdown(str(pdf_path)) == ""
+    
+    assert service.markitdown.convert.call_count == 2
+    assert not (tmp_path / "cache").exists()
+
+def test_prune_cache_keeps_newest_entries(tmp_path):
+    cache_dir = tmp_path / "cache"
+    now = time.time()
+    paths = []
+    for index, age_days in enumerate([0, 1, 2, 3, 40]):
+        path = cache_dir / f"{index:02x}" / f"{index:02x}entry.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("# Faktura", encoding="utf-8")
+        os.utime(path, (now - age_days * 86400, now - age_days * 86400))
+        paths.append(path)
+    
+    service = PDFService(cache_dir=str(cache_dir))
+    
+    # Under the cap only the entry past the TTL goes
+    service.prune_cache(max_entries=10)
+    assert [path.exists() for path in paths] == [True, True, True, True, False]
+    
+    # Over the cap the oldest entries go first
+    service.prune_cache(max_entries=3)
+    assert [path.exists() for path in paths] == [True, True, True, False, False]
+
+def test_prune_cache_without_cache_directory(tmp_path):
+    PDFService(cache_dir=str(tmp_path / "missing")).prune_cache()
+
+def test_pdf_service_sets_up_markitdown_on_first_use():
+    with patch('markitdown.MarkItDown') as mock_markitdown:
+        service = PDFService(enable_plugins=True)
+        mock_markitdown.assert_not_called()
+        
+        assert service.markitdown is service.markitdown
+    
+    mock_markitdown.assert_called_once_with(enable_plugins=True)
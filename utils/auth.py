@@ -1,19 +1,29 @@
 import msal
+from functools import lru_cache
 from config.credentials import MS_CLIENT_ID, MS_CLIENT_SECRET, MS_TENANT_ID
 
-def get_access_token():
-    app = msal.ConfidentialClientApplication(
+@lru_cache(maxsize=1)
+def _get_app():
+    # Reuse one MSAL application so its in-memory token cache survives between calls
+    return msal.ConfidentialClientApplication(
         client_id=MS_CLIENT_ID,
         client_credential=MS_CLIENT_SECRET,
         authority=f"https://login.microsoftonline.com/{MS_TENANT_ID}"
     )
+
+def get_access_token_with_expiry():
+    """Return the access token together with its lifetime in seconds"""
+    app = _get_app()
     
     # Acquire token for application (client credentials flow)
     result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
     
     if "access_token" in result:
-        return result["access_token"]
+        return result["access_token"], int(result.get("expires_in", 3600))
     else:
         error = result.get("error", "Unknown error")
         description = result.get("error_description", "No description")
-        raise Exception(f"Failed to acquire token: {error} - {description}")
\ No newline at end of file
+        raise Exception(f"Failed to acquire token: {error} - {description}")
+
+def get_access_token():
+    return get_access_token_with_expiry()[0]
\ No newline at end of file
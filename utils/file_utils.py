@@ -1,12 +1,26 @@
 import os
 import re
+import stat
+import base64
+import mmap
 import tempfile
 import string
+import time
 import random
+from functools import lru_cache
 
+# Characters not allowed in saved file names
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-\.]')
+# Characters used for random strings
+_RANDOM_ALPHABET = string.ascii_lowercase + string.digits
+# Process umask, read once at import since reading it means briefly changing it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+@lru_cache(maxsize=1024)
 def safe_filename(filename):
     # Replace invalid characters with underscores
-    safe_name = re.sub(r'[^\w\-\.]', '_', filename)
+    safe_name = _UNSAFE_FILENAME_RE.sub('_', filename)
     
     # Ensure the filename isn't too long
     if len(safe_name) > 255:
@@ -15,9 +29,71 @@ def safe_filename(filename):
         
     return safe_name
 
+@lru_cache(maxsize=None)
+def ensure_dir(path):
+    # Create the directory once per process; later calls are a cache hit
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def encode_file_base64(path):
+    # Encode straight from a memory map so the raw file is never copied onto the heap
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return base64.b64encode(mapped).decode('ascii')
+
+def write_text_atomic(path, text, buffering=1 << 20):
+    # Write next to the target and swap it in, so readers never see a partial file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with open(fd, 'w', encoding='utf-8', buffering=buffering) as file:
+            file.write(text)
+        # mkstemp creates the file as 0600; give it the mode a plain open() would have left
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+def prune_cache_dir(cache_dir, suffix, max_entries, max_age_days):
+    # Cache entries live in <key[:2]>/<key><suffix>; remove those past the age limit, then the
+    # oldest by mtime beyond max_entries. Returns how many were removed.
+    entries = []
+    try:
+        with os.scandir(cache_dir) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(bucket.path) as files:
+                    entries.extend(
+                        (entry.stat().st_mtime, entry.path) for entry in files
+                        if entry.name.endswith(suffix) and entry.is_file(follow_symlinks=False)
+                    )
+    except FileNotFoundError:
+        return 0
+    
+    # Newest first, so everything past max_entries is the oldest
+    entries.sort(reverse=True)
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for index, (mtime, path) in enumerate(entries):
+        if index >= max_entries or mtime < cutoff:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
 def create_temp_directory(prefix="email_processor_"):
     return tempfile.mkdtemp(prefix=prefix)
 
 def random_string(length=10):
-    letters = string.ascii_lowercase + string.digits
-    return ''.join(random.choice(letters) for _ in range(length))
\ No newline at end of file
+    return ''.join(random.choices(_RANDOM_ALPHABET, k=length))
\ No newline at end of file
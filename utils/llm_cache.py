@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+from config.settings import LLM_CACHE_DIR, LLM_CACHE_TTL_DAYS, LLM_CACHE_MAX_ENTRIES
+from utils.file_utils import ensure_dir, write_text_atomic, prune_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Recent responses kept in memory in front of the disk cache: (created, content) by key
+_MEMORY_MAX_ENTRIES = 512
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+# Per-key locks so identical requests in flight at the same time make a single API call
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def cache_key(request: Dict[str, Any]) -> str:
+    # Content address of the full request: model, messages, temperature and max_tokens
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+def _entry_path(key: str) -> str:
+    return os.path.join(LLM_CACHE_DIR, key[:2], f"{key}.json")
+
+def _expired(created: float) -> bool:
+    return time.time() - created > LLM_CACHE_TTL_DAYS * 86400
+
+def _remember(key: str, created: float, content: str):
+    with _memory_lock:
+        _memory[key] = (created, content)
+        _memory.move_to_end(key)
+        if len(_memory) > _MEMORY_MAX_ENTRIES:
+            _memory.popitem(last=False)
+
+def get_cached_response(key: str) -> Optional[str]:
+    with _memory_lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            _memory.move_to_end(key)
+    if entry is not None and not _expired(entry[0]):
+        return entry[1]
+    
+    path = _entry_path(key)
+    
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    # Drop entries older than the TTL
+    created = entry.get("created", 0)
+    if _expired(created):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    
+    content = entry.get("content")
+    if content is not None:
+        _remember(key, created, content)
+    return content
+
+def store_response(key: str, content: str):
+    path = _entry_path(key)
+    created = time.time()
+    _remember(key, created, content)
+    
+    try:
+        ensure_dir(os.path.dirname(path))
+        write_text_atomic(path, json.dumps({"created": created, "content": content}, ensure_ascii=False))
+    except OSError as e:
+        logger.warning(f"Could not store LLM response in cache: {e}")
+
+def prune_cache(max_entries: int = LLM_CACHE_MAX_ENTRIES):
+    """Remove expired entries from the disk cache, then the oldest ones beyond max_entries"""
+    try:
+        removed = prune_cache_dir(LLM_CACHE_DIR, ".json", max_entries, LLM_CACHE_TTL_DAYS)
+    except OSError as e:
+        logger.warning(f"Could not prune LLM cache: {e}")
+        return
+    
+    if removed:
+        logger.info(f"Pruned {removed} entries from the LLM cache")
+
+
+@contextmanager
+def single_flight(key: str):
+    """Hold the lock for one request key; other threads asking for the same key wait for it"""
+    with _inflight_lock:
+        entry = _inflight.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _inflight_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _inflight[key]
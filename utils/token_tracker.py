@@ -1,21 +1,43 @@
 import logging
+import threading
 from typing import Dict
 
 logger = logging.getLogger(__name__)
 
+# Emails are processed concurrently, so counter updates must be serialized
+_lock = threading.Lock()
+
+# Price per token in USD ($0.0015 / $0.002 per 1K tokens)
+_PROMPT_TOKEN_PRICE = 0.0015 / 1000
+_COMPLETION_TOKEN_PRICE = 0.002 / 1000
+
 # Global token tracking variables
 prompt_tokens = 0
 completion_tokens = 0
 total_tokens = 0
+# LLM calls answered from the response cache instead of the API
+cached_responses = 0
 
 def update_token_usage(new_prompt_tokens: int, new_completion_tokens: int):
     global prompt_tokens, completion_tokens, total_tokens
     
-    prompt_tokens += new_prompt_tokens
-    completion_tokens += new_completion_tokens
-    total_tokens += new_prompt_tokens + new_completion_tokens
+    with _lock:
+        prompt_tokens += new_prompt_tokens
+        completion_tokens += new_completion_tokens
+        total_tokens += new_prompt_tokens + new_completion_tokens
+        usage = (prompt_tokens, completion_tokens, total_tokens)
+    
+    # Formatted by logging only when DEBUG is enabled
+    logger.debug("Updated global token usage: prompt=%d, completion=%d, total=%d", *usage)
+
+def record_cached_response():
+    global cached_responses
     
-    logger.debug(f"Updated global token usage: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}")
+    with _lock:
+        cached_responses += 1
+
+def get_cached_response_count() -> int:
+    return cached_responses
 
 def get_token_usage() -> Dict[str, int]:
     return {
@@ -25,14 +47,13 @@ def get_token_usage() -> Dict[str, int]:
     }
 
 def get_cost_estimate() -> float:
-    prompt_cost = (prompt_tokens / 1000) * 0.0015
-    completion_cost = (completion_tokens / 1000) * 0.002
-    return prompt_cost + completion_cost
+    return prompt_tokens * _PROMPT_TOKEN_PRICE + completion_tokens * _COMPLETION_TOKEN_PRICE
 
 def reset_counters():
     """Reset all token counters to zero"""
-    global prompt_tokens, completion_tokens, total_tokens
+    global prompt_tokens, completion_tokens, total_tokens, cached_responses
     prompt_tokens = 0
     completion_tokens = 0
     total_tokens = 0
+    cached_responses = 0
     logger.debug("Token usage counters reset to zero")
\ No newline at end of file